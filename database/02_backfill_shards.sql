@@ -0,0 +1,8 @@
+-- Table: block ranges completed by a backfill (python -m src.backfill)
+CREATE TABLE backfill_shards (
+    chain_name VARCHAR(50) NOT NULL,
+    from_block BIGINT NOT NULL,
+    to_block BIGINT NOT NULL,
+    completed_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (chain_name, from_block, to_block)
+);
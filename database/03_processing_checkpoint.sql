@@ -0,0 +1,11 @@
+-- Table: last block fully processed per chain and processing stage, used to resume processing
+CREATE TABLE processing_checkpoint (
+    chain_name VARCHAR(50) NOT NULL,
+    stage VARCHAR(50) NOT NULL,
+    block_number BIGINT NOT NULL,
+    updated_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (chain_name, stage)
+);
+
+-- used to find the latest transaction if no checkpoint exists yet
+CREATE INDEX IF NOT EXISTS transaction_timestamp_time_idx ON transaction_timestamp (time);
@@ -0,0 +1,11 @@
+-- Table: settlements which failed repeatedly, replayed with python -m src.replay_failed
+CREATE TABLE failed_transactions (
+    chain_name VARCHAR(50) NOT NULL,
+    tx_hash BYTEA NOT NULL,
+    block_number BIGINT NOT NULL,
+    auction_id BIGINT,
+    attempts INT NOT NULL,
+    last_error TEXT NOT NULL,
+    failed_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (chain_name, tx_hash)
+);
@@ -0,0 +1,293 @@
+"""
+Asynchronous processing of settlements.
+
+Chain data is fetched with AsyncWeb3 (aiohttp), price providers and database writes run in
+worker threads. Up to ASYNC_MAX_SETTLEMENTS settlements are processed concurrently, with
+separate limits for requests to the node and to price providers. Results are written to the
+database in block order, in groups of DB_WRITE_GROUP_SIZE settlements, using the same writes as
+TransactionProcessor.
+The price providers are the blocking ones of TransactionProcessor, which are called in worker
+threads instead of being replaced by async HTTP clients. Settlements are traced one by one, so
+TRACE_MODE is not used, and receipts and traces are not fetched with the fast RPC client.
+"""
+
+import asyncio
+import random
+from typing import Any, Awaitable, Callable
+
+from web3 import AsyncWeb3
+from web3.types import HexStr, RPCEndpoint
+
+from src.helpers.block_headers import BLOCK_HEADERS
+from src.helpers.blockchain_data import (
+    BlockchainData,
+    SettlementRecord,
+    decode_auction_id,
+)
+from src.helpers.config import (
+    ASYNC_MAX_SETTLEMENTS,
+    ASYNC_NODE_CONCURRENCY,
+    ASYNC_PRICE_CONCURRENCY,
+    CHAIN_SLEEP_TIME,
+    logger,
+)
+from src.helpers.database import Database, SettlementResult
+from src.helpers.eth_flows import EthFlow, eth_flow
+from src.helpers.helper_functions import set_params
+from src.transaction_processor import TransactionProcessor
+
+
+class AsyncTransactionProcessor(TransactionProcessor):
+    """Class processes settlements concurrently, committing results in block order."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(
+        self,
+        blockchain_data: BlockchainData,
+        db: Database,
+        chain_name: str,
+        process_imbalances: bool,
+        process_fees: bool,
+        process_prices: bool,
+        async_web3: AsyncWeb3,
+        max_settlements: int = ASYNC_MAX_SETTLEMENTS,
+        node_concurrency: int = ASYNC_NODE_CONCURRENCY,
+        price_concurrency: int = ASYNC_PRICE_CONCURRENCY,
+    ):
+        super().__init__(
+            blockchain_data,
+            db,
+            chain_name,
+            process_imbalances,
+            process_fees,
+            process_prices,
+        )
+        self.async_web3 = async_web3
+        self.settlement_limit = asyncio.Semaphore(max_settlements)
+        self.node_limit = asyncio.Semaphore(node_concurrency)
+        self.price_limit = asyncio.Semaphore(price_concurrency)
+
+    async def node_request(
+        self, method: Callable[..., Awaitable[Any]], *args: Any
+    ) -> Any:
+        """Send a request to the node, respecting the limit of concurrent node requests."""
+        async with self.node_limit:
+            return await method(*args)
+
+    async def get_eth_flow(
+        self, tx_hash: str, events: dict[str, list[dict]]
+    ) -> EthFlow:
+        """
+        Fetch the trace of a settlement and aggregate its native ETH flows. In lazy trace mode,
+        the trace is skipped if RawTokenImbalances.needs_trace() is false, except for a sample
+        of trace_verification_rate, as in RawTokenImbalances.get_lazy_eth_flow().
+        """
+        verified = False
+        if self.imbalances.lazy_traces:
+            transaction = await self.node_request(
+                self.async_web3.eth.get_transaction, HexStr(tx_hash)
+            )
+            if not self.imbalances.needs_trace(events, transaction["value"]):
+                self.imbalances.trace_stats["skipped"] += 1
+                if random.random() >= self.imbalances.trace_verification_rate:
+                    return EthFlow()
+                self.imbalances.trace_stats["verified"] += 1
+                verified = True
+        traces = await self.node_request(
+            self.async_web3.manager.coro_request,
+            RPCEndpoint("trace_transaction"),
+            [tx_hash],
+        )
+        flow = eth_flow(traces)
+        if verified:
+            if not (flow.inflow or flow.outflow):
+                return EthFlow()
+            self.imbalances.trace_stats["mismatches"] += 1
+            logger.warning(
+                "Skipping the trace of %s would have missed native ETH flows of %s.",
+                tx_hash,
+                flow,
+            )
+        return flow
+
+    async def get_block_timestamp(self, block_number: int) -> int:
+        """Timestamp of a block, using the shared block header cache."""
+        key = ("block", str(block_number))
+        header = BLOCK_HEADERS.headers.get(key)
+        if header is None:
+            header = await self.node_request(
+                self.async_web3.eth.get_block, block_number
+            )
+            # settlements are only discovered in finalized blocks
+            BLOCK_HEADERS.headers.put(key, header)
+        return header["timestamp"]
+
+    async def get_prices(
+        self,
+        transaction_timestamp: tuple[str, int],
+        transaction_tokens: list[tuple[str, str]],
+        block_number: int,
+    ) -> list[tuple[str, int, float, str]]:
+        """Fetch prices of all tokens concurrently, with a limit on concurrent requests."""
+        tx_hash, timestamp = transaction_timestamp
+
+        async def get_price(token_address: str) -> list[tuple[float, str]]:
+            async with self.price_limit:
+                return await asyncio.to_thread(
+                    self.price_providers.get_price,
+                    set_params(token_address, block_number, tx_hash),
+                )
+
+        token_addresses = [token_address for _, token_address in transaction_tokens]
+        price_data = await asyncio.gather(
+            *(get_price(token_address) for token_address in token_addresses)
+        )
+        prices = []
+        for token_address, token_prices in zip(token_addresses, price_data):
+            if not token_prices:
+                logger.warning(
+                    "Failed to fetch price for token %s and transaction %s.",
+                    token_address,
+                    tx_hash,
+                )
+            prices += [
+                (token_address, timestamp, price, source)
+                for price, source in token_prices
+            ]
+        return prices
+
+    async def compute_token_imbalances(self, tx_hash: str) -> dict[str, int]:
+        """
+        Compute token imbalances of a transaction. As in process_token_imbalances(), errors are
+        raised only if imbalances are processed on this chain.
+        """
+        try:
+            receipt = await self.node_request(
+                self.async_web3.eth.get_transaction_receipt, HexStr(tx_hash)
+            )
+            events = self.imbalances.extract_events(receipt)
+            flow = await self.get_eth_flow(tx_hash, events)
+            return self.imbalances.compute_imbalances_from_events(events, flow)
+        except Exception as err:
+            logger.error(
+                "Failed to compute imbalances for transaction %s: %s", tx_hash, err
+            )
+            if self.process_imbalances:
+                raise
+            return {}
+
+    async def compute_settlement(
+        self, settlement: SettlementRecord
+    ) -> SettlementResult | Exception:
+        """
+        Fetch chain data and prices of a settlement and compute its imbalances.
+        Errors are returned, such that the settlement can be retried.
+        """
+        tx_hash = settlement.tx_hash
+        async with self.settlement_limit:
+            try:
+                if settlement.auction_id is None:
+                    transaction = await self.node_request(
+                        self.async_web3.eth.get_transaction, HexStr(tx_hash)
+                    )
+                    settlement.auction_id = decode_auction_id(transaction["input"])
+                token_imbalances = await self.compute_token_imbalances(tx_hash)
+                transaction_timestamp = (
+                    tx_hash,
+                    await self.get_block_timestamp(settlement.block_number),
+                )
+                transaction_tokens = self.get_transaction_tokens(
+                    tx_hash, token_imbalances
+                )
+                prices = await self.get_prices(
+                    transaction_timestamp, transaction_tokens, settlement.block_number
+                )
+            except Exception as err:
+                logger.error("Error processing transaction %s: %s", tx_hash, err)
+                return err
+        return SettlementResult(
+            settlement,
+            token_imbalances,
+            transaction_timestamp,
+            transaction_tokens,
+            prices,
+        )
+
+    async def process_settlements(
+        self, settlements: list[SettlementRecord], checkpoint: int | None = None
+    ) -> list[tuple[SettlementRecord, Exception]]:
+        """
+        Process settlements concurrently. Results are written in groups of up to
+        db_write_group_size settlements, as soon as all settlements before them in block order
+        are computed. Returns failed settlements with their errors.
+        If checkpoint is given, it is written together with the last results, or on its own.
+        """
+        settlements = sorted(
+            settlements,
+            key=lambda settlement: (settlement.block_number, settlement.tx_index or 0),
+        )
+        tasks = [
+            asyncio.create_task(self.compute_settlement(settlement))
+            for settlement in settlements
+        ]
+        failed: list[tuple[SettlementRecord, Exception]] = []
+        results: list[SettlementResult] = []
+        for i, (settlement, task) in enumerate(zip(settlements, tasks)):
+            result = await task
+            if isinstance(result, Exception):
+                failed.append((settlement, result))
+            else:
+                results.append(result)
+            last = i == len(settlements) - 1
+            if not results or (len(results) < self.db_write_group_size and not last):
+                continue
+            try:
+                await asyncio.to_thread(
+                    self.write_settlement_results,
+                    results,
+                    (
+                        self.checkpoint_block(checkpoint, failed, settlements)
+                        if last and checkpoint is not None
+                        else None
+                    ),
+                )
+                checkpoint = None if last else checkpoint
+            except Exception as err:
+                logger.error("Error writing results of %d txs: %s", len(results), err)
+                failed += [(result.settlement, err) for result in results]
+            results = []
+        if checkpoint is not None:
+            await asyncio.to_thread(
+                self.write_checkpoint, checkpoint, failed, settlements
+            )
+        return failed
+
+    async def process_async(self, start_block: int) -> None:
+        """Main daemon loop, processing all settlements found in a range concurrently."""
+        previous_block = start_block
+        logger.info(
+            "%s async daemon started. Start block: %d", self.chain_name, start_block
+        )
+        while True:
+            try:
+                _, latest_block = await asyncio.to_thread(
+                    self.head_tracker.next_range, previous_block
+                )
+                settlements = await asyncio.to_thread(
+                    self.blockchain_data.fetch_tx_data, previous_block, latest_block
+                )
+                due = self.retries.due()
+                try:
+                    failed = await self.process_settlements(
+                        settlements + due, latest_block
+                    )
+                except Exception as err:
+                    # the range is processed again, settlements due for retry are rescheduled
+                    self.retries.record(due, [(settlement, err) for settlement in due])
+                    raise
+                await asyncio.to_thread(self.record_outcome, settlements + due, failed)
+                previous_block = latest_block + 1
+            except Exception as e:
+                logger.error("Error in processing loop: %s", e)
+                await asyncio.sleep(CHAIN_SLEEP_TIME)
@@ -0,0 +1,148 @@
+"""
+Backfill of settlements in a historical block range, processed in parallel by several processes.
+
+The range is split into shards of --shard-size blocks, which are processed by a pool of worker
+processes, each with its own node and database connections. Completed shards are recorded in
+the backfill_shards table, such that an interrupted backfill continues with the missing shards
+when run again with the same arguments.
+
+Usage:
+python -m src.backfill --from-block 20000000 --to-block 20500000 --workers 8
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.daemon import get_processing_flags
+from src.helpers.blockchain_data import BlockchainData
+from src.helpers.config import (
+    FAST_RPC,
+    HEAD_TRACKING_MAX_RANGE,
+    NODE_URL,
+    create_db_connection,
+    initialize_connections,
+    logger,
+)
+from src.helpers.database import Database
+from src.helpers.fast_rpc import FastRPCClient
+from src.transaction_processor import TransactionProcessor
+
+DEFAULT_SHARD_SIZE = 10000
+# number of settlements whose results are bulk loaded into the database in one transaction
+BULK_WRITE_GROUP_SIZE = 1000
+
+# processor of the current worker process, created by init_worker()
+_processor: TransactionProcessor | None = None
+
+
+def split_range(
+    from_block: int, to_block: int, shard_size: int
+) -> list[tuple[int, int]]:
+    """Split the block range [from_block, to_block] into shards of at most shard_size blocks."""
+    return [
+        (start, min(start + shard_size - 1, to_block))
+        for start in range(from_block, to_block + 1, shard_size)
+    ]
+
+
+def create_processor(chain_name: str) -> TransactionProcessor:
+    """Create a processor which writes results of many settlements at once with COPY."""
+    web3, db_engine = initialize_connections()
+    fast_rpc = FastRPCClient(NODE_URL) if FAST_RPC and NODE_URL else None
+    processor = TransactionProcessor(
+        BlockchainData(web3, fast_rpc=fast_rpc),
+        Database(db_engine, chain_name),
+        chain_name,
+        *get_processing_flags(chain_name),
+    )
+    processor.bulk_writes = True
+    processor.db_write_group_size = BULK_WRITE_GROUP_SIZE
+    return processor
+
+
+def init_worker(chain_name: str) -> None:
+    """Create connections once per worker process, they can not be shared between processes."""
+    global _processor  # pylint: disable=global-statement
+    _processor = create_processor(chain_name)
+
+
+def process_shard(shard: tuple[int, int]) -> tuple[tuple[int, int], int]:
+    """
+    Process all settlements of a shard, in ranges of at most HEAD_TRACKING_MAX_RANGE blocks.
+    The shard is recorded as completed if no settlement failed.
+    Returns the shard and the number of failed settlements.
+    """
+    assert _processor is not None
+    from_block, to_block = shard
+    failed = 0
+    for start, end in split_range(from_block, to_block, HEAD_TRACKING_MAX_RANGE):
+        settlements = _processor.blockchain_data.fetch_tx_data(start, end)
+        failed += len(_processor.process_batch(settlements))
+    if failed == 0:
+        _processor.db.write_backfill_shard(from_block, to_block)
+    return shard, failed
+
+
+def backfill(
+    chain_name: str, from_block: int, to_block: int, workers: int, shard_size: int
+) -> None:
+    """Process all shards of the block range which are not completed yet."""
+    # only a database connection, the node connections of the workers are created after the
+    # fork, as the disk cache of the RPC responses can not be shared by processes
+    db_engine = create_db_connection("solver_slippage")
+    db = Database(db_engine, chain_name)
+    completed = db.get_completed_backfill_shards(from_block, to_block)
+    db_engine.dispose()
+    shards = [
+        shard
+        for shard in split_range(from_block, to_block, shard_size)
+        if shard not in completed
+    ]
+    logger.info(
+        "Backfill of blocks %d to %d: %d of %d shards remaining.",
+        from_block,
+        to_block,
+        len(shards),
+        len(shards) + len(completed),
+    )
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(chain_name,)
+    ) as executor:
+        futures = [executor.submit(process_shard, shard) for shard in shards]
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                (shard_from, shard_to), failed = future.result()
+            except Exception as err:
+                logger.error("Backfill shard failed: %s", err)
+                continue
+            if failed:
+                logger.warning(
+                    "Shard %d-%d: %d settlements failed, shard will be retried on the "
+                    "next run.",
+                    shard_from,
+                    shard_to,
+                    failed,
+                )
+            logger.info("Backfill progress: %d/%d shards", done, len(shards))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Backfill settlements of a block range."
+    )
+    parser.add_argument("--from-block", type=int, required=True)
+    parser.add_argument("--to-block", type=int, required=True)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE)
+    args = parser.parse_args()
+
+    chain_name = os.getenv("CHAIN_NAME")
+    if chain_name is None:
+        logger.error("CHAIN_NAME environment variable is not set.")
+        return
+    backfill(chain_name, args.from_block, args.to_block, args.workers, args.shard_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ from web3.types import TxReceipt, HexStr
 from eth_typing import ChecksumAddress
 from typing import Dict, Optional, Set
 from src.helpers.config import NODE_URL
+from src.helpers.http_provider import ThreadSafeHTTPProvider
+from src.helpers.rpc_disk_cache import add_disk_cache_middleware
 from src.constants import SETTLEMENT_CONTRACT_ADDRESS, NATIVE_ETH_TOKEN_ADDRESS
 from contracts.erc20_abi import erc20_abi
 
@@ -11,7 +13,7 @@ from contracts.erc20_abi import erc20_abi
 
 class BalanceOfImbalances:
     def __init__(self, NODE_URL: str):
-        self.web3 = Web3(Web3.HTTPProvider(NODE_URL))
+        self.web3 = add_disk_cache_middleware(Web3(ThreadSafeHTTPProvider(NODE_URL)))
 
     def get_token_balance(
         self,
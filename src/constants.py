@@ -17,12 +17,34 @@ SDAI_TOKEN_ADDRESS = Web3.to_checksum_address(
 INVALIDATED_ORDER_TOPIC = (
     "0x875b6cb035bbd4ac6500fabc6d1e4ca5bdc58a3e2b424ccb5c24cdbebeb009a9"
 )
+# topic of GPv2 event Settlement(address indexed solver)
+SETTLEMENT_TOPIC = "0x40338ce1a7c49204f0099533b1e9a7ee0a3d261f84974ab7af36105b8c4e9db4"
+# topic of GPv2 event Trade(address indexed owner, ...)
+TRADE_TOPIC = "0xa07a543ab8a018198e99ca0184c93fe9050a79400a0a723441f84de1d972cc17"
+
+# Initial and maximal number of blocks requested in a single eth_getLogs call. The range is
+# halved whenever the node rejects a request for returning too many results.
+LOGS_MAX_BLOCK_RANGE = 2000
+
+# Minimal number of settlements in a block for fetching all receipts of the block with a
+# single eth_getBlockReceipts call instead of fetching receipts of settlements individually
+BLOCK_RECEIPTS_MIN_SETTLEMENTS = 2
+
+# Multicall3, deployed at the same address on all supported chains
+MULTICALL3_ADDRESS = Web3.to_checksum_address(
+    "0xcA11bde05977b3631167028862bE2a173976CA11"
+)
+# selector of ERC20 decimals()
+DECIMALS_SELECTOR = "0x313ce567"
 
 NULL_ADDRESS = Web3.to_checksum_address("0x0000000000000000000000000000000000000000")
 NULL_ADDRESS_STRING = "0x0000000000000000000000000000000000000000"
 
 REQUEST_TIMEOUT = 5
 
+# Number of blocks behind the chain head after which blocks are considered final
+FINALIZATION_DEPTH = 67
+
 # Time limit, currently set to 1 full day, after which Coingecko Token List is re-fetched (in seconds)
 COINGECKO_TOKEN_LIST_RELOAD_TIME = 86400
 
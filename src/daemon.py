@@ -1,10 +1,66 @@
+import asyncio
 import os
-from src.helpers.config import initialize_connections, logger
+import signal
+import sys
+
+from web3 import AsyncWeb3
+
+from src.async_transaction_processor import AsyncTransactionProcessor
+from src.helpers.config import (
+    ASYNC_PROCESSING,
+    FAST_RPC,
+    NODE_URL,
+    PIPELINE_PROCESSING,
+    TRACE_MODE,
+    WRITE_BEHIND,
+    WRITE_BEHIND_MAX_DELAY_MS,
+    WRITE_BEHIND_MAX_ROWS,
+    initialize_connections,
+    logger,
+)
+from src.helpers.fast_rpc import FastRPCClient
+from src.helpers.rpc_cache import add_cache_middleware
+from src.pipeline_processor import PipelineProcessor
 from src.transaction_processor import TransactionProcessor
 from src.helpers.database import Database
 from src.helpers.blockchain_data import BlockchainData
 
 
+def get_processing_flags(chain_name: str) -> tuple[bool, bool, bool]:
+    """Return whether imbalances, fees and prices are processed on a chain."""
+    process_imbalances = True
+    process_fees = False
+    process_prices = True
+
+    if chain_name == "arbitrum_one":
+        process_imbalances = False
+        process_prices = False
+
+    if chain_name == "xdai":
+        process_prices = False
+
+    return process_imbalances, process_fees, process_prices
+
+
+def warn_unused_async_settings() -> None:
+    """Log settings which have no effect on requests of the async processor."""
+    if TRACE_MODE != "transaction":
+        logger.warning(
+            "TRACE_MODE=%s is not supported in async mode, settlements are traced one by one.",
+            TRACE_MODE,
+        )
+    if FAST_RPC:
+        logger.warning(
+            "FAST_RPC is only used to discover settlements in async mode, receipts and "
+            "traces are fetched with AsyncWeb3."
+        )
+    if os.getenv("RPC_DISK_CACHE_PATH"):
+        logger.warning(
+            "The on-disk RPC cache is not used for requests of AsyncWeb3 in async mode, "
+            "only the in-memory RPC cache."
+        )
+
+
 def main() -> None:
     # valid chain names: mainnet, xdai, arbitrum_one
     chain_name = os.getenv("CHAIN_NAME")
@@ -12,25 +68,54 @@ def main() -> None:
         logger.error("CHAIN_NAME environment variable is not set.")
         return
 
-    process_imbalances = True
-    process_fees = False
-    process_prices = True
-
     web3, db_engine = initialize_connections()
-    blockchain = BlockchainData(web3)
+    fast_rpc = FastRPCClient(NODE_URL) if FAST_RPC and NODE_URL else None
+    blockchain = BlockchainData(web3, fast_rpc=fast_rpc)
     db = Database(db_engine, chain_name)
 
-    if chain_name == "arbitrum_one":
-        process_imbalances = False
-        process_prices = False
+    process_imbalances, process_fees, process_prices = get_processing_flags(chain_name)
+    # exit on SIGTERM as on SIGINT, so that buffered results are written on shutdown
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    if chain_name == "xdai":
-        process_prices = False
+    if ASYNC_PROCESSING:
+        warn_unused_async_settings()
+        async_processor = AsyncTransactionProcessor(
+            blockchain,
+            db,
+            chain_name,
+            process_imbalances,
+            process_fees,
+            process_prices,
+            add_cache_middleware(AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(NODE_URL))),
+        )
+        if WRITE_BEHIND:
+            async_processor.start_write_buffer(
+                WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_MAX_DELAY_MS / 1000
+            )
+        start_block = async_processor.get_start_block()
+        asyncio.run(async_processor.process_async(start_block))
+        return
+
+    if PIPELINE_PROCESSING:
+        pipeline_processor = PipelineProcessor(
+            blockchain, db, chain_name, process_imbalances, process_fees, process_prices
+        )
+        if WRITE_BEHIND:
+            pipeline_processor.start_write_buffer(
+                WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_MAX_DELAY_MS / 1000
+            )
+        start_block = pipeline_processor.get_start_block()
+        pipeline_processor.process_pipeline(start_block)
+        return
 
     processor = TransactionProcessor(
         blockchain, db, chain_name, process_imbalances, process_fees, process_prices
     )
 
+    if WRITE_BEHIND:
+        processor.start_write_buffer(
+            WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_MAX_DELAY_MS / 1000
+        )
     start_block = processor.get_start_block()
     processor.process(start_block)
 
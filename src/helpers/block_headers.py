@@ -0,0 +1,86 @@
+"""
+Cache of block headers, used for all lookups of block timestamps.
+
+Headers of finalized blocks never change and are kept by block number. The finalized head is
+cached for a few seconds only, such that frequent lookups, e.g. one per token of a settlement,
+do not each request the chain head.
+"""
+
+import threading
+import time
+
+from web3 import Web3
+from web3.types import BlockData
+
+from src.constants import FINALIZATION_DEPTH
+from src.helpers.rpc_cache import LRUCache
+
+# maximal number of block headers kept in the cache
+BLOCK_HEADER_CACHE_SIZE = 10000
+# time in seconds for which the finalized head is reused
+FINALIZED_HEAD_TTL = 10
+
+
+class BlockHeaderCache:
+    """Class caches headers of finalized blocks and the finalized head."""
+
+    def __init__(
+        self,
+        max_size: int = BLOCK_HEADER_CACHE_SIZE,
+        head_ttl: float = FINALIZED_HEAD_TTL,
+    ):
+        self.headers = LRUCache(max_size)
+        self.head_ttl = head_ttl
+        self.lock = threading.Lock()
+        self.finalized_head: BlockData | None = None
+        self.finalized_head_updated_at = 0.0
+
+    def get_finalized_head(self, web3: Web3) -> BlockData:
+        """Return the header of the most recent finalized block, refreshed after head_ttl."""
+        with self.lock:
+            if (
+                self.finalized_head is None
+                or time.time() - self.finalized_head_updated_at > self.head_ttl
+            ):
+                block_number = web3.eth.block_number - FINALIZATION_DEPTH
+                self.finalized_head = web3.eth.get_block(block_number)
+                self.finalized_head_updated_at = time.time()
+                self.headers.put(("block", str(block_number)), self.finalized_head)
+            return self.finalized_head
+
+    def get_finalized_block_number(self, web3: Web3) -> int:
+        return self.get_finalized_head(web3)["number"]
+
+    def get_finalized_timestamp(self, web3: Web3) -> int:
+        return self.get_finalized_head(web3)["timestamp"]
+
+    def get_header(self, web3: Web3, block_number: int) -> BlockData:
+        """
+        Return the header of a block. Headers are only cached if the block is finalized
+        according to the cached finalized head.
+        """
+        key = ("block", str(block_number))
+        header = self.headers.get(key)
+        if header is None:
+            header = web3.eth.get_block(block_number)
+            if block_number <= self.get_finalized_block_number(web3):
+                self.headers.put(key, header)
+        return header
+
+    def store(self, web3: Web3, headers: dict[int, BlockData | Exception]) -> None:
+        """Store headers fetched elsewhere, e.g. in a batch request, if they are finalized."""
+        finalized_block_number = self.get_finalized_block_number(web3)
+        for block_number, header in headers.items():
+            if (
+                not isinstance(header, Exception)
+                and block_number <= finalized_block_number
+            ):
+                self.headers.put(("block", str(block_number)), header)
+
+    def get_timestamp(self, web3: Web3, block_number: int) -> int:
+        """Return the timestamp of a block."""
+        return self.get_header(web3, block_number)["timestamp"]
+
+
+# cache shared by BlockchainData and the price providers
+BLOCK_HEADERS = BlockHeaderCache()
@@ -1,40 +1,139 @@
+from dataclasses import dataclass
+from typing import Any, cast
+
 from hexbytes import HexBytes
 from web3 import Web3
-from web3.types import HexStr
+from web3.types import FilterParams, HexStr, LogReceipt, TxData, TxReceipt
 
 from contracts.erc20_abi import erc20_abi
+from src.helpers.block_headers import BLOCK_HEADERS
 from src.helpers.config import logger
-from src.constants import SETTLEMENT_CONTRACT_ADDRESS, INVALIDATED_ORDER_TOPIC
+from src.helpers.fast_rpc import FastRPCClient
+from src.helpers.rpc_batching import BatchRPCClient
+from src.constants import (
+    SETTLEMENT_CONTRACT_ADDRESS,
+    INVALIDATED_ORDER_TOPIC,
+    SETTLEMENT_TOPIC,
+    TRADE_TOPIC,
+    LOGS_MAX_BLOCK_RANGE,
+    FINALIZATION_DEPTH,
+    BLOCK_RECEIPTS_MIN_SETTLEMENTS,
+)
+
+# substrings of eth_getLogs error messages of nodes and providers, indicating that the block
+# range has too many results or is larger than allowed
+LOGS_RANGE_ERRORS = (
+    # geth, Infura
+    "query returned more than",
+    # Alchemy
+    "log response size exceeded",
+    # Erigon
+    "exceed maximum block range",
+    # reth
+    "query exceeds max block range",
+    "query exceeds max results",
+    # Besu
+    "requested range exceeds maximum range limit",
+    # QuickNode
+    "eth_getlogs is limited to",
+    # Ankr, Chainstack
+    "block range is too wide",
+    "block range too large",
+)
+
+
+def is_logs_range_error(err: Exception) -> bool:
+    """Check if an eth_getLogs error can be resolved by querying a smaller block range."""
+    message = str(err).lower()
+    return any(pattern in message for pattern in LOGS_RANGE_ERRORS)
+
+
+# substrings of node error messages indicating that an RPC method is not supported
+UNSUPPORTED_METHOD_ERRORS = (
+    "-32601",
+    "method not found",
+    "does not exist",
+    "not supported",
+    "not available",
+    "unsupported",
+)
+
+
+def is_unsupported_method_error(err: Exception) -> bool:
+    """Check if an error indicates that the node does not support the requested method."""
+    message = str(err).lower()
+    return any(pattern in message for pattern in UNSUPPORTED_METHOD_ERRORS)
+
+
+def decode_auction_id(call_data: HexBytes | str) -> int:
+    """The auction id is encoded in the last 8 bytes of the call data of a settlement."""
+    call_data_bytes = (
+        bytes(call_data)
+        if isinstance(call_data, bytes)
+        else bytes.fromhex(call_data[2:])
+    )
+    return int.from_bytes(call_data_bytes[-8:], byteorder="big")
+
+
+@dataclass
+class SettlementRecord:
+    """
+    Settlement transaction found during discovery. Fields are filled from the data fetched for
+    discovery; auction_id is None until the call data of the transaction is known.
+    """
+
+    tx_hash: str
+    block_number: int
+    tx_index: int | None = None
+    auction_id: int | None = None
+    solver: str | None = None
+    # 1 for successful transactions, reverted transactions are not reported
+    status: int = 1
+
+
+def solver_from_settlement_log(log: LogReceipt) -> str | None:
+    """The solver is the indexed argument of the Settlement event."""
+    if len(log["topics"]) < 2:
+        return None
+    return Web3.to_checksum_address(bytes(log["topics"][1][-20:]))
 
 
 class BlockchainData:
     """Class provides functions for fetching blockchain data."""
 
-    def __init__(self, web3: Web3):
+    def __init__(
+        self,
+        web3: Web3,
+        discovery_mode: str = "logs",
+        fast_rpc: FastRPCClient | None = None,
+    ):
+        """
+        discovery_mode determines how settlements are found: "logs" uses eth_getLogs on the
+        settlement contract, "blocks" scans all transactions of every block.
+        If fast_rpc is given, logs are fetched with it instead of web3.
+        """
+        if discovery_mode not in ("logs", "blocks"):
+            raise ValueError(f"Unknown discovery mode {discovery_mode}.")
         self.web3 = web3
+        self.discovery_mode = discovery_mode
+        self.logs_block_range = LOGS_MAX_BLOCK_RANGE
+        self.batch = BatchRPCClient(web3)
+        self.fast_rpc = fast_rpc
+        # None until the first eth_getBlockReceipts request shows if the node supports it
+        self.block_receipts_supported: bool | None = None
 
     def get_latest_block(self) -> int:
         """Returns finalized block number."""
-        return self.web3.eth.block_number - 67
+        return self.web3.eth.block_number - FINALIZATION_DEPTH
 
-    def fetch_tx_data(
-        self, start_block: int, end_block: int
-    ) -> list[tuple[str, int, int]]:
+    def fetch_tx_data(self, start_block: int, end_block: int) -> list[SettlementRecord]:
         """
-        Fetch transaction data beginning from start_block to end_block.
-        Returns (tx_hash, auction_id, block_number) as a tuple.
+        Fetch settlements beginning from start_block to end_block.
+        Settlements found via logs have no auction id yet. It is decoded when the settlement is
+        processed, from the transaction fetched together with the other chain data of the
+        settlement, see TransactionProcessor.set_auction_id().
         """
-        tx_data = []
-        tx_hashes_blocks = self.get_tx_hashes_blocks(start_block, end_block)
-
-        for tx_hash, block_number in tx_hashes_blocks:
-            try:
-                auction_id = self.get_auction_id(tx_hash)
-                tx_data.append((tx_hash, auction_id, block_number))
-            except Exception as e:
-                logger.error(f"Error fetching auction ID for {tx_hash}: {e}")
-
-        return tx_data
+        return self.get_settlements(start_block, end_block)
 
     def get_tx_hashes_blocks(
         self, start_block: int, end_block: int
@@ -43,43 +142,260 @@ class BlockchainData:
         Get all transaction hashes appended with corresponding block (tuple) transactions
         involving the settlement contract.
         """
-        tx_hashes_blocks = []
-        for block_number in range(start_block, end_block + 1):
-            block = self.web3.eth.get_block(block_number, full_transactions=True)
-            for tx in block.transactions:  # type: ignore[attr-defined]
-                if tx.to and tx.to.lower() == SETTLEMENT_CONTRACT_ADDRESS.lower():
-                    receipt = self.web3.eth.get_transaction_receipt(tx.hash)
-                    # ignore txs that trigger the OrderInvalidated event
-                    if any(
-                        log.topics[0].to_0x_hex() == INVALIDATED_ORDER_TOPIC
-                        for log in receipt.logs  # type: ignore[attr-defined]
-                        if log.topics  # type: ignore[attr-defined]
+        return [
+            (settlement.tx_hash, settlement.block_number)
+            for settlement in self.get_settlements(start_block, end_block)
+        ]
+
+    def get_settlements(
+        self, start_block: int, end_block: int
+    ) -> list[SettlementRecord]:
+        """Find settlements in the block range, using the configured discovery mode."""
+        if self.discovery_mode == "logs":
+            return self.get_settlements_from_logs(start_block, end_block)
+        return self.get_settlements_from_blocks(start_block, end_block)
+
+    def get_settlements_from_logs(
+        self, start_block: int, end_block: int
+    ) -> list[SettlementRecord]:
+        """
+        Find settlements via Settlement and Trade events emitted by the settlement contract.
+        Reverted transactions do not emit logs, so no receipts are required. Transactions
+        emitting an OrderInvalidated event are ignored. In contrast to scanning blocks, this also
+        finds settlements which are not called directly by the transaction.
+        The solver is taken from the Settlement event, the auction id is not known yet.
+        """
+        settlements: dict[str, SettlementRecord] = {}
+        invalidated: set[str] = set()
+        for log in self.get_settlement_logs(start_block, end_block):
+            if log.get("removed"):
+                continue
+            # logs of web3 and the fast RPC client both contain bytes
+            tx_hash = "0x" + log["transactionHash"].hex()
+            topic = "0x" + log["topics"][0].hex()
+            if topic == INVALIDATED_ORDER_TOPIC:
+                invalidated.add(tx_hash)
+                continue
+            settlement = settlements.setdefault(
+                tx_hash,
+                SettlementRecord(
+                    tx_hash, log["blockNumber"], log.get("transactionIndex")
+                ),
+            )
+            if topic == SETTLEMENT_TOPIC:
+                settlement.solver = solver_from_settlement_log(log)
+        return [
+            settlement
+            for tx_hash, settlement in settlements.items()
+            if tx_hash not in invalidated
+        ]
+
+    def get_settlement_logs(self, start_block: int, end_block: int) -> list[LogReceipt]:
+        """
+        Fetch logs of the settlement contract relevant for finding settlements.
+        The block range is split into chunks. The chunk size is halved if the node rejects a
+        request as too large, and grows back after successful requests.
+        """
+        logs: list[LogReceipt] = []
+        from_block = start_block
+        while from_block <= end_block:
+            to_block = min(from_block + self.logs_block_range - 1, end_block)
+            filter_params: FilterParams = {
+                "fromBlock": from_block,
+                "toBlock": to_block,
+                "address": SETTLEMENT_CONTRACT_ADDRESS,
+                "topics": [
+                    [
+                        HexStr(SETTLEMENT_TOPIC),
+                        HexStr(TRADE_TOPIC),
+                        HexStr(INVALIDATED_ORDER_TOPIC),
+                    ]
+                ],
+            }
+            try:
+                if self.fast_rpc is not None:
+                    logs += cast(
+                        list[LogReceipt], self.fast_rpc.get_logs(filter_params)
+                    )
+                else:
+                    logs += self.web3.eth.get_logs(filter_params)
+            except Exception as err:
+                if not is_logs_range_error(err) or to_block == from_block:
+                    raise
+                self.logs_block_range = max((to_block - from_block + 1) // 2, 1)
+                logger.info(
+                    "eth_getLogs range too large, reducing to %d blocks: %s",
+                    self.logs_block_range,
+                    err,
+                )
+                continue
+            from_block = to_block + 1
+            self.logs_block_range = min(self.logs_block_range * 2, LOGS_MAX_BLOCK_RANGE)
+        return sorted(logs, key=lambda log: (log["blockNumber"], log["logIndex"]))
+
+    def get_settlements_from_blocks(
+        self, start_block: int, end_block: int
+    ) -> list[SettlementRecord]:
+        """
+        Find settlements by scanning all transactions of each block for transactions sent to
+        the settlement contract. Auction ids are decoded from the fetched transactions and
+        solvers are taken from the Settlement event in the receipts.
+        """
+        settlements = []
+        for chunk_start in range(start_block, end_block + 1, self.batch.max_batch_size):
+            block_numbers = list(
+                range(
+                    chunk_start,
+                    min(chunk_start + self.batch.max_batch_size, end_block + 1),
+                )
+            )
+            settlement_txs: list[tuple[str, int]] = []
+            transactions: dict[str, TxData] = {}
+            for block_number, block in self.batch.get_blocks(
+                block_numbers, full_transactions=True
+            ).items():
+                if isinstance(block, Exception):
+                    raise block
+                for tx in cast(list[TxData], block["transactions"]):
+                    if (
+                        tx["to"]
+                        and tx["to"].lower() == SETTLEMENT_CONTRACT_ADDRESS.lower()
                     ):
-                        continue
-                    # status = 0 indicates a reverted tx, status = 1 is successful tx
-                    if receipt.status == 1:  # type: ignore[attr-defined]
-                        tx_hashes_blocks.append((tx.hash.to_0x_hex(), block_number))
-        return tx_hashes_blocks
+                        tx_hash = tx["hash"].to_0x_hex()
+                        settlement_txs.append((tx_hash, block_number))
+                        transactions[tx_hash] = tx
+
+            receipts = self.get_settlement_receipts(settlement_txs)
+            for tx_hash, block_number in settlement_txs:
+                receipt = receipts[tx_hash]
+                if isinstance(receipt, Exception):
+                    raise receipt
+                topics = {
+                    "0x" + log["topics"][0].hex(): log
+                    for log in receipt["logs"]
+                    if log["topics"]
+                }
+                # ignore txs that trigger the OrderInvalidated event
+                if INVALIDATED_ORDER_TOPIC in topics:
+                    continue
+                # status = 0 indicates a reverted tx, status = 1 is successful tx
+                if receipt["status"] != 1:
+                    continue
+                tx = transactions[tx_hash]
+                settlement_log = topics.get(SETTLEMENT_TOPIC)
+                settlements.append(
+                    SettlementRecord(
+                        tx_hash,
+                        block_number,
+                        tx["transactionIndex"],
+                        decode_auction_id(tx["input"]),
+                        solver_from_settlement_log(settlement_log)
+                        if settlement_log
+                        else tx["from"],
+                        receipt["status"],
+                    )
+                )
+        return settlements
+
+    def get_settlement_receipts(
+        self, tx_hashes_blocks: list[tuple[str, int]]
+    ) -> dict[str, TxReceipt | Exception]:
+        """
+        Fetch receipts of settlements given as (tx_hash, block_number).
+        Receipts of blocks with several settlements are fetched via eth_getBlockReceipts if the
+        node supports it, all other receipts via batched eth_getTransactionReceipt requests.
+        Fetched receipts are stored in the RPC cache of the web3 instance, or in the cache of
+        the fast RPC client if it is used, where RawTokenImbalances reads them.
+        """
+        tx_hashes_by_block: dict[int, list[str]] = {}
+        for tx_hash, block_number in tx_hashes_blocks:
+            tx_hashes_by_block.setdefault(block_number, []).append(tx_hash)
+
+        receipts: dict[str, TxReceipt | Exception] = {}
+        if self.block_receipts_supported is not False:
+            blocks = [
+                block_number
+                for block_number, tx_hashes in tx_hashes_by_block.items()
+                if len(tx_hashes) >= BLOCK_RECEIPTS_MIN_SETTLEMENTS
+            ]
+            receipts = self.get_receipts_from_blocks(blocks)
+
+        missing_tx_hashes = [
+            tx_hash
+            for tx_hash, _ in tx_hashes_blocks
+            if tx_hash not in receipts or isinstance(receipts[tx_hash], Exception)
+        ]
+        rpc: BatchRPCClient | FastRPCClient = self.fast_rpc or self.batch
+        receipts.update(
+            cast(
+                dict[str, TxReceipt | Exception],
+                rpc.get_transaction_receipts(missing_tx_hashes),
+            )
+        )
+        return {tx_hash: receipts[tx_hash] for tx_hash, _ in tx_hashes_blocks}
+
+    def get_receipts_from_blocks(
+        self, block_numbers: list[int]
+    ) -> dict[str, TxReceipt | Exception]:
+        """
+        Fetch all receipts of the given blocks via batched eth_getBlockReceipts requests.
+        If the first request fails because the method is not available, the node is marked as
+        not supporting it and an empty result is returned.
+        """
+        receipts: dict[str, TxReceipt | Exception] = {}
+        results: list[Any]
+        if self.fast_rpc is not None:
+            results = self.fast_rpc.get_block_receipts(block_numbers)
+        else:
+            results = self.batch.execute(
+                [
+                    (self.web3.eth.get_block_receipts, (block_number,))
+                    for block_number in block_numbers
+                ]
+            )
+        for block_number, block_receipts in zip(block_numbers, results):
+            if isinstance(block_receipts, Exception):
+                if (
+                    self.block_receipts_supported is None
+                    and is_unsupported_method_error(block_receipts)
+                ):
+                    logger.info(
+                        "eth_getBlockReceipts is not supported, fetching receipts "
+                        "individually: %s",
+                        block_receipts,
+                    )
+                    self.block_receipts_supported = False
+                    return {}
+                logger.warning(
+                    "Error fetching receipts of block %d: %s",
+                    block_number,
+                    block_receipts,
+                )
+                continue
+            self.block_receipts_supported = True
+            # receipts of web3 and the fast RPC client both contain bytes
+            for receipt in block_receipts:
+                receipts["0x" + receipt["transactionHash"].hex()] = receipt
+        return receipts
 
     def get_auction_id(self, tx_hash: str) -> int:
         """
         Method that finds an auction id given a transaction hash.
         """
         transaction = self.web3.eth.get_transaction(HexBytes(tx_hash))
-        call_data = transaction["input"]
-        # convert call_data to hexString if it's in hexBytes
-        call_data_bytes = bytes.fromhex(
-            call_data.hex()[2:] if isinstance(call_data, HexBytes) else call_data[2:]
-        )
-        # convert bytes to int
-        auction_id = int.from_bytes(call_data_bytes[-8:], byteorder="big")
-        return auction_id
+        return decode_auction_id(transaction["input"])
 
-    def get_transaction_timestamp(self, tx_hash: str) -> tuple[str, int]:
-        receipt = self.web3.eth.get_transaction_receipt(HexStr(tx_hash))
-        block_number = receipt["blockNumber"]
-        block = self.web3.eth.get_block(block_number)
-        timestamp = block["timestamp"]
+    def get_transaction_timestamp(
+        self, tx_hash: str, block_number: int | None = None
+    ) -> tuple[str, int]:
+        """
+        Return the timestamp of the block of a transaction. If the block number is not given,
+        it is taken from the receipt.
+        """
+        if block_number is None:
+            receipt = self.web3.eth.get_transaction_receipt(HexStr(tx_hash))
+            block_number = receipt["blockNumber"]
+        timestamp = BLOCK_HEADERS.get_timestamp(self.web3, block_number)
 
         return tx_hash, timestamp
 
@@ -1,7 +1,5 @@
 import os
 from typing import Tuple
-from sqlalchemy import text
-from sqlalchemy.exc import OperationalError
 from sqlalchemy import create_engine, Engine
 from dotenv import load_dotenv
 from web3 import Web3
@@ -40,6 +38,71 @@ def get_env_int(var_name: str) -> int:
 
 
 CHAIN_SLEEP_TIME = get_env_int("CHAIN_SLEEP_TIME")
+# how new blocks are detected: "poll" (adaptive to block time) or "subscribe" (newHeads)
+HEAD_TRACKING_MODE = os.getenv("HEAD_TRACKING_MODE", "poll")
+# websocket URL of the node, required for the newHeads subscription
+NODE_WS_URL = os.getenv("NODE_WS_URL")
+# maximal number of blocks processed in one iteration while catching up
+HEAD_TRACKING_MAX_RANGE = int(os.getenv("HEAD_TRACKING_MAX_RANGE", "1000"))
+# attempts per failed settlement before it is moved to the failed_transactions table, and
+# bounds of the delay in seconds between attempts, which doubles after every attempt
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "60"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "3600"))
+# number of settlements whose results are written to the database in one transaction
+DB_WRITE_GROUP_SIZE = int(os.getenv("DB_WRITE_GROUP_SIZE", "1"))
+# connection pool of the database engine: number of kept connections, additional connections
+# opened under load, and maximal age and wait time for a connection in seconds
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+# attempts of a database operation which fails with an OperationalError, e.g. a lost connection
+DB_MAX_ATTEMPTS = int(os.getenv("DB_MAX_ATTEMPTS", "3"))
+# number of executions of a statement on a connection after which psycopg prepares it on the
+# server, psycopg's default (5) if unset, so that only repeated statements are prepared. "none"
+# disables prepared statements, e.g. behind a pgbouncer in transaction pooling mode
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "")
+
+# buffer results of the daemon and write them once WRITE_BEHIND_MAX_ROWS rows are buffered or
+# WRITE_BEHIND_MAX_DELAY_MS milliseconds passed, delaying their visibility for fewer transactions
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "5000"))
+WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "2000"))
+
+# maximal number of calls sent in a single JSON-RPC batch request
+RPC_MAX_BATCH_SIZE = int(os.getenv("RPC_MAX_BATCH_SIZE", "50"))
+
+# how traces for native ETH imbalances are fetched: "transaction", "block" or "filter"
+TRACE_MODE = os.getenv("TRACE_MODE", "transaction")
+# skip traces of transactions without value and WETH withdrawals or deposits
+LAZY_TRACES = os.getenv("LAZY_TRACES", "false").lower() == "true"
+# fraction of skipped traces which are fetched anyway to verify that no ETH was transferred
+TRACE_VERIFICATION_RATE = float(os.getenv("TRACE_VERIFICATION_RATE", "0"))
+# fetch logs, receipts and traces with the lightweight client in fast_rpc instead of web3
+FAST_RPC = os.getenv("FAST_RPC", "false").lower() == "true"
+
+# process settlements concurrently with the AsyncTransactionProcessor
+ASYNC_PROCESSING = os.getenv("ASYNC_PROCESSING", "false").lower() == "true"
+# maximal number of settlements, node requests and price requests processed concurrently
+ASYNC_MAX_SETTLEMENTS = int(os.getenv("ASYNC_MAX_SETTLEMENTS", "10"))
+ASYNC_NODE_CONCURRENCY = int(os.getenv("ASYNC_NODE_CONCURRENCY", "20"))
+ASYNC_PRICE_CONCURRENCY = int(os.getenv("ASYNC_PRICE_CONCURRENCY", "4"))
+# process settlements in a pipeline of stages with their own worker threads
+PIPELINE_PROCESSING = os.getenv("PIPELINE_PROCESSING", "false").lower() == "true"
+# number of worker threads and maximal queue size per pipeline stage
+PIPELINE_STAGE_WORKERS = {
+    "fetch": int(os.getenv("PIPELINE_FETCH_WORKERS", "2")),
+    "compute": int(os.getenv("PIPELINE_COMPUTE_WORKERS", "4")),
+    "price": int(os.getenv("PIPELINE_PRICE_WORKERS", "4")),
+    "persist": 1,
+}
+PIPELINE_STAGE_QUEUE_SIZE = {
+    "fetch": int(os.getenv("PIPELINE_FETCH_QUEUE_SIZE", "10")),
+    "compute": int(os.getenv("PIPELINE_COMPUTE_QUEUE_SIZE", "100")),
+    "price": int(os.getenv("PIPELINE_PRICE_QUEUE_SIZE", "100")),
+    "persist": int(os.getenv("PIPELINE_PERSIST_QUEUE_SIZE", "100")),
+}
 
 
 def create_db_connection(db_type: str) -> Engine:
@@ -51,21 +114,24 @@ def create_db_connection(db_type: str) -> Engine:
     if not db_url:
         raise ValueError(f"{db_type} database URL not found in environment variables.")
 
-    return create_engine(f"postgresql+psycopg://{db_url}")
-
-
-def check_db_connection(engine: Engine, db_type: str) -> Engine:
-    """
-    Check if the database engine is still active. If not, create a new one.
-    """
-    try:
-        if engine:
-            with engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
-    except OperationalError:
-        # if engine is closed (failed query execution above), create new one
-        engine = create_db_connection(db_type)
-    return engine
+    connect_args: dict[str, int | None] = {}
+    if DB_PREPARE_THRESHOLD:
+        connect_args["prepare_threshold"] = (
+            None
+            if DB_PREPARE_THRESHOLD.lower() == "none"
+            else int(DB_PREPARE_THRESHOLD)
+        )
+    # connections are checked when taken from the pool, replacing stale ones, and are
+    # replaced after DB_POOL_RECYCLE seconds
+    return create_engine(
+        f"postgresql+psycopg://{db_url}",
+        pool_pre_ping=True,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        connect_args=connect_args,
+    )
 
 
 def initialize_connections() -> Tuple[Web3, Engine]:
@@ -1,15 +1,173 @@
+import math
+import time
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Callable, TypeVar, cast
 
-import psycopg.errors
-import sqlalchemy
+import psycopg
 from hexbytes import HexBytes
-from sqlalchemy import Table, MetaData, insert, text, update
-from sqlalchemy.engine import Engine
+from sqlalchemy import Table, MetaData, TextClause, column, table, text
+from sqlalchemy.dialects.postgresql import Insert, insert as pg_insert
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 
-from src.helpers.config import check_db_connection, logger
-from src.helpers.helper_functions import read_sql_file
+from src.helpers.blockchain_data import SettlementRecord
+from src.helpers.config import DB_MAX_ATTEMPTS, logger
+from src.helpers.sql_statements import SQL_STATEMENTS
 from src.constants import NULL_ADDRESS_STRING
 
+T = TypeVar("T")
+
+# delay in seconds before the first retry of a failed database operation, doubled afterwards
+DB_RETRY_DELAY = 0.5
+
+# Tables written by write_settlement_results(). Only names are needed for inserts, so the tables
+# are declared here instead of being reflected from the database.
+TRANSACTION_TIMESTAMP_TABLE = table(
+    "transaction_timestamp", column("tx_hash"), column("time")
+)
+TRANSACTION_TOKENS_TABLE = table(
+    "transaction_tokens", column("tx_hash"), column("token_address")
+)
+PRICES_TABLE = table(
+    "prices",
+    column("token_address"),
+    column("time"),
+    column("price"),
+    column("source"),
+)
+RAW_TOKEN_IMBALANCES_TABLE = table(
+    "raw_token_imbalances",
+    column("auction_id"),
+    column("chain_name"),
+    column("block_number"),
+    column("tx_hash"),
+    column("token_address"),
+    column("imbalance"),
+)
+SETTLEMENT_TABLES = {
+    table_clause.name: table_clause
+    for table_clause in [
+        TRANSACTION_TIMESTAMP_TABLE,
+        TRANSACTION_TOKENS_TABLE,
+        PRICES_TABLE,
+        RAW_TOKEN_IMBALANCES_TABLE,
+    ]
+}
+PRIMARY_KEYS = {
+    "transaction_timestamp": ("tx_hash",),
+    "transaction_tokens": ("tx_hash", "token_address"),
+    "prices": ("token_address", "time", "source"),
+    "raw_token_imbalances": ("tx_hash", "token_address"),
+}
+# upsert of the last block fully processed by a stage
+CHECKPOINT_QUERY = text(
+    "INSERT INTO processing_checkpoint (chain_name, stage, block_number) "
+    "VALUES (:chain_name, :stage, :block_number) "
+    "ON CONFLICT (chain_name, stage) DO UPDATE "
+    "SET block_number = EXCLUDED.block_number, updated_at = now();"
+)
+# columns updated if a row exists already, rows of other tables are skipped
+UPDATED_COLUMNS = {"prices": ("price",)}
+# prices are stored as numeric(78, 18), i.e. with at most 60 digits before the decimal point
+MAX_PRICE = 10**60
+
+
+def price_in_range(price: float) -> bool:
+    """Check if a price can be stored in the prices table."""
+    return math.isfinite(price) and abs(price) < MAX_PRICE
+
+
+def price_rows(prices: list[tuple[str, int, float, str]]) -> list[dict]:
+    """
+    Rows of the prices table. Prices which are out of range are skipped. Of several prices with
+    the same primary key the last one is kept, as a multi-row upsert can not update a row twice.
+    """
+    rows: dict[tuple[bytes, datetime, str], dict] = {}
+    for token_address, timestamp, price, source in prices:
+        if not price_in_range(price):
+            logger.info(
+                f"Value out of range for price data. token: {token_address}, "
+                f"time: {timestamp}, price: {price}, source: {source}"
+            )
+            continue
+        key = (
+            bytes.fromhex(token_address[2:]),
+            datetime.fromtimestamp(timestamp, tz=timezone.utc),
+            source,
+        )
+        rows[key] = {
+            "token_address": key[0],
+            "time": key[1],
+            "price": price,
+            "source": source,
+        }
+    return list(rows.values())
+
+
+def upsert_statement(table_name: str, rows: list[dict]) -> Insert:
+    """
+    Multi-row insert into one of the settlement tables. Rows which exist already are skipped,
+    or updated for tables with UPDATED_COLUMNS.
+    """
+    statement = pg_insert(SETTLEMENT_TABLES[table_name]).values(rows)
+    update_columns = UPDATED_COLUMNS.get(table_name, ())
+    if not update_columns:
+        return statement.on_conflict_do_nothing()
+    return statement.on_conflict_do_update(
+        index_elements=list(PRIMARY_KEYS[table_name]),
+        set_={name: statement.excluded[name] for name in update_columns},
+    )
+
+
+@lru_cache(maxsize=None)
+def reflect_table(engine: Engine, table_name: str) -> Table:
+    """Reflect a table from the database, once per engine for the life of the process."""
+    return Table(table_name, MetaData(), autoload_with=engine)
+
+
+def copy_and_merge(cursor: psycopg.Cursor, table_name: str, rows: list[dict]) -> None:
+    """
+    Copy rows into a temporary staging table and insert them into table_name, skipping or
+    updating rows which exist already. The staging table is dropped on commit.
+    """
+    columns = [column.name for column in SETTLEMENT_TABLES[table_name].columns]
+    column_list = ", ".join(columns)
+    primary_key = ", ".join(PRIMARY_KEYS[table_name])
+    staging_table = f"staging_{table_name}"
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {staging_table} (LIKE {table_name} INCLUDING DEFAULTS) "
+        "ON COMMIT DROP"
+    )
+    with cursor.copy(f"COPY {staging_table} ({column_list}) FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row([row[name] for name in columns])
+    update_columns = UPDATED_COLUMNS.get(table_name, ())
+    if update_columns:
+        on_conflict = "DO UPDATE SET " + ", ".join(
+            f"{name} = EXCLUDED.{name}" for name in update_columns
+        )
+    else:
+        on_conflict = "DO NOTHING"
+    cursor.execute(
+        f"INSERT INTO {table_name} ({column_list}) "
+        f"SELECT DISTINCT ON ({primary_key}) {column_list} FROM {staging_table} "
+        f"ON CONFLICT ({primary_key}) {on_conflict}"
+    )
+
+
+@dataclass
+class SettlementResult:
+    """All data computed for a settlement, ready to be written to the database."""
+
+    settlement: SettlementRecord
+    token_imbalances: dict[str, int]
+    transaction_timestamp: tuple[str, int]
+    transaction_tokens: list[tuple[str, str]]
+    prices: list[tuple[str, int, float, str]]
+
 
 class Database:
     """
@@ -17,32 +175,61 @@ class Database:
     using a database connection.
     """
 
-    def __init__(self, engine: Engine, chain_name: str):
+    def __init__(
+        self, engine: Engine, chain_name: str, max_attempts: int = DB_MAX_ATTEMPTS
+    ):
         self.engine = engine
         self.chain_name = chain_name
+        self.max_attempts = max_attempts
 
-    def execute_query(self, query: str, params: dict):
-        """Function executes a read-only query."""
-        self.engine = check_db_connection(self.engine, "solver_slippage")
-        with self.engine.connect() as connection:
+    def run(self, operation: Callable[[Connection], T]) -> T:
+        """
+        Run operation on a pooled connection in a single transaction. Connections are checked
+        by the pool before use; if the connection is lost during the operation anyway, the
+        operation is retried on a new connection up to max_attempts times.
+        """
+        attempt = 1
+        while True:
             try:
-                result = connection.execute(text(query), params)
-                return result
-            except Exception as e:
-                logger.error(f"Error executing query: {e}")
-                raise
+                with self.engine.begin() as connection:
+                    return operation(connection)
+            except OperationalError as e:
+                if attempt >= self.max_attempts:
+                    raise
+                logger.warning(
+                    f"Database operation failed (attempt {attempt}/{self.max_attempts}),"
+                    f" retrying: {e}"
+                )
+                time.sleep(DB_RETRY_DELAY * 2 ** (attempt - 1))
+                attempt += 1
 
-    def execute_and_commit(self, query: str, params: dict):
+    def pool_stats(self) -> dict[str, int]:
+        """Size of the connection pool and number of checked out and overflow connections."""
+        pool = cast(QueuePool, self.engine.pool)
+        return {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+
+    def execute_query(self, query: str | TextClause, params: dict):
+        """Function executes a read-only query."""
+        statement = text(query) if isinstance(query, str) else query
+        try:
+            return self.run(lambda connection: connection.execute(statement, params))
+        except Exception as e:
+            logger.error(f"Error executing query: {e}")
+            raise
+
+    def execute_and_commit(self, query: str | TextClause, params: dict):
         """Function writes to the table."""
-        self.engine = check_db_connection(self.engine, "solver_slippage")
-        with self.engine.connect() as connection:
-            try:
-                connection.execute(text(query), params)
-                connection.commit()
-            except Exception as e:
-                logger.info(f"Error executing and committing query: {e}")
-                connection.rollback()
-                raise
+        statement = text(query) if isinstance(query, str) else query
+        try:
+            self.run(lambda connection: connection.execute(statement, params))
+        except Exception as e:
+            logger.info(f"Error executing and committing query: {e}")
+            raise
 
     def write_token_imbalances(
         self,
@@ -56,7 +243,7 @@ class Database:
         tx_hash_bytes = bytes.fromhex(tx_hash[2:])
         token_address_bytes = bytes.fromhex(token_address[2:])
 
-        query = read_sql_file("src/sql/insert_raw_token_imbalances.sql")
+        query = SQL_STATEMENTS["insert_raw_token_imbalances"]
         self.execute_and_commit(
             query,
             {
@@ -81,7 +268,7 @@ class Database:
         tx_hash_bytes = bytes.fromhex(tx_hash[2:])
         token_address_bytes = bytes.fromhex(token_address[2:])
 
-        query = read_sql_file("src/sql/insert_price.sql")
+        query = SQL_STATEMENTS["insert_price"]
         self.execute_and_commit(
             query,
             {
@@ -111,7 +298,7 @@ class Database:
         order_uid_bytes = bytes.fromhex(order_uid[2:])
         null_address_bytes = bytes.fromhex(NULL_ADDRESS_STRING[2:])
 
-        query = read_sql_file("src/sql/insert_fee.sql")
+        query = SQL_STATEMENTS["insert_fee"]
         final_recipient = null_address_bytes
         if recipient != "":
             final_recipient = bytes.fromhex(recipient[2:])
@@ -137,7 +324,7 @@ class Database:
         """Writes the transaction timestamp to database."""
         query = (
             "INSERT INTO transaction_timestamp (tx_hash, time) "
-            "VALUES (:tx_hash, :time);"
+            "VALUES (:tx_hash, :time) ON CONFLICT DO NOTHING;"
         )
         self.execute_and_commit(
             query,
@@ -155,7 +342,7 @@ class Database:
         """Writes the transaction tokens to the database."""
         query = (
             "INSERT INTO transaction_tokens (tx_hash, token_address) "
-            "VALUES (:tx_hash, :token_address);"
+            "VALUES (:tx_hash, :token_address) ON CONFLICT DO NOTHING;"
         )
         for tx_hash, token_address in transaction_tokens:
             self.execute_and_commit(
@@ -167,62 +354,123 @@ class Database:
             )
 
     def write_prices_new(self, prices: list[tuple[str, int, float, str]]) -> None:
-        """Write prices to database."""
+        """
+        Write prices to database with a single multi-row upsert. Prices which are out of range
+        for the prices table are skipped, of duplicate prices the last one is written.
+        """
+        rows = price_rows(prices)
+        if not rows:
+            return
         try:
-            prices_table = Table("prices", MetaData(), autoload_with=self.engine)
-
-            with self.engine.connect() as conn:
-                with conn.begin():
-                    for token_address, time, price, source in prices:
-                        savepoint = conn.begin_nested()
-                        # First try to insert
-                        try:
-                            insert_stmt = insert(prices_table).values(
-                                token_address=bytes.fromhex(token_address[2:]),
-                                time=datetime.fromtimestamp(time, tz=timezone.utc),
-                                price=price,
-                                source=source,
-                            )
-                            conn.execute(insert_stmt)
-                        except (
-                            sqlalchemy.exc.IntegrityError
-                        ):  # update if insertion failed
-                            logger.info(
-                                f"Error while inserting price data. token: {token_address}, "
-                                f"time: {time}, price: {price}, source: {source}\n"
-                                "Updating price instead."
-                            )
-                            savepoint.rollback()
-                            update_stmt = (
-                                update(prices_table)
-                                .where(
-                                    prices_table.c.token_address
-                                    == bytes.fromhex(token_address[2:])
-                                )
-                                .where(
-                                    prices_table.c.time
-                                    == datetime.fromtimestamp(time, tz=timezone.utc)
-                                )
-                                .where(prices_table.c.source == source)
-                                .values(price=price)
-                            )
-                            res = conn.execute(update_stmt)
-                            if res.rowcount == 0:
-                                logger.error(
-                                    f"Update failed, no matching record found. token: "
-                                    f"{token_address}, time: {time}, price: {price},"
-                                    f"source: {source}\n"
-                                    "This indicates a faulty database state."
-                                )
-
-                        except psycopg.errors.NumericValueOutOfRange:
-                            logger.info(
-                                f"Value out of range for price data. token: {token_address}, "
-                                f"time: {time}, price: {price}, source: {source}"
-                            )
+            statement = upsert_statement("prices", rows)
+            self.run(lambda connection: connection.execute(statement))
         except Exception as e:
             logger.error(f"Error writing prices: {e}")
 
+    def settlement_rows(
+        self, results: list[SettlementResult], write_imbalances: bool = True
+    ) -> dict[str, list[dict]]:
+        """
+        Rows of settlement results per table. Prices which are out of range for the prices
+        table are skipped, duplicate prices are written once.
+        """
+        timestamps: list[dict] = []
+        tokens: list[dict] = []
+        imbalances: list[dict] = []
+        for result in results:
+            settlement = result.settlement
+            tx_hash, timestamp = result.transaction_timestamp
+            timestamps.append(
+                {
+                    "tx_hash": bytes.fromhex(tx_hash[2:]),
+                    "time": datetime.fromtimestamp(timestamp, tz=timezone.utc),
+                }
+            )
+            tokens += [
+                {
+                    "tx_hash": bytes.fromhex(tx_hash[2:]),
+                    "token_address": bytes.fromhex(token_address[2:]),
+                }
+                for tx_hash, token_address in result.transaction_tokens
+            ]
+            if write_imbalances:
+                imbalances += [
+                    {
+                        "auction_id": settlement.auction_id,
+                        "chain_name": self.chain_name,
+                        "block_number": settlement.block_number,
+                        "tx_hash": bytes.fromhex(settlement.tx_hash[2:]),
+                        "token_address": bytes.fromhex(token_address[2:]),
+                        "imbalance": imbalance,
+                    }
+                    for token_address, imbalance in result.token_imbalances.items()
+                    if imbalance != 0
+                ]
+        return {
+            "transaction_timestamp": timestamps,
+            "transaction_tokens": tokens,
+            "raw_token_imbalances": imbalances,
+            "prices": price_rows(
+                [price for result in results for price in result.prices]
+            ),
+        }
+
+    def write_settlement_results(
+        self,
+        results: list[SettlementResult],
+        write_imbalances: bool = True,
+        checkpoint: tuple[str, int] | None = None,
+    ) -> None:
+        """
+        Write timestamps, transaction tokens, prices and (if write_imbalances) non-zero
+        imbalances of settlements in a single transaction, with one multi-row insert per table.
+        Rows which exist already are skipped, existing prices are updated.
+        A checkpoint, given as stage and block number, is written in the same transaction.
+        """
+        statements = [
+            upsert_statement(table_name, rows)
+            for table_name, rows in self.settlement_rows(
+                results, write_imbalances
+            ).items()
+            if rows
+        ]
+
+        def write(connection: Connection) -> None:
+            for statement in statements:
+                connection.execute(statement)
+            if checkpoint is not None:
+                connection.execute(
+                    CHECKPOINT_QUERY, self.checkpoint_params(*checkpoint)
+                )
+
+        self.run(write)
+
+    def bulk_write_settlement_results(
+        self,
+        results: list[SettlementResult],
+        write_imbalances: bool = True,
+        checkpoint: tuple[str, int] | None = None,
+    ) -> None:
+        """
+        Write the same rows as write_settlement_results() for large numbers of settlements, e.g.
+        in backfills. Rows are streamed with COPY into temporary staging tables and merged into
+        the tables with INSERT ... ON CONFLICT, all in a single transaction, together with the
+        checkpoint if given.
+        """
+        rows_by_table = self.settlement_rows(results, write_imbalances)
+
+        def write(connection: Connection) -> None:
+            cursor = connection.connection.driver_connection.cursor()  # type: ignore[union-attr]
+            for table_name, rows in rows_by_table.items():
+                if rows:
+                    copy_and_merge(cursor, table_name, rows)
+            if checkpoint is not None:
+                connection.execute(
+                    CHECKPOINT_QUERY, self.checkpoint_params(*checkpoint)
+                )
+
+        self.run(write)
+
     def get_latest_transaction(self) -> str | None:
         """Get latest transaction hash.
         If no transaction is found, return None."""
@@ -235,6 +483,118 @@ class Database:
         latest_tx_hash = HexBytes(result[0]).to_0x_hex()
         return latest_tx_hash
 
+    def get_checkpoint(self, stage: str) -> int | None:
+        """Get the last block fully processed by a stage, or None if there is none."""
+        query = (
+            "SELECT block_number FROM processing_checkpoint "
+            "WHERE chain_name = :chain_name AND stage = :stage;"
+        )
+        result = self.execute_query(
+            query, {"chain_name": self.chain_name, "stage": stage}
+        ).fetchone()
+        return None if result is None else int(result[0])
+
+    def checkpoint_params(self, stage: str, block_number: int) -> dict:
+        return {
+            "chain_name": self.chain_name,
+            "stage": stage,
+            "block_number": block_number,
+        }
+
+    def write_checkpoint(self, stage: str, block_number: int) -> None:
+        """Set the last block fully processed by a stage."""
+        self.execute_and_commit(
+            CHECKPOINT_QUERY, self.checkpoint_params(stage, block_number)
+        )
+
+    def write_failed_transaction(
+        self, settlement: SettlementRecord, attempts: int, error: str
+    ) -> None:
+        """Store a settlement which failed repeatedly, or update it if it is stored already."""
+        query = (
+            "INSERT INTO failed_transactions "
+            "(chain_name, tx_hash, block_number, auction_id, attempts, last_error) "
+            "VALUES (:chain_name, :tx_hash, :block_number, :auction_id, :attempts, :error) "
+            "ON CONFLICT (chain_name, tx_hash) DO UPDATE SET "
+            "attempts = failed_transactions.attempts + EXCLUDED.attempts, "
+            "last_error = EXCLUDED.last_error, failed_at = now();"
+        )
+        self.execute_and_commit(
+            query,
+            {
+                "chain_name": self.chain_name,
+                "tx_hash": bytes.fromhex(settlement.tx_hash[2:]),
+                "block_number": settlement.block_number,
+                "auction_id": settlement.auction_id,
+                "attempts": attempts,
+                "error": error,
+            },
+        )
+
+    def get_failed_transactions(
+        self, limit: int | None = None
+    ) -> list[SettlementRecord]:
+        """Get settlements from the failed_transactions table, in block order."""
+        query = (
+            "SELECT tx_hash, block_number, auction_id FROM failed_transactions "
+            "WHERE chain_name = :chain_name ORDER BY block_number LIMIT :limit;"
+        )
+        result = self.execute_query(
+            query, {"chain_name": self.chain_name, "limit": limit}
+        ).fetchall()
+        return [
+            SettlementRecord(HexBytes(row[0]).to_0x_hex(), row[1], auction_id=row[2])
+            for row in result
+        ]
+
+    def delete_failed_transactions(self, tx_hashes: list[str]) -> None:
+        """Remove settlements from the failed_transactions table."""
+        query = (
+            "DELETE FROM failed_transactions "
+            "WHERE chain_name = :chain_name AND tx_hash = ANY(:tx_hashes);"
+        )
+        self.execute_and_commit(
+            query,
+            {
+                "chain_name": self.chain_name,
+                "tx_hashes": [bytes.fromhex(tx_hash[2:]) for tx_hash in tx_hashes],
+            },
+        )
+
+    def get_completed_backfill_shards(
+        self, from_block: int, to_block: int
+    ) -> set[tuple[int, int]]:
+        """Get (from_block, to_block) of completed backfill shards within a block range."""
+        query = (
+            "SELECT from_block, to_block FROM backfill_shards "
+            "WHERE chain_name = :chain_name "
+            "AND from_block >= :from_block AND to_block <= :to_block;"
+        )
+        result = self.execute_query(
+            query,
+            {
+                "chain_name": self.chain_name,
+                "from_block": from_block,
+                "to_block": to_block,
+            },
+        ).fetchall()
+        return {(row[0], row[1]) for row in result}
+
+    def write_backfill_shard(self, from_block: int, to_block: int) -> None:
+        """Mark a backfill shard as completed."""
+        query = (
+            "INSERT INTO backfill_shards (chain_name, from_block, to_block) "
+            "VALUES (:chain_name, :from_block, :to_block) ON CONFLICT DO NOTHING;"
+        )
+        self.execute_and_commit(
+            query,
+            {
+                "chain_name": self.chain_name,
+                "from_block": from_block,
+                "to_block": to_block,
+            },
+        )
+
     def get_tokens_without_decimals(self) -> list[str]:
         """Get tokens without decimals."""
         query = (
@@ -244,13 +604,16 @@ class Database:
         result = self.execute_query(query, {}).fetchall()
         return list({HexBytes(row[0]).to_0x_hex() for row in result})
 
-    def write_token_decimals(self, token_decimals: list[tuple[str, int]]) -> None:
-        self.engine = check_db_connection(self.engine, "solver_slippage")
+    def get_token_decimals(self) -> dict[str, int]:
+        """Get decimals of all tokens in the token_decimals table."""
+        query = "SELECT token_address, decimals FROM token_decimals;"
+        result = self.execute_query(query, {}).fetchall()
+        return {HexBytes(row[0]).to_0x_hex(): row[1] for row in result}
 
-        # Define the table without creating a model class
-        token_decimals_table = Table(
-            "token_decimals", MetaData(), autoload_with=self.engine
-        )
+    def write_token_decimals(self, token_decimals: list[tuple[str, int]]) -> None:
+        """Write decimals of tokens, skipping tokens which are stored already."""
+        # table metadata is reflected once and cached
+        token_decimals_table = reflect_table(self.engine, "token_decimals")
 
         # Prepare the data
         records = [
@@ -259,6 +622,8 @@ class Database:
         ]
 
         # Execute the bulk insert
-        with self.engine.connect() as conn:
-            conn.execute(token_decimals_table.insert(), records)
-            conn.commit()
+        self.run(
+            lambda connection: connection.execute(
+                pg_insert(token_decimals_table).on_conflict_do_nothing(), records
+            )
+        )
@@ -0,0 +1,166 @@
+"""
+Native ETH flows of a contract, aggregated per transaction from traces.
+
+Instead of requesting trace_transaction for every settlement, traces can be fetched for whole
+blocks (trace_block) or block ranges (trace_filter). Value transfers involving the contract are
+summed per transaction, so computing the native ETH imbalance is a single subtraction.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+from hexbytes import HexBytes
+from web3 import Web3
+
+from src.constants import SETTLEMENT_CONTRACT_ADDRESS
+from src.helpers.config import logger
+from src.helpers.rpc_batching import BatchRPCClient
+
+# number of traces requested per trace_filter call, further pages are requested with "after"
+TRACE_FILTER_PAGE_SIZE = 1000
+
+
+@dataclass
+class EthFlow:
+    """Native ETH transferred into and out of a contract within one transaction."""
+
+    inflow: int = 0
+    outflow: int = 0
+    # number of call frames with the contract as sender or recipient
+    actions: int = 0
+
+    @property
+    def imbalance(self) -> int:
+        return self.inflow - self.outflow
+
+
+def _address(value: Any) -> str:
+    """Lower case hex representation of an address, or empty string if missing."""
+    if isinstance(value, bytes):
+        return "0x" + value.hex()
+    return str(value or "").lower()
+
+
+def _value(value: Any) -> int:
+    """Convert trace values given as hex strings or integers."""
+    if isinstance(value, str):
+        return int(value, 16) if value.startswith("0x") else int(value)
+    return int(value or 0)
+
+
+def add_trace(flow: EthFlow, trace: Any, address: str) -> None:
+    """Add a single trace frame to flow, if it involves address (in lower case)."""
+    action = trace.get("action", {})
+    sender = _address(action.get("from"))
+    recipient = _address(action.get("to"))
+    if address not in (sender, recipient):
+        return
+    flow.actions += 1
+    value = _value(action.get("value", 0))
+    if recipient == address:
+        flow.inflow += value
+    if sender == address:
+        flow.outflow += value
+
+
+def eth_flow(
+    traces: Iterable[Any], address: str = SETTLEMENT_CONTRACT_ADDRESS
+) -> EthFlow:
+    """Aggregate the traces of a single transaction."""
+    flow = EthFlow()
+    normalized_address = address.lower()
+    for trace in traces:
+        add_trace(flow, trace, normalized_address)
+    return flow
+
+
+def eth_flows_by_transaction(
+    traces: Iterable[Any], address: str = SETTLEMENT_CONTRACT_ADDRESS
+) -> dict[str, EthFlow]:
+    """
+    Aggregate traces of several transactions, e.g. of a whole block, grouped by transaction
+    hash. Every transaction with a trace gets an entry, also if it does not involve address.
+    """
+    flows: dict[str, EthFlow] = {}
+    normalized_address = address.lower()
+    for trace in traces:
+        tx_hash = trace.get("transactionHash")
+        if tx_hash is None:
+            # block rewards are not part of a transaction
+            continue
+        flow = flows.setdefault(HexBytes(tx_hash).to_0x_hex(), EthFlow())
+        add_trace(flow, trace, normalized_address)
+    return flows
+
+
+class EthFlowTracer:
+    """Class fetches traces of blocks or block ranges and aggregates ETH flows of a contract."""
+
+    def __init__(
+        self,
+        web3: Web3,
+        address: str = SETTLEMENT_CONTRACT_ADDRESS,
+        page_size: int = TRACE_FILTER_PAGE_SIZE,
+    ):
+        self.web3 = web3
+        self.address = address
+        self.page_size = page_size
+        self.batch = BatchRPCClient(web3)
+
+    def from_blocks(self, block_numbers: list[int]) -> dict[str, EthFlow]:
+        """
+        Fetch traces of all blocks with batched trace_block requests. Blocks with failed requests
+        are skipped, such that their transactions are missing from the result.
+        """
+        flows: dict[str, EthFlow] = {}
+        results = self.batch.execute(
+            [
+                (self.web3.tracing.trace_block, (block_number,))  # type: ignore[attr-defined]
+                for block_number in block_numbers
+            ]
+        )
+        for block_number, traces in zip(block_numbers, results):
+            if isinstance(traces, Exception):
+                logger.warning(
+                    "Error fetching traces of block %d: %s", block_number, traces
+                )
+                continue
+            flows.update(eth_flows_by_transaction(traces, self.address))
+        return flows
+
+    def from_filter(self, from_block: int, to_block: int) -> dict[str, EthFlow]:
+        """
+        Fetch traces with the contract as sender or recipient in the block range via trace_filter.
+        Both directions are requested separately, as nodes differ in how they combine address
+        filters, and frames matching both are counted once. Results are requested in pages of
+        page_size traces, as nodes limit the size of a response.
+        Transactions without ETH flows of the contract are missing from the result.
+        """
+        frames: dict[tuple[str, tuple], Any] = {}
+        for direction in ("fromAddress", "toAddress"):
+            for trace in self.filter_traces(from_block, to_block, direction):
+                key = (
+                    HexBytes(trace["transactionHash"]).to_0x_hex(),
+                    tuple(trace.get("traceAddress", [])),
+                )
+                frames[key] = trace
+        return eth_flows_by_transaction(frames.values(), self.address)
+
+    def filter_traces(
+        self, from_block: int, to_block: int, direction: str
+    ) -> list[Any]:
+        """Fetch all pages of trace_filter results for the contract in one direction."""
+        traces: list[Any] = []
+        while True:
+            page = self.web3.tracing.trace_filter(  # type: ignore[attr-defined]
+                {
+                    "fromBlock": hex(from_block),
+                    "toBlock": hex(to_block),
+                    direction: [self.address],
+                    "after": len(traces),
+                    "count": self.page_size,
+                }
+            )
+            traces += page
+            if len(page) < self.page_size:
+                return traces
@@ -0,0 +1,283 @@
+"""
+Lightweight JSON-RPC client for the calls on the hot path of the pipeline.
+
+web3.py wraps every receipt, log and trace in AttributeDict and HexBytes objects via its
+middleware and formatter stack. This client sends requests over a pooled HTTP session, parses
+responses with orjson, and decodes only the fields used by BlockchainData and
+RawTokenImbalances. Decoded objects are dicts with the same keys as web3's results, such that
+they can be used in place of them:
+- hashes, topics and data are bytes,
+- addresses are lower case hex strings,
+- numbers are integers.
+The client is enabled by setting FAST_RPC=true.
+"""
+
+from typing import Any, Callable, Mapping, Sequence, TypedDict
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.constants import REQUEST_TIMEOUT
+from src.helpers.config import RPC_MAX_BATCH_SIZE, logger
+from src.helpers.rpc_cache import (
+    LRUCache,
+    involves_settlement_contract,
+    rpc_cache_size,
+)
+
+
+# number of connections kept open to the node
+FAST_RPC_POOL_SIZE = 10
+
+
+class RPCError(Exception):
+    """Error returned by the node for a single request."""
+
+    def __init__(self, error: dict):
+        super().__init__(f"{error.get('code')}: {error.get('message')}")
+        self.code = error.get("code")
+        self.message = error.get("message")
+
+
+Log = TypedDict(
+    "Log",
+    {
+        "address": str,
+        "topics": list[bytes],
+        "data": bytes,
+        "blockNumber": int,
+        "transactionHash": bytes,
+        "transactionIndex": int,
+        "logIndex": int,
+        "removed": bool,
+    },
+)
+Receipt = TypedDict(
+    "Receipt",
+    {
+        "transactionHash": bytes,
+        "blockNumber": int,
+        "transactionIndex": int,
+        "from": str,
+        "to": str | None,
+        "status": int,
+        "logs": list[Log],
+    },
+)
+Trace = TypedDict(
+    "Trace",
+    {
+        "action": dict[str, Any],
+        "transactionHash": bytes | None,
+        "blockNumber": int,
+        "traceAddress": list[int],
+        "type": str,
+    },
+)
+
+
+def _bytes(value: str) -> bytes:
+    return bytes.fromhex(value[2:])
+
+
+def _int(value: str | None) -> int:
+    return int(value, 16) if value else 0
+
+
+def decode_log(log: dict) -> Log:
+    return {
+        "address": log["address"].lower(),
+        "topics": [_bytes(topic) for topic in log["topics"]],
+        "data": _bytes(log["data"]),
+        "blockNumber": _int(log.get("blockNumber")),
+        "transactionHash": _bytes(log["transactionHash"]),
+        "transactionIndex": _int(log.get("transactionIndex")),
+        "logIndex": _int(log.get("logIndex")),
+        "removed": bool(log.get("removed", False)),
+    }
+
+
+def decode_receipt(receipt: dict) -> Receipt:
+    return {
+        "transactionHash": _bytes(receipt["transactionHash"]),
+        "blockNumber": _int(receipt["blockNumber"]),
+        "transactionIndex": _int(receipt["transactionIndex"]),
+        "from": receipt["from"].lower(),
+        "to": receipt["to"].lower() if receipt.get("to") else None,
+        "status": _int(receipt.get("status")),
+        "logs": [decode_log(log) for log in receipt["logs"]],
+    }
+
+
+def decode_trace(trace: dict) -> Trace:
+    action = dict(trace.get("action", {}))
+    for key in ("from", "to"):
+        if action.get(key):
+            action[key] = action[key].lower()
+    action["value"] = _int(action.get("value"))
+    tx_hash = trace.get("transactionHash")
+    return {
+        "action": action,
+        "transactionHash": _bytes(tx_hash) if tx_hash else None,
+        "blockNumber": trace.get("blockNumber") or 0,
+        "traceAddress": trace.get("traceAddress", []),
+        "type": trace.get("type", ""),
+    }
+
+
+class FastRPCClient:
+    """Class sends JSON-RPC requests to a node and decodes receipts, logs and traces."""
+
+    def __init__(
+        self,
+        url: str,
+        max_batch_size: int = RPC_MAX_BATCH_SIZE,
+        cache_size: int | None = None,
+    ):
+        self.url = url
+        self.max_batch_size = max_batch_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=FAST_RPC_POOL_SIZE, pool_maxsize=FAST_RPC_POOL_SIZE
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        # decoded receipts and traces of finalized transactions
+        self.cache = LRUCache(cache_size or rpc_cache_size())
+
+    def _post(self, payload: Any) -> Any:
+        response = self.session.post(
+            self.url, data=orjson.dumps(payload), timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    def request(self, method: str, params: list) -> Any:
+        """Send a single request and return its raw result."""
+        response = self._post(
+            {"jsonrpc": "2.0", "id": 0, "method": method, "params": params}
+        )
+        if "error" in response:
+            raise RPCError(response["error"])
+        return response["result"]
+
+    def batch_request(self, requests_info: Sequence[tuple[str, list]]) -> list[Any]:
+        """
+        Send requests as batch requests of at most max_batch_size requests.
+        Returns one entry per request, either the raw result or the exception raised for it.
+        """
+        results: list[Any] = []
+        for start in range(0, len(requests_info), self.max_batch_size):
+            chunk = requests_info[start : start + self.max_batch_size]
+            payload = [
+                {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+                for i, (method, params) in enumerate(chunk)
+            ]
+            try:
+                responses = self._post(payload)
+            except Exception as err:
+                logger.warning("Batch request of %d calls failed: %s", len(chunk), err)
+                results += [err] * len(chunk)
+                continue
+            # responses may arrive in any order
+            by_id = {response.get("id"): response for response in responses}
+            for i in range(len(chunk)):
+                response = by_id.get(i)
+                if response is None:
+                    results.append(RPCError({"message": "missing response"}))
+                elif "error" in response:
+                    results.append(RPCError(response["error"]))
+                else:
+                    results.append(response["result"])
+        return results
+
+    def _fetch_cached(
+        self,
+        method: str,
+        tx_hashes: Sequence[str],
+        decode: Callable[[Any], Any],
+    ) -> dict[str, Any]:
+        """Fetch results of method for all tx_hashes, using the cache for known ones."""
+        results: dict[str, Any] = {}
+        missing = []
+        for tx_hash in tx_hashes:
+            cached = self.cache.get((method, tx_hash.lower()))
+            if cached is None:
+                missing.append(tx_hash)
+            else:
+                results[tx_hash] = cached
+        fetched = self.batch_request([(method, [tx_hash]) for tx_hash in missing])
+        for tx_hash, result in zip(missing, fetched):
+            if result is None or result == []:
+                result = RPCError({"message": f"{method} returned no result"})
+            if not isinstance(result, Exception):
+                result = decode(result)
+                self.cache.put((method, tx_hash.lower()), result)
+            results[tx_hash] = result
+        return results
+
+    def get_transaction_receipts(
+        self, tx_hashes: Sequence[str]
+    ) -> dict[str, Receipt | Exception]:
+        """Fetch decoded receipts for all transaction hashes."""
+        return self._fetch_cached(
+            "eth_getTransactionReceipt", tx_hashes, decode_receipt
+        )
+
+    def get_block_receipts(
+        self, block_numbers: Sequence[int]
+    ) -> list[list[Receipt] | Exception]:
+        """
+        Fetch decoded receipts of whole blocks via eth_getBlockReceipts. Receipts involving the
+        settlement contract are cached for get_transaction_receipts(), other receipts of the
+        blocks are dropped.
+        """
+        results: list[list[Receipt] | Exception] = []
+        fetched = self.batch_request(
+            [("eth_getBlockReceipts", [hex(number)]) for number in block_numbers]
+        )
+        for result in fetched:
+            if result is None:
+                result = RPCError(
+                    {"message": "eth_getBlockReceipts returned no result"}
+                )
+            if not isinstance(result, Exception):
+                result = [decode_receipt(receipt) for receipt in result]
+                for receipt in result:
+                    if involves_settlement_contract(receipt):
+                        tx_hash = "0x" + receipt["transactionHash"].hex()
+                        self.cache.put(("eth_getTransactionReceipt", tx_hash), receipt)
+            results.append(result)
+        return results
+
+    def trace_transactions(
+        self, tx_hashes: Sequence[str]
+    ) -> dict[str, list[Trace] | Exception]:
+        """Fetch decoded traces (trace_transaction) for all transaction hashes."""
+        return self._fetch_cached(
+            "trace_transaction",
+            tx_hashes,
+            lambda traces: [decode_trace(trace) for trace in traces],
+        )
+
+    def get_transaction_receipt(self, tx_hash: str) -> Receipt:
+        result = self.get_transaction_receipts([tx_hash])[tx_hash]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def trace_transaction(self, tx_hash: str) -> list[Trace]:
+        result = self.trace_transactions([tx_hash])[tx_hash]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def get_logs(self, filter_params: Mapping[str, object]) -> list[Log]:
+        """Fetch decoded logs. Block numbers in filter_params may be given as integers."""
+        params = {
+            key: hex(value) if isinstance(value, int) else value
+            for key, value in filter_params.items()
+        }
+        return [decode_log(log) for log in self.request("eth_getLogs", [params])]
@@ -0,0 +1,147 @@
+"""
+Tracking of the chain head, used to hand out ranges of finalized blocks for processing.
+
+In "poll" mode, the head is requested only when all known finalized blocks are processed, and
+the next request is timed for when the next block is expected, based on the block time of the
+chain. While processing lags behind, ranges are handed out without waiting.
+In "subscribe" mode, new heads are received from a newHeads websocket subscription, running in
+a background thread. If no head arrives within a few block times, the head is polled instead.
+A failed subscription is renewed with exponential backoff.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Any
+
+from web3 import AsyncWeb3, Web3, WebSocketProvider
+
+from src.constants import FINALIZATION_DEPTH
+from src.helpers.config import logger
+
+HEAD_TRACKING_MODES = ("poll", "subscribe")
+# number of blocks used to estimate the block time of the chain
+BLOCK_TIME_SAMPLE_SIZE = 100
+# bounds of the time in seconds between two requests of the head
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 60.0
+# bounds of the time in seconds before a failed newHeads subscription is renewed
+MIN_RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 60.0
+
+
+def _int(value: Any) -> int:
+    """Block numbers and timestamps are integers in web3 results, hex strings in raw ones."""
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+class HeadTracker:
+    """Class hands out ranges of finalized blocks, waiting for new blocks when caught up."""
+
+    def __init__(
+        self,
+        web3: Web3,
+        mode: str = "poll",
+        ws_url: str | None = None,
+        max_range: int = 1000,
+    ):
+        if mode not in HEAD_TRACKING_MODES:
+            raise ValueError(
+                f"Invalid head tracking mode {mode}, must be one of {HEAD_TRACKING_MODES}."
+            )
+        if mode == "subscribe" and not ws_url:
+            raise ValueError("A websocket URL is required for subscribe mode.")
+        self.web3 = web3
+        self.mode = mode
+        self.ws_url = ws_url
+        self.max_range = max_range
+        self.block_time: float | None = None
+        # most recent head, with the time it was received or its timestamp
+        self.head = 0
+        self.head_timestamp = 0.0
+        self.new_head = threading.Event()
+        self.subscription: threading.Thread | None = None
+
+    @property
+    def finalized_block(self) -> int:
+        return self.head - FINALIZATION_DEPTH
+
+    def get_block_time(self) -> float:
+        """Average time between blocks, estimated once from recent blocks."""
+        if self.block_time is None:
+            latest = self.web3.eth.get_block("latest")
+            earlier = self.web3.eth.get_block(latest["number"] - BLOCK_TIME_SAMPLE_SIZE)
+            self.block_time = (
+                latest["timestamp"] - earlier["timestamp"]
+            ) / BLOCK_TIME_SAMPLE_SIZE
+            logger.info("Estimated block time: %.2f seconds", self.block_time)
+        return self.block_time
+
+    def update_head(self, number: int, timestamp: float) -> None:
+        if number > self.head:
+            self.head = number
+            self.head_timestamp = timestamp
+            self.new_head.set()
+
+    def poll_head(self) -> None:
+        latest = self.web3.eth.get_block("latest")
+        self.update_head(latest["number"], latest["timestamp"])
+
+    def poll_interval(self) -> float:
+        """Time until the next block is expected, based on the timestamp of the head."""
+        block_time = self.get_block_time()
+        expected = self.head_timestamp + block_time - time.time()
+        if expected <= 0:
+            # the next block is late, check again after a fraction of the block time
+            expected = block_time / 4
+        return min(max(expected, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+    def next_range(self, start_block: int) -> tuple[int, int]:
+        """
+        Return the next range of at most max_range finalized blocks starting at start_block.
+        Blocks until start_block is finalized.
+        """
+        if self.mode == "subscribe":
+            self.start_subscription()
+        while start_block > self.finalized_block:
+            if self.mode == "poll" or self.head == 0:
+                self.poll_head()
+                if start_block <= self.finalized_block:
+                    break
+                time.sleep(self.poll_interval())
+            else:
+                self.new_head.clear()
+                if not self.new_head.wait(timeout=4 * self.get_block_time()):
+                    logger.warning("No new head received, polling instead.")
+                    self.poll_head()
+        return start_block, min(self.finalized_block, start_block + self.max_range - 1)
+
+    def start_subscription(self) -> None:
+        if self.subscription is None or not self.subscription.is_alive():
+            self.subscription = threading.Thread(
+                target=lambda: asyncio.run(self.subscribe()),
+                name="head-tracker",
+                daemon=True,
+            )
+            self.subscription.start()
+
+    async def subscribe(self) -> None:
+        """
+        Receive new heads over a websocket subscription. If the connection fails or is closed,
+        the subscription is renewed after a delay, which doubles up to MAX_RECONNECT_DELAY and is
+        reset once a head is received.
+        """
+        delay = MIN_RECONNECT_DELAY
+        while True:
+            try:
+                async with AsyncWeb3(WebSocketProvider(self.ws_url)) as w3:
+                    await w3.eth.subscribe("newHeads")
+                    async for message in w3.socket.process_subscriptions():
+                        header = message["result"]
+                        self.update_head(_int(header["number"]), time.time())
+                        delay = MIN_RECONNECT_DELAY
+            except Exception as err:
+                logger.error("newHeads subscription failed: %s", err)
+            logger.info("Renewing newHeads subscription in %.0f seconds.", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
@@ -8,6 +8,10 @@ import logging
 from dotenv import load_dotenv
 from web3 import Web3
 from contracts.erc20_abi import erc20_abi
+from src.constants import FINALIZATION_DEPTH
+from src.helpers.http_provider import ThreadSafeHTTPProvider
+from src.helpers.rpc_cache import add_cache_middleware
+from src.helpers.rpc_disk_cache import add_disk_cache_middleware
 
 load_dotenv()
 NODE_URL = os.getenv("NODE_URL")
@@ -56,21 +60,18 @@ def get_logger(filename: str | None = None) -> logging.Logger:
 def get_web3_instance() -> Web3:
     """
     returns a Web3 instance for the given blockchain via chain name.
+    All instances share a cache for finalized chain data, which is additionally persisted on
+    disk if RPC_DISK_CACHE_PATH is set.
     """
-    return Web3(Web3.HTTPProvider(NODE_URL))
+    web3 = add_disk_cache_middleware(Web3(ThreadSafeHTTPProvider(NODE_URL)))
+    return add_cache_middleware(web3)
 
 
 def get_finalized_block_number(web3: Web3) -> int:
     """
     Get the number of the most recent finalized block.
     """
-    return web3.eth.block_number - 67
-
-
-def read_sql_file(file_path: str) -> str:
-    """This function reads a file (SQL) and returns its content as a string."""
-    with open(file_path, "r") as file:
-        return file.read()
+    return web3.eth.block_number - FINALIZATION_DEPTH
 
 
 def extract_params(price_params: dict, is_block: bool):
@@ -0,0 +1,29 @@
+"""
+HTTP provider which can be shared by threads that send batch requests.
+
+While requests are collected for web3's batch_requests(), the provider is marked as batching and
+every call made through it returns its request instead of sending it. With a provider shared by
+threads, e.g. the stages of the PipelineProcessor, calls of other threads would be added to the
+batch or receive responses of the batch. The batching state of this provider is kept per thread.
+"""
+
+import threading
+from typing import Any
+
+from web3 import HTTPProvider
+
+
+class ThreadSafeHTTPProvider(HTTPProvider):
+    """HTTP provider with a batching state per thread."""
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        self._batching = threading.local()
+        super().__init__(*args, **kwargs)
+
+    @property  # type: ignore[override]
+    def _is_batching(self) -> bool:
+        return getattr(self._batching, "active", False)
+
+    @_is_batching.setter
+    def _is_batching(self, value: bool) -> None:
+        self._batching.active = value
@@ -0,0 +1,116 @@
+"""
+Scheduling of retries of failed settlements.
+
+A settlement which fails is retried after an exponentially growing delay with random jitter.
+After max_attempts failed attempts it is written to the failed_transactions table, from where it
+can be replayed with python -m src.replay_failed.
+"""
+
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Collection
+
+from src.helpers.blockchain_data import SettlementRecord
+from src.helpers.config import logger
+from src.helpers.database import Database
+
+
+@dataclass
+class ScheduledRetry:
+    settlement: SettlementRecord
+    attempts: int
+    next_attempt_at: float
+
+
+class RetryScheduler:
+    """Class keeps track of failed settlements and when to retry them."""
+
+    def __init__(
+        self,
+        db: Database,
+        max_attempts: int,
+        base_delay: float,
+        max_delay: float,
+    ):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        # number of failed attempts of settlements which are currently being retried, both
+        # scheduled ones and ones returned by due() whose outcome is not recorded yet
+        self.attempts: dict[str, int] = {}
+        self.retried: dict[str, SettlementRecord] = {}
+        self.scheduled: dict[str, ScheduledRetry] = {}
+
+    def __len__(self) -> int:
+        return len(self.attempts)
+
+    def delay(self, attempts: int) -> float:
+        """Delay before the next attempt: exponential backoff with jitter of up to 50%."""
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def due(self) -> list[SettlementRecord]:
+        """Remove and return all settlements whose next attempt is due."""
+        now = time.time()
+        with self.lock:
+            due = [
+                tx_hash
+                for tx_hash, retry in self.scheduled.items()
+                if retry.next_attempt_at <= now
+            ]
+            return [self.scheduled.pop(tx_hash).settlement for tx_hash in due]
+
+    def min_block(self, exclude: Collection[str] = ()) -> int | None:
+        """
+        Smallest block number of settlements which are still being retried, including ones
+        which are due and being processed, except for the transaction hashes in exclude.
+        """
+        with self.lock:
+            blocks = [
+                settlement.block_number
+                for tx_hash, settlement in self.retried.items()
+                if tx_hash not in exclude
+            ]
+        return min(blocks, default=None)
+
+    def record(
+        self,
+        settlements: list[SettlementRecord],
+        failures: list[tuple[SettlementRecord, Exception]],
+    ) -> None:
+        """
+        Record the outcome of processing settlements. Failed settlements are scheduled for
+        another attempt or moved to the failed_transactions table.
+        """
+        failed = {settlement.tx_hash: error for settlement, error in failures}
+        for settlement in settlements:
+            if settlement.tx_hash in failed:
+                self.failed(settlement, failed[settlement.tx_hash])
+            else:
+                with self.lock:
+                    self.attempts.pop(settlement.tx_hash, None)
+                    self.retried.pop(settlement.tx_hash, None)
+
+    def failed(self, settlement: SettlementRecord, error: Exception) -> None:
+        with self.lock:
+            attempts = self.attempts.get(settlement.tx_hash, 0) + 1
+            if attempts < self.max_attempts:
+                self.attempts[settlement.tx_hash] = attempts
+                self.retried[settlement.tx_hash] = settlement
+                self.scheduled[settlement.tx_hash] = ScheduledRetry(
+                    settlement, attempts, time.time() + self.delay(attempts)
+                )
+                return
+            self.attempts.pop(settlement.tx_hash, None)
+            self.retried.pop(settlement.tx_hash, None)
+        logger.error(
+            "Transaction %s failed %d times, moving it to failed_transactions: %s",
+            settlement.tx_hash,
+            attempts,
+            error,
+        )
+        self.db.write_failed_transaction(settlement, attempts, str(error))
@@ -0,0 +1,122 @@
+"""
+Batching of JSON-RPC requests.
+
+Several requests are sent as a single JSON-RPC array request, which saves one round-trip to the
+node per request. In contrast to web3's own batch_requests(), an error of one request does not
+fail the whole batch: results are returned per request, with errors mapped to exceptions.
+"""
+
+from typing import Any, Callable, Sequence
+
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.types import BlockData, TxData, TxReceipt
+
+from src.helpers.config import RPC_MAX_BATCH_SIZE, logger
+
+# pylint: disable=protected-access
+
+
+class BatchRPCClient:
+    """
+    Class sends web3 method calls as JSON-RPC batch requests. If the Web3 instance is shared
+    by threads, its provider must keep the batching state per thread, see http_provider.
+    """
+
+    def __init__(self, web3: Web3, max_batch_size: int = RPC_MAX_BATCH_SIZE):
+        if max_batch_size < 1:
+            raise ValueError("Maximal batch size must be positive.")
+        self.web3 = web3
+        self.max_batch_size = max_batch_size
+
+    def execute(
+        self, calls: Sequence[tuple[Callable[..., Any], tuple]]
+    ) -> list[Any | Exception]:
+        """
+        Execute calls given as (web3 method, arguments), e.g.
+        (web3.eth.get_transaction_receipt, (tx_hash,)).
+        Returns one entry per call, either the formatted result or the exception raised for it.
+        """
+        results: list[Any | Exception] = []
+        for i in range(0, len(calls), self.max_batch_size):
+            results += self._execute_batch(calls[i : i + self.max_batch_size])
+        return results
+
+    def _execute_batch(
+        self, calls: Sequence[tuple[Callable[..., Any], tuple]]
+    ) -> list[Any | Exception]:
+        """Send a single batch request and map responses back to the calls."""
+        if not calls:
+            return []
+        try:
+            with self.web3.batch_requests():
+                # while batching, calling a method returns the request and its formatters
+                requests_info = [method(*args) for method, args in calls]
+            request_func = self.web3.provider.batch_request_func(  # type: ignore[attr-defined]
+                self.web3, self.web3.middleware_onion
+            )
+            responses = request_func([request for request, _ in requests_info])
+        except Exception as err:
+            logger.warning("Batch request of %d calls failed: %s", len(calls), err)
+            return [err] * len(calls)
+
+        results: list[Any | Exception] = []
+        for request_info, response in zip(requests_info, responses):
+            try:
+                results.append(
+                    self.web3.manager._format_batched_response(request_info, response)
+                )
+            except Exception as err:
+                results.append(err)
+        return results
+
+    def get_transaction_receipts(
+        self, tx_hashes: Sequence[str]
+    ) -> dict[str, TxReceipt | Exception]:
+        """Fetch receipts for all transaction hashes."""
+        results = self.execute(
+            [
+                (self.web3.eth.get_transaction_receipt, (HexBytes(tx_hash),))
+                for tx_hash in tx_hashes
+            ]
+        )
+        return dict(zip(tx_hashes, results))
+
+    def get_transactions(
+        self, tx_hashes: Sequence[str]
+    ) -> dict[str, TxData | Exception]:
+        """Fetch transactions for all transaction hashes."""
+        results = self.execute(
+            [
+                (self.web3.eth.get_transaction, (HexBytes(tx_hash),))
+                for tx_hash in tx_hashes
+            ]
+        )
+        return dict(zip(tx_hashes, results))
+
+    def get_blocks(
+        self, block_numbers: Sequence[int], full_transactions: bool = False
+    ) -> dict[int, BlockData | Exception]:
+        """Fetch blocks for all block numbers."""
+        results = self.execute(
+            [
+                (self.web3.eth.get_block, (block_number, full_transactions))
+                for block_number in block_numbers
+            ]
+        )
+        return dict(zip(block_numbers, results))
+
+    def trace_transactions(
+        self, tx_hashes: Sequence[str]
+    ) -> dict[str, list[dict] | Exception]:
+        """Fetch traces (trace_transaction) for all transaction hashes."""
+        results = self.execute(
+            [
+                (
+                    self.web3.tracing.trace_transaction,  # type: ignore[attr-defined]
+                    (HexBytes(tx_hash),),
+                )
+                for tx_hash in tx_hashes
+            ]
+        )
+        return dict(zip(tx_hashes, results))
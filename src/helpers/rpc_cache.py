@@ -0,0 +1,256 @@
+"""
+In-memory cache for RPC responses of finalized chain data.
+
+The cache is attached to Web3 instances as a middleware, so that all components using the same
+cache share fetched receipts, transactions, blocks and traces. This includes responses of batch
+requests.
+"""
+
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, TypeVar
+
+from web3 import AsyncWeb3, Web3
+from web3.middleware import Web3Middleware
+from web3.types import RPCEndpoint, RPCResponse
+
+from src.constants import SETTLEMENT_CONTRACT_ADDRESS
+
+AnyWeb3 = TypeVar("AnyWeb3", Web3, AsyncWeb3)
+
+# methods with responses which do not change once the data is part of a finalized block
+CACHEABLE_METHODS = {
+    "eth_getTransactionReceipt",
+    "eth_getTransactionByHash",
+    "eth_getBlockByNumber",
+    "trace_transaction",
+}
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with hit and miss counters per method."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple[str, str], Any] = OrderedDict()
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple[str, str]) -> Any | None:
+        """Return cached value for key (method, params), or None if not present."""
+        method = key[0]
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses[method] = self.misses.get(method, 0) + 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits[method] = self.hits.get(method, 0) + 1
+            return value
+
+    def put(self, key: tuple[str, str], value: Any) -> None:
+        """Store value, evicting the least recently used entry if the cache is full."""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries and reset counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Return total number of hits, misses and entries."""
+        with self.lock:
+            return {
+                "hits": sum(self.hits.values()),
+                "misses": sum(self.misses.values()),
+                "entries": len(self.entries),
+            }
+
+
+def rpc_cache_size() -> int:
+    """
+    Maximal number of responses kept in a cache. Read on use rather than on import, such that
+    values from .env apply, which is loaded after this module is imported.
+    """
+    return int(os.getenv("RPC_CACHE_SIZE", "10000"))
+
+
+_rpc_cache: LRUCache | None = None
+_rpc_cache_lock = threading.Lock()
+
+
+def get_rpc_cache() -> LRUCache:
+    """Cache shared by all Web3 instances created via get_web3_instance()."""
+    global _rpc_cache  # pylint: disable=global-statement
+    with _rpc_cache_lock:
+        if _rpc_cache is None:
+            _rpc_cache = LRUCache(rpc_cache_size())
+        return _rpc_cache
+
+
+def _normalize_param(param: Any) -> Any:
+    """Normalize parameters such that e.g. HexBytes and hex strings result in the same key."""
+    if isinstance(param, bytes):
+        return "0x" + param.hex()
+    if isinstance(param, str):
+        return param.lower()
+    if isinstance(param, int) and not isinstance(param, bool):
+        return hex(param)
+    return param
+
+
+def cache_key(method: str, params: Any) -> tuple[str, str] | None:
+    """
+    Compute cache key of a request, or None if the response of the request can not be cached.
+    Blocks are only cached if requested by number and without full transactions.
+    """
+    if method not in CACHEABLE_METHODS:
+        return None
+    normalized_params = [_normalize_param(param) for param in params]
+    if method == "eth_getBlockByNumber":
+        block_identifier, full_transactions = normalized_params
+        if full_transactions or not str(block_identifier).startswith("0x"):
+            return None
+    return method, json.dumps(normalized_params)
+
+
+def involves_settlement_contract(receipt: Any) -> bool:
+    """Check if a raw receipt belongs to a call to, or emits logs of, the settlement contract."""
+    settlement_contract = SETTLEMENT_CONTRACT_ADDRESS.lower()
+    return str(receipt.get("to")).lower() == settlement_contract or any(
+        str(log.get("address")).lower() == settlement_contract
+        for log in receipt.get("logs", [])
+    )
+
+
+def is_cacheable_response(response: RPCResponse) -> bool:
+    """Only successful, non-empty responses are cached."""
+    return "error" not in response and response.get("result") not in (None, [])
+
+
+class CachingMiddleware(Web3Middleware, ABC):
+    """
+    Base class for middlewares answering requests from a cache.
+    Subclasses implement lookup() and store(); responses of batch requests are handled per
+    request, and only requests missing from the cache are sent to the node. Single requests of
+    AsyncWeb3 instances are cached as well.
+    """
+
+    @abstractmethod
+    def lookup(self, method: RPCEndpoint, params: Any) -> RPCResponse | None:
+        """Return cached response for the request, or None."""
+        pass
+
+    @abstractmethod
+    def store(self, method: RPCEndpoint, params: Any, response: RPCResponse) -> None:
+        """Store the response of a request if it is cacheable."""
+        pass
+
+    def wrap_make_request(self, make_request: Callable) -> Callable:
+        def middleware(method: RPCEndpoint, params: Any) -> RPCResponse:
+            response = self.lookup(method, params)
+            if response is None:
+                response = make_request(method, params)
+                self.store(method, params, response)
+            return response
+
+        return middleware
+
+    async def async_wrap_make_request(self, make_request: Callable) -> Callable:
+        async def middleware(method: RPCEndpoint, params: Any) -> RPCResponse:
+            response = self.lookup(method, params)
+            if response is None:
+                response = await make_request(method, params)
+                self.store(method, params, response)
+            return response
+
+        return middleware
+
+    def wrap_make_batch_request(self, make_batch_request: Callable) -> Callable:
+        def middleware(
+            requests_info: list[tuple[RPCEndpoint, Any]]
+        ) -> list[RPCResponse]:
+            responses: list[RPCResponse | None] = [
+                self.lookup(method, params) for method, params in requests_info
+            ]
+            missing = [i for i, response in enumerate(responses) if response is None]
+            if missing:
+                fetched = make_batch_request([requests_info[i] for i in missing])
+                for i, response in zip(missing, fetched):
+                    responses[i] = response
+                    self.store(*requests_info[i], response)
+            return responses  # type: ignore[return-value]
+
+        return middleware
+
+
+class RPCCacheMiddleware(CachingMiddleware):
+    """Middleware answering requests for finalized chain data from an LRUCache."""
+
+    cache: LRUCache
+
+    def lookup(self, method: RPCEndpoint, params: Any) -> RPCResponse | None:
+        key = cache_key(method, params)
+        return self.cache.get(key) if key is not None else None
+
+    def store(self, method: RPCEndpoint, params: Any, response: RPCResponse) -> None:
+        if method == "eth_getBlockReceipts":
+            self.store_block_receipts(params, response)
+            return
+        key = cache_key(method, params)
+        if key is not None and is_cacheable_response(response):
+            self.cache.put(key, response)
+
+    def store_block_receipts(self, params: Any, response: RPCResponse) -> None:
+        """
+        Store receipts contained in an eth_getBlockReceipts response as responses to
+        eth_getTransactionReceipt. Only receipts involving the settlement contract are stored,
+        to not fill the cache with unrelated transactions.
+        """
+        if not is_cacheable_response(response):
+            return
+        if not str(_normalize_param(params[0])).startswith("0x"):
+            return
+        for receipt in response["result"]:
+            if involves_settlement_contract(receipt):
+                key = cache_key(
+                    RPCEndpoint("eth_getTransactionReceipt"),
+                    [receipt["transactionHash"]],
+                )
+                self.cache.put(
+                    key,  # type: ignore[arg-type]
+                    {"jsonrpc": "2.0", "id": response["id"], "result": receipt},
+                )
+
+
+def build_cache_middleware(cache: LRUCache) -> Callable[[Web3], RPCCacheMiddleware]:
+    """Build a middleware which uses the given cache instead of the shared one."""
+
+    def build(w3: Web3) -> RPCCacheMiddleware:
+        middleware = RPCCacheMiddleware(w3)
+        middleware.cache = cache
+        return middleware
+
+    return build
+
+
+def add_cache_middleware(web3: AnyWeb3, cache: LRUCache | None = None) -> AnyWeb3:
+    """
+    Attach a caching middleware to a Web3 or AsyncWeb3 instance, using the shared cache by
+    default.
+    """
+    web3.middleware_onion.add(
+        build_cache_middleware(cache or get_rpc_cache()),  # type: ignore[arg-type]
+        name="rpc_cache",
+    )
+    return web3
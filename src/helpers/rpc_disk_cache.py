@@ -0,0 +1,281 @@
+"""
+Persistent on-disk cache for RPC responses of finalized chain data.
+
+Responses concerning blocks at or below the finalized block never change. They are stored
+compressed in a local SQLite database, keyed by a hash of chain id, method and parameters, so
+that restarts, reprocessing and debugging sessions on the same block ranges do not hit the node
+again. Several chains can share a cache. The cache is enabled by setting RPC_DISK_CACHE_PATH.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable, cast
+
+from web3 import Web3
+from web3.types import RPCEndpoint, RPCResponse
+
+from src.constants import FINALIZATION_DEPTH
+from src.helpers.rpc_cache import CachingMiddleware, is_cacheable_response
+
+# minimal time in seconds between two requests for the chain head
+HEAD_REFRESH_TIME = 10
+
+# methods for which the block is determined from the parameters, with the position of the block
+BLOCK_PARAM_METHODS = {
+    "eth_getBlockByNumber": 0,
+    "eth_getBlockReceipts": 0,
+    "trace_block": 0,
+    "eth_call": 1,
+    "eth_getBalance": 1,
+    "eth_getCode": 1,
+    "eth_getStorageAt": 2,
+}
+# methods for which the block is determined from the result
+BLOCK_RESULT_METHODS = {
+    "eth_getTransactionReceipt",
+    "eth_getTransactionByHash",
+    "trace_transaction",
+}
+
+
+def _to_json(value: Any) -> Any:
+    """Convert parameters to a JSON serializable and normalized form."""
+    if isinstance(value, bytes):
+        return "0x" + value.hex()
+    if isinstance(value, str):
+        return value.lower()
+    if isinstance(value, int) and not isinstance(value, bool):
+        return hex(value)
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    return value
+
+
+def request_key(chain_id: int, method: str, params: Any) -> bytes:
+    """Content address of a request on a chain."""
+    payload = json.dumps([chain_id, method, _to_json(params)], sort_keys=True)
+    return hashlib.sha256(payload.encode()).digest()
+
+
+def _hex_to_block(value: Any) -> int | None:
+    """Parse a hex encoded block number, block tags like 'latest' return None."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.startswith("0x"):
+        return int(value, 16)
+    return None
+
+
+def request_block(method: str, params: Any) -> int | None:
+    """
+    Return the block a request refers to if it is determined by the parameters. Requests for
+    block tags like 'latest' return None.
+    """
+    if method in BLOCK_PARAM_METHODS:
+        position = BLOCK_PARAM_METHODS[method]
+        return _hex_to_block(params[position]) if len(params) > position else None
+    if method == "eth_getLogs":
+        if _hex_to_block(params[0].get("fromBlock")) is None:
+            return None
+        return _hex_to_block(params[0].get("toBlock"))
+    return None
+
+
+def result_block(response: RPCResponse) -> int | None:
+    """Return the block of a receipt, transaction or trace response."""
+    result = response["result"]
+    if isinstance(result, list):
+        result = result[0]
+    return _hex_to_block(result.get("blockNumber"))
+
+
+class DiskCache:
+    """
+    Content-addressed store of compressed responses in SQLite.
+    If the store grows beyond max_bytes, the oldest entries are removed.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL)"
+        )
+        self.connection.commit()
+        self.size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        # finalized block and time of its last update, per chain id
+        self.finalized_blocks: dict[int, int] = {}
+        self.heads_updated_at: dict[int, float] = {}
+
+    def get(self, key: bytes) -> Any | None:
+        """Return the stored result for key, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: bytes, result: Any) -> None:
+        """Store a result and enforce the size limit."""
+        value = zlib.compress(json.dumps(result).encode())
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO responses (key, value, size) VALUES (?, ?, ?)",
+                (key, value, len(value)),
+            )
+            self.size += len(value) * cursor.rowcount
+            if self.size > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _evict(self) -> None:
+        """Remove oldest entries until the store uses at most 90% of its limit."""
+        target = int(self.max_bytes * 0.9)
+        rows = self.connection.execute(
+            "SELECT rowid, size FROM responses ORDER BY rowid"
+        ).fetchall()
+        evicted = []
+        for rowid, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((rowid,))
+            self.size -= size
+        self.connection.executemany("DELETE FROM responses WHERE rowid = ?", evicted)
+
+    def stats(self) -> dict[str, int]:
+        """Return number of hits, misses and the size of the store in bytes."""
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size}
+
+
+# stores opened by process id and path, SQLite connections can not be used after a fork
+_disk_caches: dict[tuple[int, str], DiskCache] = {}
+
+
+def get_disk_cache(path: str, max_mb: int | None = None) -> DiskCache:
+    """
+    Open the store at path, or return it if it is already open. The size limit defaults to
+    RPC_DISK_CACHE_MAX_MB.
+    """
+    key = (os.getpid(), path)
+    if key not in _disk_caches:
+        if max_mb is None:
+            max_mb = int(os.getenv("RPC_DISK_CACHE_MAX_MB", "1024"))
+        _disk_caches[key] = DiskCache(path, max_mb * 1024 * 1024)
+    return _disk_caches[key]
+
+
+@dataclass
+class ChainInfo:
+    """Chain id of the node of a Web3 instance, requested on first use."""
+
+    chain_id: int | None = None
+
+
+class DiskCacheMiddleware(CachingMiddleware):
+    """Middleware answering requests for finalized chain data from a DiskCache."""
+
+    cache: DiskCache
+    chain: ChainInfo
+
+    def chain_id(self) -> int:
+        if self.chain.chain_id is None:
+            # the provider is called directly, bypassing all middlewares
+            response = cast(
+                RPCResponse,
+                self._w3.provider.make_request(RPCEndpoint("eth_chainId"), []),
+            )
+            self.chain.chain_id = int(response["result"], 16)
+        return self.chain.chain_id
+
+    def lookup(self, method: RPCEndpoint, params: Any) -> RPCResponse | None:
+        if method not in BLOCK_RESULT_METHODS and request_block(method, params) is None:
+            return None
+        result = self.cache.get(request_key(self.chain_id(), method, params))
+        if result is None:
+            return None
+        return {"jsonrpc": "2.0", "id": 0, "result": result}
+
+    def store(self, method: RPCEndpoint, params: Any, response: RPCResponse) -> None:
+        if not is_cacheable_response(response):
+            return
+        if method in BLOCK_RESULT_METHODS:
+            block = result_block(response)
+        else:
+            block = request_block(method, params)
+        if block is not None and block <= self.finalized_block(block):
+            self.cache.put(
+                request_key(self.chain_id(), method, params), response["result"]
+            )
+
+    def finalized_block(self, block: int) -> int:
+        """
+        Return the finalized block number of the chain. The chain head is only requested if
+        block is not known to be finalized yet, and at most every HEAD_REFRESH_TIME seconds.
+        """
+        cache = self.cache
+        chain_id = self.chain_id()
+        finalized_block = cache.finalized_blocks.get(chain_id, -1)
+        if block > finalized_block and (
+            time.time() - cache.heads_updated_at.get(chain_id, 0.0) > HEAD_REFRESH_TIME
+        ):
+            # the provider is called directly, bypassing all middlewares
+            response = cast(
+                RPCResponse,
+                self._w3.provider.make_request(RPCEndpoint("eth_blockNumber"), []),
+            )
+            finalized_block = int(response["result"], 16) - FINALIZATION_DEPTH
+            cache.finalized_blocks[chain_id] = finalized_block
+            cache.heads_updated_at[chain_id] = time.time()
+        return finalized_block
+
+
+def build_disk_cache_middleware(
+    cache: DiskCache,
+) -> Callable[[Web3], DiskCacheMiddleware]:
+    """Build a middleware which uses the given store, for the chain of one Web3 instance."""
+    chain = ChainInfo()
+
+    def build(w3: Web3) -> DiskCacheMiddleware:
+        middleware = DiskCacheMiddleware(w3)
+        middleware.cache = cache
+        middleware.chain = chain
+        return middleware
+
+    return build
+
+
+def add_disk_cache_middleware(web3: Web3, path: str | None = None) -> Web3:
+    """
+    Attach the on-disk cache at path to a Web3 instance, as innermost middleware such that
+    raw responses are stored. The path defaults to RPC_DISK_CACHE_PATH, which is read on use
+    such that values from .env apply. Does nothing if no path is configured.
+    """
+    if path is None:
+        path = os.getenv("RPC_DISK_CACHE_PATH", "")
+    if path:
+        web3.middleware_onion.inject(
+            build_disk_cache_middleware(get_disk_cache(path)),  # type: ignore[arg-type]
+            name="rpc_disk_cache",
+            layer=0,
+        )
+    return web3
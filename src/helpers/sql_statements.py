@@ -0,0 +1,43 @@
+"""
+Registry of the SQL statements in src/sql.
+
+All files are read and compiled into SQLAlchemy text clauses once, when the module is imported,
+so that writing rows does not read files. The directory is resolved relative to the package,
+independent of the working directory. Statements which are executed repeatedly are prepared on
+the server by psycopg, see DB_PREPARE_THRESHOLD in config, so that they are planned once per
+connection.
+"""
+
+from pathlib import Path
+
+from sqlalchemy import TextClause, text
+
+SQL_DIRECTORY = Path(__file__).resolve().parent.parent / "sql"
+# scripts which are run as a whole, e.g. with psql, and are not single statements
+SCRIPTS = {"schema.sql", "delete_entries_max_block.sql"}
+
+
+class StatementRegistry:
+    """
+    Class holds the compiled statements of all .sql files in a directory, except for scripts,
+    by file name.
+    """
+
+    def __init__(self, directory: Path = SQL_DIRECTORY):
+        self.statements: dict[str, TextClause] = {
+            path.stem: text(path.read_text())
+            for path in sorted(directory.glob("*.sql"))
+            if path.name not in SCRIPTS
+        }
+
+    def __getitem__(self, name: str) -> TextClause:
+        try:
+            return self.statements[name]
+        except KeyError:
+            raise KeyError(f"No SQL statement {name}.sql in the registry.") from None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.statements
+
+
+SQL_STATEMENTS = StatementRegistry()
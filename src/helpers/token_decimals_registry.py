@@ -0,0 +1,133 @@
+"""
+Process-wide registry of token decimals.
+
+The registry is preloaded with all decimals stored in the token_decimals table, so that known
+tokens are looked up in memory. Decimals of new tokens are fetched with a single Multicall3
+aggregate3 call per batch of tokens, where a token without a valid decimals() does not fail the
+other tokens. New decimals are kept until they are written to the database. Tokens are only
+marked as unresolvable if their call fails or reverts, transport errors are raised.
+"""
+
+import threading
+
+from eth_abi.exceptions import DecodingError
+from web3 import Web3
+from web3.exceptions import BadFunctionCallOutput, ContractLogicError
+
+from contracts.erc20_abi import erc20_abi
+from contracts.multicall3_abi import multicall3_abi
+from src.constants import DECIMALS_SELECTOR, MULTICALL3_ADDRESS
+
+# maximal number of decimals() calls aggregated in a single Multicall3 call
+MULTICALL_BATCH_SIZE = 200
+# errors of a call which reverts or has no valid return value, e.g. as there is no contract
+CALL_ERRORS = (BadFunctionCallOutput, ContractLogicError, DecodingError)
+
+
+def decode_decimals(success: bool, return_data: bytes) -> int | None:
+    """Decimals from the result of a decimals() call, None if the call failed or is invalid."""
+    if not success or len(return_data) < 32:
+        return None
+    decimals = int.from_bytes(return_data[:32], "big")
+    # decimals are a uint8
+    return decimals if decimals < 256 else None
+
+
+class TokenDecimalsRegistry:
+    """Class keeps decimals of tokens in memory and fetches missing ones in batches."""
+
+    def __init__(self, batch_size: int = MULTICALL_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        # decimals by lower case token address
+        self.decimals: dict[str, int] = {}
+        # tokens with decimals which are not stored in the database yet
+        self.unpersisted: set[str] = set()
+        # tokens without a valid decimals(), which are not requested again
+        self.unresolvable: set[str] = set()
+        self.loaded = False
+
+    def load(self, token_decimals: dict[str, int]) -> None:
+        """Add decimals which are stored in the database already."""
+        with self.lock:
+            for token_address, decimals in token_decimals.items():
+                self.decimals[token_address.lower()] = decimals
+            self.loaded = True
+
+    def get(self, web3: Web3, token_address: str) -> int | None:
+        """Decimals of a token, fetched from the chain if unknown. None if unresolvable."""
+        return self.resolve(web3, [token_address]).get(token_address.lower())
+
+    def resolve(self, web3: Web3, token_addresses: list[str]) -> dict[str, int]:
+        """
+        Return decimals of all tokens which have decimals, by lower case address. Unknown tokens
+        are fetched with Multicall3.
+        """
+        addresses = {token_address.lower() for token_address in token_addresses}
+        with self.lock:
+            missing = sorted(
+                addresses - self.decimals.keys() - self.unresolvable,
+            )
+        for start in range(0, len(missing), self.batch_size):
+            fetched = self.fetch(web3, missing[start : start + self.batch_size])
+            with self.lock:
+                for token_address, decimals in fetched.items():
+                    if decimals is None:
+                        self.unresolvable.add(token_address)
+                    elif token_address not in self.decimals:
+                        self.decimals[token_address] = decimals
+                        self.unpersisted.add(token_address)
+        with self.lock:
+            return {
+                token_address: self.decimals[token_address]
+                for token_address in addresses
+                if token_address in self.decimals
+            }
+
+    def fetch(self, web3: Web3, token_addresses: list[str]) -> dict[str, int | None]:
+        """
+        Fetch decimals with a single Multicall3 call. If the multicall reverts, e.g. as
+        Multicall3 is not deployed, decimals are fetched with one call per token.
+        """
+        multicall = web3.eth.contract(address=MULTICALL3_ADDRESS, abi=multicall3_abi)
+        calls = [
+            (Web3.to_checksum_address(token_address), True, DECIMALS_SELECTOR)
+            for token_address in token_addresses
+        ]
+        try:
+            results = multicall.functions.aggregate3(calls).call()
+        except CALL_ERRORS:
+            return {
+                token_address: self.fetch_single(web3, token_address)
+                for token_address in token_addresses
+            }
+        return {
+            token_address: decode_decimals(success, bytes(return_data))
+            for token_address, (success, return_data) in zip(token_addresses, results)
+        }
+
+    @staticmethod
+    def fetch_single(web3: Web3, token_address: str) -> int | None:
+        """Decimals of a token from a decimals() call, None if the call reverts."""
+        contract = web3.eth.contract(
+            address=Web3.to_checksum_address(token_address), abi=erc20_abi
+        )
+        try:
+            return contract.functions.decimals().call()
+        except CALL_ERRORS:
+            return None
+
+    def get_unpersisted(self) -> list[tuple[str, int]]:
+        """Decimals which are not stored in the database yet."""
+        with self.lock:
+            return [
+                (token_address, self.decimals[token_address])
+                for token_address in sorted(self.unpersisted)
+            ]
+
+    def mark_persisted(self, token_decimals: list[tuple[str, int]]) -> None:
+        with self.lock:
+            self.unpersisted -= {token_address for token_address, _ in token_decimals}
+
+
+TOKEN_DECIMALS = TokenDecimalsRegistry()
@@ -0,0 +1,159 @@
+"""
+Write-behind buffer for settlement results.
+
+Results are collected in memory and written in a single transaction once max_rows rows are
+buffered or max_delay seconds passed since the first buffered result. The processing checkpoint
+is held back until all results before it are flushed and written in the same transaction, so
+that no block is skipped after a restart. The buffer is flushed on shutdown.
+"""
+
+import atexit
+import threading
+import time
+from typing import Callable
+
+from src.helpers.config import logger
+from src.helpers.database import SettlementResult
+
+
+def result_rows(result: SettlementResult) -> int:
+    """Number of rows written for a settlement result, over all tables."""
+    return (
+        1
+        + len(result.transaction_tokens)
+        + len(result.prices)
+        + len(result.token_imbalances)
+    )
+
+
+class WriteBuffer:
+    """
+    Class buffers settlement results and writes them together with the checkpoint, if one is
+    set, with write() from a background thread, or from the thread adding results if the buffer
+    is full. Results of a failed write are passed to on_failure() together with the error, the
+    checkpoint is then written on its own with write_checkpoint().
+    """
+
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(
+        self,
+        write: Callable[[list[SettlementResult], int | None], None],
+        write_checkpoint: Callable[[int], None],
+        on_failure: Callable[[list[SettlementResult], Exception], None],
+        max_rows: int,
+        max_delay: float,
+    ):
+        self.write = write
+        self.write_checkpoint = write_checkpoint
+        self.on_failure = on_failure
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        # protects the buffered data, flush_lock keeps flushes in order
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.results: list[SettlementResult] = []
+        self.rows = 0
+        self.checkpoint: int | None = None
+        self.first_buffered_at: float | None = None
+        self.closed = False
+        self.flushes = 0
+        self.rows_written = 0
+        self.thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        """Start flushing in the background and flush the buffer on shutdown."""
+        self.thread = threading.Thread(
+            target=self.flush_periodically, name="write-buffer", daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(
+        self, results: list[SettlementResult], checkpoint: int | None = None
+    ) -> None:
+        """Buffer results and the checkpoint after them, flushing the buffer if it is full."""
+        with self.lock:
+            self.results += results
+            if checkpoint is not None:
+                self.checkpoint = checkpoint
+            self.rows += sum(result_rows(result) for result in results)
+            if self.first_buffered_at is None:
+                self.first_buffered_at = time.monotonic()
+            full = self.rows >= self.max_rows
+            self.lock.notify()
+        if full:
+            self.flush()
+
+    def set_checkpoint(self, block_number: int) -> None:
+        """Write block_number as checkpoint once all results buffered before are written."""
+        with self.lock:
+            self.checkpoint = block_number
+            if self.first_buffered_at is None:
+                self.first_buffered_at = time.monotonic()
+            self.lock.notify()
+
+    def flush(self) -> None:
+        """Write all buffered results and the checkpoint in one transaction."""
+        with self.flush_lock:
+            with self.lock:
+                results, rows, checkpoint = self.results, self.rows, self.checkpoint
+                self.results, self.rows, self.checkpoint = [], 0, None
+                self.first_buffered_at = None
+            if results:
+                try:
+                    self.write(results, checkpoint)
+                    self.flushes += 1
+                    self.rows_written += rows
+                    return
+                except Exception as err:
+                    logger.error(f"Error writing results of {len(results)} txs: {err}")
+                    self.on_failure(results, err)
+            if checkpoint is not None:
+                try:
+                    self.write_checkpoint(checkpoint)
+                except Exception:
+                    # keep the checkpoint for the next flush unless a later one was set
+                    with self.lock:
+                        if self.checkpoint is None:
+                            self.checkpoint = checkpoint
+                            self.first_buffered_at = time.monotonic()
+                    raise
+
+    def flush_periodically(self) -> None:
+        """Flush the buffer max_delay seconds after data was buffered, until closed."""
+        while True:
+            with self.lock:
+                while not self.closed and (
+                    self.first_buffered_at is None
+                    or time.monotonic() < self.first_buffered_at + self.max_delay
+                ):
+                    timeout = (
+                        None
+                        if self.first_buffered_at is None
+                        else self.first_buffered_at + self.max_delay - time.monotonic()
+                    )
+                    self.lock.wait(timeout)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception as err:
+                logger.error(f"Error flushing write buffer: {err}")
+
+    def close(self) -> None:
+        """Stop the background thread and write everything which is still buffered."""
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        self.flush()
+
+    def stats(self) -> dict[str, int]:
+        """Number of buffered rows, completed flushes and rows written."""
+        with self.lock:
+            buffered = self.rows
+        return {
+            "buffered_rows": buffered,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
@@ -3,10 +3,13 @@
 Steps for computing token imbalances:
 
 1. Get transaction receipt via tx hash -> get_transaction_receipt()
-2. Obtain the transaction trace and extract actions from trace to identify actions 
-   related to native ETH transfers -> get_transaction_trace() and extract_actions()
-3. Calculate ETH imbalance via actions by identifying transfers in 
-   and out of a contract address -> calculate_native_eth_imbalance()
+2. Obtain the native ETH flows of the contract, i.e. the sum of transfers in and out of the
+   contract address, from traces -> get_eth_flow(). Depending on the trace mode, traces are
+   fetched per transaction or in advance for whole blocks or block ranges -> prefetch()
+   In lazy trace mode, traces are only fetched if the transaction has a value or the receipt
+   contains WETH withdrawals or deposits, as native ETH can only move otherwise in rare
+   cases -> needs_trace()
+3. Calculate ETH imbalance as the difference of inflow and outflow
 4. Extract and categorize relevant events (such as ERC20 transfers, WETH withdrawals, 
    and sDAI transactions) from the transaction receipt. -> extract_events()
 5. Process each event by first decoding it to retrieve event details, i.e. to_address, from_address
@@ -15,17 +18,25 @@ Steps for computing token imbalances:
    adding the transfer value to existing inflow/outflow for the token addresses.
 7. Returning to calculate_imbalances(), which finds the imbalance for all token addresses using
    inflow-outflow.
-8. If actions are not None, it denotes an ETH transfer event, which involves reducing WETH 
-   withdrawal amount- > update_weth_imbalance(). The ETH imbalance is also calculated 
-   via -> update_native_eth_imbalance().
+8. If there are call frames involving the contract, it denotes an ETH transfer event, which
+   involves reducing WETH withdrawal amount- > update_weth_imbalance(). The ETH imbalance is also
+   calculated via -> update_native_eth_imbalance().
 9. update_sdai_imbalance() is called in each iteration and only completes if there is an SDAI 
    transfer involved which has special handling for its events.
 """
 
+import random
+from functools import lru_cache
+from typing import cast
+
 from web3 import Web3
-from web3.datastructures import AttributeDict
 from web3.types import HexStr, TxReceipt
 from src.helpers.config import CHAIN_RPC_ENDPOINTS, logger
+from src.helpers.eth_flows import EthFlow, EthFlowTracer, eth_flow
+from src.helpers.fast_rpc import FastRPCClient
+from src.helpers.http_provider import ThreadSafeHTTPProvider
+from src.helpers.rpc_batching import BatchRPCClient
+from src.helpers.rpc_disk_cache import add_disk_cache_middleware
 from src.constants import (
     SETTLEMENT_CONTRACT_ADDRESS,
     NATIVE_ETH_TOKEN_ADDRESS,
@@ -42,10 +53,45 @@ EVENT_TOPICS = {
     "WithdrawSDAI": "Withdraw(address,address,address,uint256,uint256)",
 }
 
+# events which are processed as ERC-20 transfers, used to find imbalances for most tokens
+TRANSFER_EVENTS = ("Transfer", "ERC20Transfer")
+
+
+def compute_event_topics() -> dict[bytes, str]:
+    """
+    Compute the table mapping topics of all relevant events to the kind of event.
+    Both transfer events are of kind "Transfer".
+    """
+    return {
+        bytes(Web3.keccak(text=text)): "Transfer" if name in TRANSFER_EVENTS else name
+        for name, text in EVENT_TOPICS.items()
+    }
 
-def compute_event_topics(web3: Web3) -> dict[str, str]:
-    """Compute the event topics for all relevant events."""
-    return {name: web3.keccak(text=text).hex() for name, text in EVENT_TOPICS.items()}
+
+# computed once per process, used for classifying logs in extract_events()
+EVENT_TOPIC_KINDS = compute_event_topics()
+
+
+def to_address_bytes(value: str | bytes) -> bytes:
+    """
+    Canonical 20 byte representation of an address given as hex string, as bytes or as
+    32 byte topic. Addresses are only checksummed when returning results.
+    """
+    if isinstance(value, bytes):
+        return bytes(value[-20:])
+    return bytes.fromhex(value[-40:])
+
+
+@lru_cache(maxsize=4096)
+def to_checksum_address(address: bytes) -> str:
+    """Checksum encoding of a 20 byte address, cached as the same tokens appear repeatedly."""
+    return Web3.to_checksum_address(address)
+
+
+SETTLEMENT_CONTRACT = to_address_bytes(SETTLEMENT_CONTRACT_ADDRESS)
+NATIVE_ETH_TOKEN = to_address_bytes(NATIVE_ETH_TOKEN_ADDRESS)
+WETH_TOKEN = to_address_bytes(WETH_TOKEN_ADDRESS)
+SDAI_TOKEN = to_address_bytes(SDAI_TOKEN_ADDRESS)
 
 
 def find_chain_with_tx(tx_hash: str) -> tuple[str, Web3]:
@@ -54,7 +100,7 @@ def find_chain_with_tx(tx_hash: str) -> tuple[str, Web3]:
     Returns the chain name and the web3 instance. Used for checking single tx hashes.
     """
     for chain_name, url in CHAIN_RPC_ENDPOINTS.items():
-        web3 = Web3(Web3.HTTPProvider(url))
+        web3 = add_disk_cache_middleware(Web3(ThreadSafeHTTPProvider(url)))
         if not web3.is_connected():
             logger.warning("Could not connect to %s.", chain_name)
             continue
@@ -67,30 +113,152 @@ def find_chain_with_tx(tx_hash: str) -> tuple[str, Web3]:
     raise ValueError(f"Transaction hash {tx_hash} not found on any chain.")
 
 
-def _to_int(value: str | int) -> int:
-    """Convert hex string or integer to integer."""
-    try:
-        return (
-            int(value, 16)
-            if isinstance(value, str) and value.startswith("0x")
-            else int(value)
-        )
-    except ValueError:
-        logger.error("Error converting value %s to integer.", value)
-
-
 class RawTokenImbalances:
     """Class for computing token imbalances."""
 
-    def __init__(self, web3: Web3, chain_name: str):
+    # pylint: disable=too-many-arguments
+
+    def __init__(
+        self,
+        web3: Web3,
+        chain_name: str,
+        trace_mode: str = "transaction",
+        lazy_traces: bool = False,
+        trace_verification_rate: float = 0.0,
+        fast_rpc: FastRPCClient | None = None,
+    ):
+        """
+        trace_mode determines how traces are fetched in prefetch(): "transaction" uses
+        trace_transaction per transaction, "block" uses trace_block for the blocks of the
+        transactions and "filter" uses trace_filter on the block range of the transactions.
+        With lazy_traces, traces are skipped for transactions which can not move native ETH
+        according to needs_trace(). A fraction trace_verification_rate of skipped transactions
+        is traced anyway to check that assumption.
+        If fast_rpc is given, receipts and transaction traces are fetched with it instead of
+        web3, bypassing web3's result formatters.
+        """
+        if trace_mode not in ("transaction", "block", "filter"):
+            raise ValueError(f"Unknown trace mode {trace_mode}.")
         self.web3 = web3
         self.chain_name = chain_name
+        self.trace_mode = trace_mode
+        self.lazy_traces = lazy_traces
+        self.trace_verification_rate = trace_verification_rate
+        self.trace_stats = {"skipped": 0, "verified": 0, "mismatches": 0}
+        self.batch = BatchRPCClient(web3)
+        self.fast_rpc = fast_rpc
+        # client for batched receipts and traces, both provide the same methods
+        self.rpc: BatchRPCClient | FastRPCClient = fast_rpc or self.batch
+        self.tracer = EthFlowTracer(web3, SETTLEMENT_CONTRACT_ADDRESS)
+        # ETH flows of prefetched transactions, removed once used by compute_imbalances()
+        self.eth_flows: dict[str, EthFlow] = {}
+
+    def prefetch(
+        self, tx_hashes: list[str], block_numbers: list[int] | None = None
+    ) -> None:
+        """
+        Fetch receipts and traces of several transactions using batch requests.
+        Receipts and per transaction traces are stored in the cache of the RPC client, ETH flows
+        from block traces in eth_flows. Both are used by compute_imbalances().
+        Transactions with failed requests are fetched individually later on.
+        block_numbers are the blocks of the transactions, needed for the block and filter modes.
+        """
+        receipts = self.rpc.get_transaction_receipts(tx_hashes)
+        if self.lazy_traces:
+            traced = self.select_traced_transactions(receipts)
+            block_numbers = [
+                block_number
+                for tx_hash, block_number in zip(tx_hashes, block_numbers or [])
+                if tx_hash in traced
+            ]
+            tx_hashes = [tx_hash for tx_hash in tx_hashes if tx_hash in traced]
+            if not tx_hashes:
+                return
+        if self.trace_mode == "transaction" or not block_numbers:
+            self.rpc.trace_transactions(tx_hashes)
+        elif self.trace_mode == "block":
+            flows = self.tracer.from_blocks(sorted(set(block_numbers)))
+            # blocks contain other transactions, only flows of settlements are kept
+            self.eth_flows.update(
+                {tx_hash: flows[tx_hash] for tx_hash in tx_hashes if tx_hash in flows}
+            )
+        else:
+            try:
+                flows = self.tracer.from_filter(min(block_numbers), max(block_numbers))
+            except Exception as err:
+                logger.warning("Error fetching traces via trace_filter: %s", err)
+                return
+            # transactions without traces in the result are traced individually later on,
+            # instead of assuming that they have no ETH flows
+            self.eth_flows.update(
+                {tx_hash: flows[tx_hash] for tx_hash in tx_hashes if tx_hash in flows}
+            )
+
+    def select_traced_transactions(
+        self, receipts: dict[str, TxReceipt | Exception]
+    ) -> set[str]:
+        """
+        Return the transactions which need a trace according to needs_trace(). Transactions
+        with failed receipt requests are included, as they are decided on later.
+        """
+        received = [
+            tx_hash
+            for tx_hash, receipt in receipts.items()
+            if not isinstance(receipt, Exception)
+        ]
+        transactions = self.batch.get_transactions(received)
+        traced = {tx_hash for tx_hash in receipts if tx_hash not in received}
+        for tx_hash in received:
+            transaction = transactions[tx_hash]
+            if isinstance(transaction, Exception) or self.needs_trace(
+                self.extract_events(receipts[tx_hash]),  # type: ignore[arg-type]
+                transaction["value"],
+            ):
+                traced.add(tx_hash)
+        return traced
+
+    def needs_trace(self, events: dict[str, list[dict]], value: int) -> bool:
+        """
+        Check if native ETH can be transferred in or out of the settlement contract. This is the
+        case if ETH is sent with the transaction or WETH is unwrapped or wrapped. Other ETH
+        transfers, e.g. directly from an AMM, are not detected.
+        """
+        return value > 0 or bool(events["WithdrawalWETH"] or events["DepositWETH"])
+
+    def get_lazy_eth_flow(
+        self, tx_hash: str, events: dict[str, list[dict]]
+    ) -> EthFlow | None:
+        """
+        Return the native ETH flows of the settlement contract, skipping the trace if
+        needs_trace() is false. Skipped transactions are sampled and traced anyway; if ETH was
+        transferred nevertheless, a warning is logged and the traced flows are used.
+        """
+        if tx_hash in self.eth_flows or self.needs_trace(
+            events, self.web3.eth.get_transaction(HexStr(tx_hash))["value"]
+        ):
+            return self.get_eth_flow(tx_hash)
+        self.trace_stats["skipped"] += 1
+        if random.random() >= self.trace_verification_rate:
+            return EthFlow()
+        self.trace_stats["verified"] += 1
+        flow = self.get_eth_flow(tx_hash)
+        if flow is not None and (flow.inflow or flow.outflow):
+            self.trace_stats["mismatches"] += 1
+            logger.warning(
+                "Skipping the trace of %s would have missed native ETH flows of %s.",
+                tx_hash,
+                flow,
+            )
+            return flow
+        return EthFlow()
 
     def get_transaction_receipt(self, tx_hash: str) -> TxReceipt | None:
         """
-        Get the transaction receipt from the provided web3 instance.
+        Get the transaction receipt from the provided web3 instance, or the fast RPC client.
         """
         try:
+            if self.fast_rpc is not None:
+                return cast(TxReceipt, self.fast_rpc.get_transaction_receipt(tx_hash))
             return self.web3.eth.get_transaction_receipt(tx_hash)
         except Exception as ex:
             logger.error("Error getting transaction receipt: %s", ex)
@@ -99,78 +267,49 @@ class RawTokenImbalances:
     def get_transaction_trace(self, tx_hash: str) -> list[dict] | None:
         """Function used for retreiving trace to identify native ETH transfers."""
         try:
+            if self.fast_rpc is not None:
+                return cast(list[dict], self.fast_rpc.trace_transaction(tx_hash))
             res = self.web3.tracing.trace_transaction(tx_hash)
             return res
         except Exception as err:
             logger.error("Error occurred while fetching transaction trace: %s", err)
             return None
 
-    def extract_actions(self, traces: list[AttributeDict], address: str) -> list[dict]:
-        """Identify transfer events in trace involving the specified contract."""
-        normalized_address = Web3.to_checksum_address(address)
-        actions = []
-        for trace in traces:
-            if isinstance(trace, AttributeDict):
-                action = trace.get("action", {})
-                if (
-                    Web3.to_checksum_address(action.get("from", ""))
-                    == normalized_address
-                    or Web3.to_checksum_address(action.get("to", ""))
-                    == normalized_address
-                ):
-                    actions.append(dict(action))
-        return actions
-
-    def calculate_native_eth_imbalance(self, actions: list[dict], address: str) -> int:
-        """Extract ETH imbalance from transfer actions."""
-        # inflow is the total value transferred to address param
-        inflow = sum(
-            _to_int(action["value"])
-            for action in actions
-            if Web3.to_checksum_address(action.get("to", "")) == address
-        )
-        # outflow is the total value transferred out of address param
-        outflow = sum(
-            _to_int(action["value"])
-            for action in actions
-            if Web3.to_checksum_address(action.get("from", "")) == address
-        )
-        return inflow - outflow
+    def get_eth_flow(self, tx_hash: str) -> EthFlow | None:
+        """
+        Return the native ETH flows of the settlement contract in a transaction. Prefetched
+        flows are used if available, otherwise the transaction trace is fetched.
+        """
+        flow = self.eth_flows.pop(tx_hash, None)
+        if flow is not None:
+            return flow
+        traces = self.get_transaction_trace(tx_hash)
+        if traces is None:
+            return None
+        return eth_flow(traces, SETTLEMENT_CONTRACT_ADDRESS)
 
     def extract_events(self, tx_receipt: dict) -> dict[str, list[dict]]:
-        """Extract relevant events from the transaction receipt."""
-        event_topics = compute_event_topics(self.web3)
-        # transfer_topics are filtered to find imbalances for most ERC-20 tokens
-        transfer_topics = {
-            k: v for k, v in event_topics.items() if k in ["Transfer", "ERC20Transfer"]
-        }
-        # other_topics is used to find imbalances for SDAI, ETH transactions
-        other_topics = {
-            k: v for k, v in event_topics.items() if k not in transfer_topics
-        }
-
+        """
+        Extract relevant events from the transaction receipt, grouped by kind of event.
+        Transfers of both transfer events are collected under "Transfer".
+        """
         events: dict[str, list[dict]] = {name: [] for name in EVENT_TOPICS}
         for log in tx_receipt["logs"]:
             if log["topics"]:
-                log_topic = log["topics"][0].hex()
-                if log_topic in transfer_topics.values():
-                    events["Transfer"].append(log)
-                else:
-                    for event_name, topic in other_topics.items():
-                        if log_topic == topic:
-                            events[event_name].append(log)
-                            break
+                kind = EVENT_TOPIC_KINDS.get(log["topics"][0])
+                if kind is not None:
+                    events[kind].append(log)
         return events
 
-    def decode_event(self, event: dict) -> tuple[str | None, str | None, int | None]:
+    def decode_event(
+        self, event: dict
+    ) -> tuple[bytes | None, bytes | None, int | None]:
         """
         Decode transfer and withdrawal events.
-        Returns from_address, to_address (for transfer), and value.
+        Returns from_address, to_address (for transfer) as 20 bytes, and value.
         """
         try:
-            from_address = Web3.to_checksum_address(
-                "0x" + event["topics"][1].hex()[-40:]
-            )
+            from_address = to_address_bytes(event["topics"][1])
             value_hex = event["data"]
 
             if isinstance(value_hex, bytes):
@@ -179,9 +318,7 @@ class RawTokenImbalances:
                 value = int(value_hex, 16)
 
             if len(event["topics"]) > 2:  # Transfer event
-                to_address = Web3.to_checksum_address(
-                    "0x" + event["topics"][2].hex()[-40:]
-                )
+                to_address = to_address_bytes(event["topics"][2])
                 return from_address, to_address, value
             else:  # Withdrawal or Deposit event for our purpose
                 return from_address, None, value
@@ -192,27 +329,28 @@ class RawTokenImbalances:
     def process_event(
         self,
         event: dict,
-        inflows: dict[str, int],
-        outflows: dict[str, int],
-        address: str,
+        inflows: dict[bytes, int],
+        outflows: dict[bytes, int],
+        address: bytes,
     ) -> None:
         """Process a single event to update inflows and outflows."""
         from_address, to_address, value = self.decode_event(event)
         if from_address is None or to_address is None:
             return
+        token_address = to_address_bytes(event["address"])
         if to_address == from_address == address:
             # adds a positive amount of sell token entering the contract (fee withdrawal txs)
-            inflows[event["address"]] = inflows.get(event["address"], 0) + value
+            inflows[token_address] = inflows.get(token_address, 0) + value
             return
         if to_address == address:
-            inflows[event["address"]] = inflows.get(event["address"], 0) + value
+            inflows[token_address] = inflows.get(token_address, 0) + value
         if from_address == address:
-            outflows[event["address"]] = outflows.get(event["address"], 0) + value
+            outflows[token_address] = outflows.get(token_address, 0) + value
 
     def calculate_imbalances(
-        self, events: dict[str, list[dict]], address: str
-    ) -> dict[str, int]:
-        """Calculate token imbalances from events."""
+        self, events: dict[str, list[dict]], address: bytes
+    ) -> dict[bytes, int]:
+        """Calculate token imbalances from events, keyed by 20 byte token addresses."""
         inflows, outflows = {}, {}  # type: (dict, dict)
         for event in events["Transfer"]:
             self.process_event(event, inflows, outflows, address)
@@ -227,26 +365,24 @@ class RawTokenImbalances:
     def update_weth_imbalance(
         self,
         events: dict[str, list[dict]],
-        imbalances: dict[str, int],
-        address: str,
+        imbalances: dict[bytes, int],
+        address: bytes,
     ) -> None:
         """Update the WETH imbalance in imbalances."""
-        weth_imbalance = imbalances.get(WETH_TOKEN_ADDRESS, 0)
-        for event in events["WithdrawalWETH"] + events["DepositWETH"]:
-            from_address, _, value = self.decode_event(event)
-            if from_address == address:
-                if event in events["WithdrawalWETH"]:
-                    weth_imbalance -= value
-                elif event in events["DepositWETH"]:
-                    weth_imbalance += value
-        imbalances[WETH_TOKEN_ADDRESS] = weth_imbalance
+        weth_imbalance = imbalances.get(WETH_TOKEN, 0)
+        for kind, sign in (("WithdrawalWETH", -1), ("DepositWETH", 1)):
+            for event in events[kind]:
+                from_address, _, value = self.decode_event(event)
+                if from_address == address:
+                    weth_imbalance += sign * value
+        imbalances[WETH_TOKEN] = weth_imbalance
 
     def update_native_eth_imbalance(
-        self, imbalances: dict[str, int], native_eth_imbalance: int | None
+        self, imbalances: dict[bytes, int], native_eth_imbalance: int | None
     ) -> None:
         """Update the native ETH imbalance in imbalances."""
         if native_eth_imbalance is not None:
-            imbalances[NATIVE_ETH_TOKEN_ADDRESS] = native_eth_imbalance
+            imbalances[NATIVE_ETH_TOKEN] = native_eth_imbalance
 
     def decode_sdai_event(self, event: dict) -> int | None:
         """Decode sDAI event."""
@@ -263,70 +399,71 @@ class RawTokenImbalances:
             return None
 
     def process_sdai_event(
-        self, event: dict, imbalances: dict[str, int], is_deposit: bool
+        self, event: dict, imbalances: dict[bytes, int], is_deposit: bool
     ) -> None:
         """Process an sDAI deposit or withdrawal event to update imbalances."""
         decoded_event_value = self.decode_sdai_event(event)
         if decoded_event_value is None:
             return
         if is_deposit:
-            imbalances[SDAI_TOKEN_ADDRESS] = (
-                imbalances.get(SDAI_TOKEN_ADDRESS, 0) + decoded_event_value
-            )
+            imbalances[SDAI_TOKEN] = imbalances.get(SDAI_TOKEN, 0) + decoded_event_value
         else:
-            imbalances[SDAI_TOKEN_ADDRESS] = (
-                imbalances.get(SDAI_TOKEN_ADDRESS, 0) - decoded_event_value
-            )
+            imbalances[SDAI_TOKEN] = imbalances.get(SDAI_TOKEN, 0) - decoded_event_value
 
     def update_sdai_imbalance(
-        self, events: dict[str, list[dict]], imbalances: dict[str, int]
+        self, events: dict[str, list[dict]], imbalances: dict[bytes, int]
     ) -> None:
         """Update the sDAI imbalance in imbalances."""
 
         def filter_sdai_events(event_list: list[dict], is_deposit: bool) -> None:
             for event in event_list:
-                if event["address"] == SDAI_TOKEN_ADDRESS:
+                if to_address_bytes(event["address"]) == SDAI_TOKEN:
                     for topic in event["topics"]:
-                        if (
-                            Web3.to_checksum_address("0x" + topic.hex()[-40:])
-                            == SETTLEMENT_CONTRACT_ADDRESS
-                        ):
+                        if to_address_bytes(topic) == SETTLEMENT_CONTRACT:
                             self.process_sdai_event(event, imbalances, is_deposit)
                             break
 
         filter_sdai_events(events["DepositSDAI"], is_deposit=True)
         filter_sdai_events(events["WithdrawSDAI"], is_deposit=False)
 
+    def compute_imbalances_from_events(
+        self, events: dict[str, list[dict]], flow: EthFlow
+    ) -> dict[str, int]:
+        """
+        Compute imbalances of the settlement contract from the events of a receipt and the
+        native ETH flows. No chain data is fetched, such that this can be used with data
+        fetched elsewhere, e.g. asynchronously.
+        """
+        imbalances = self.calculate_imbalances(events, SETTLEMENT_CONTRACT)
+
+        if flow.actions:
+            self.update_weth_imbalance(events, imbalances, SETTLEMENT_CONTRACT)
+            self.update_native_eth_imbalance(imbalances, flow.imbalance)
+
+        self.update_sdai_imbalance(events, imbalances)
+        return {
+            to_checksum_address(token_address): imbalance
+            for token_address, imbalance in imbalances.items()
+        }
+
     def compute_imbalances(self, tx_hash: str) -> dict[str, int]:
         try:
             tx_receipt = self.get_transaction_receipt(tx_hash)
             if not tx_receipt:
                 raise ValueError(f"No transaction receipt found for {tx_hash}")
 
-            traces = self.get_transaction_trace(tx_hash)
-            if traces is None:
-                raise ValueError(
-                    f"Error fetching transaction trace for {tx_hash}. Marking transaction as unprocessed."
-                )
-
             events = self.extract_events(tx_receipt)
-            imbalances = self.calculate_imbalances(events, SETTLEMENT_CONTRACT_ADDRESS)
-
-            native_eth_imbalance = None
-            actions = []
-            actions = self.extract_actions(traces, SETTLEMENT_CONTRACT_ADDRESS)
-            native_eth_imbalance = self.calculate_native_eth_imbalance(
-                actions, SETTLEMENT_CONTRACT_ADDRESS
-            )
 
-            if actions:
-                self.update_weth_imbalance(
-                    events, imbalances, SETTLEMENT_CONTRACT_ADDRESS
+            if self.lazy_traces:
+                flow = self.get_lazy_eth_flow(tx_hash, events)
+            else:
+                flow = self.get_eth_flow(tx_hash)
+            if flow is None:
+                raise ValueError(
+                    f"Error fetching transaction trace for {tx_hash}. Marking transaction as unprocessed."
                 )
-                self.update_native_eth_imbalance(imbalances, native_eth_imbalance)
 
-            self.update_sdai_imbalance(events, imbalances)
-            return imbalances
+            return self.compute_imbalances_from_events(events, flow)
 
         except Exception as e:
             logger.error("Error computing imbalances for %s: %s", tx_hash, e)
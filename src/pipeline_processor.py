@@ -0,0 +1,288 @@
+"""
+Processing of settlements in a pipeline of stages, each with its own worker threads.
+
+Stages are connected by bounded queues, so a slow stage blocks the stages before it instead of
+letting work pile up. The stages are:
+1. discover: find settlements in new finalized blocks, in batches
+2. fetch: fetch receipts, traces and blocks of a batch in batch requests
+3. compute: compute imbalances, timestamps and transferred tokens of a settlement
+4. price: fetch prices of transferred tokens
+5. persist: write results to the database, in the order settlements were discovered
+The number of workers and the queue size of each stage are configured via environment
+variables, see PIPELINE_*_WORKERS and PIPELINE_*_QUEUE_SIZE in .env.sample.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from queue import Queue
+from typing import Any, Callable
+
+from src.helpers.blockchain_data import BlockchainData, SettlementRecord
+from src.helpers.config import (
+    CHAIN_SLEEP_TIME,
+    PIPELINE_STAGE_QUEUE_SIZE,
+    PIPELINE_STAGE_WORKERS,
+    logger,
+)
+from src.helpers.database import Database, SettlementResult
+from src.transaction_processor import TransactionProcessor
+
+
+@dataclass
+class PipelineItem:
+    """A settlement passing through the pipeline, together with the data computed for it."""
+
+    seq: int
+    settlement: SettlementRecord
+    token_imbalances: dict[str, int] | None = None
+    transaction_timestamp: tuple[str, int] | None = None
+    transaction_tokens: list[tuple[str, str]] | None = None
+    prices: list[tuple[str, int, float, str]] | None = None
+    error: Exception | None = None
+    # last block of the discovered range, set on the last settlement of the range
+    checkpoint: int | None = None
+
+
+class Stage:
+    """
+    Class runs a handler in worker threads on items of a bounded input queue. Outputs of the
+    handler are put into the input queue of the next stage. If the handler fails, the input
+    items are passed on with their error set, such that later stages can account for them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], list[PipelineItem]],
+        workers: int,
+        queue_size: int,
+    ):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue: Queue = Queue(maxsize=queue_size)
+        self.next_stage: Stage | None = None
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.started_at = time.time()
+
+    def start(self) -> None:
+        self.started_at = time.time()
+        for i in range(self.workers):
+            threading.Thread(
+                target=self.work, name=f"{self.name}-{i}", daemon=True
+            ).start()
+
+    def put(self, item: Any) -> None:
+        """Add an item to the input queue, blocking while the queue is full."""
+        self.queue.put(item)
+
+    def work(self) -> None:
+        while True:
+            item = self.queue.get()
+            items = item if isinstance(item, list) else [item]
+            try:
+                outputs = self.handler(item)
+            except Exception as err:
+                logger.error("Error in pipeline stage %s: %s", self.name, err)
+                for pipeline_item in items:
+                    pipeline_item.error = pipeline_item.error or err
+                outputs = items
+                with self.lock:
+                    self.errors += len(items)
+            with self.lock:
+                self.processed += len(items)
+            if self.next_stage is not None:
+                for output in outputs:
+                    self.next_stage.put(output)
+            self.queue.task_done()
+
+    def stats(self) -> dict[str, float]:
+        """Return queue depth, number of processed items, errors and items per second."""
+        with self.lock:
+            elapsed = max(time.time() - self.started_at, 1e-9)
+            return {
+                "queue": self.queue.qsize(),
+                "processed": self.processed,
+                "errors": self.errors,
+                "per_second": round(self.processed / elapsed, 2),
+            }
+
+
+class PipelineProcessor(TransactionProcessor):
+    """Class processes settlements in a pipeline of stages with their own worker pools."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(
+        self,
+        blockchain_data: BlockchainData,
+        db: Database,
+        chain_name: str,
+        process_imbalances: bool,
+        process_fees: bool,
+        process_prices: bool,
+        stage_workers: dict[str, int] | None = None,
+        stage_queue_sizes: dict[str, int] | None = None,
+    ):
+        super().__init__(
+            blockchain_data,
+            db,
+            chain_name,
+            process_imbalances,
+            process_fees,
+            process_prices,
+        )
+        stage_workers = {**PIPELINE_STAGE_WORKERS, **(stage_workers or {})}
+        stage_queue_sizes = {**PIPELINE_STAGE_QUEUE_SIZE, **(stage_queue_sizes or {})}
+        handlers: dict[str, Callable[[Any], list[PipelineItem]]] = {
+            "fetch": self.fetch,
+            "compute": self.compute,
+            "price": self.price,
+            "persist": self.persist,
+        }
+        self.stages = {
+            name: Stage(
+                name,
+                handler,
+                # results are persisted in order by a single writer
+                1 if name == "persist" else stage_workers[name],
+                stage_queue_sizes[name],
+            )
+            for name, handler in handlers.items()
+        }
+        stages = list(self.stages.values())
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        # results waiting for results of earlier settlements to be persisted
+        self.pending: dict[int, PipelineItem] = {}
+        self.next_seq = 0
+
+    def fetch(self, items: list[PipelineItem]) -> list[PipelineItem]:
+        """Fetch chain data of a batch of settlements, used by the compute stage."""
+        self.prefetch_chain_data([item.settlement for item in items])
+        return items
+
+    def compute(self, item: PipelineItem) -> list[PipelineItem]:
+        """Compute imbalances, the timestamp and transferred tokens of a settlement."""
+        if item.error is not None:
+            return [item]
+        tx_hash = item.settlement.tx_hash
+        self.set_auction_id(item.settlement)
+        try:
+            item.token_imbalances = self.imbalances.compute_imbalances(tx_hash)
+        except Exception as e:
+            logger.error(f"Failed to compute imbalances for transaction {tx_hash}: {e}")
+            if self.process_imbalances:
+                raise
+            item.token_imbalances = {}
+        item.transaction_timestamp = self.blockchain_data.get_transaction_timestamp(
+            tx_hash, item.settlement.block_number
+        )
+        item.transaction_tokens = self.get_transaction_tokens(
+            tx_hash, item.token_imbalances
+        )
+        return [item]
+
+    def price(self, item: PipelineItem) -> list[PipelineItem]:
+        """Fetch prices of the transferred tokens of a settlement."""
+        if item.error is not None:
+            return [item]
+        item.prices = self.get_prices_for_tokens(
+            item.transaction_timestamp,  # type: ignore[arg-type]
+            item.transaction_tokens,  # type: ignore[arg-type]
+        )
+        return [item]
+
+    def persist(self, item: PipelineItem) -> list[PipelineItem]:
+        """Write results in the order of discovery, holding back results which are early."""
+        self.pending[item.seq] = item
+        while self.next_seq in self.pending:
+            pending_item = self.pending.pop(self.next_seq)
+            self.write_item(pending_item)
+            self.next_seq += 1
+        return []
+
+    def write_item(self, item: PipelineItem) -> None:
+        """
+        Write the results of a settlement, together with the checkpoint of the item if the
+        write succeeds. Otherwise, the checkpoint is written on its own, before the settlement.
+        """
+        settlement = item.settlement
+        if item.error is not None:
+            logger.error(
+                f"Error processing transaction {settlement.tx_hash}: {item.error}"
+            )
+            self.retries.failed(settlement, item.error)
+            if item.checkpoint is not None:
+                self.write_checkpoint(item.checkpoint)
+            return
+        try:
+            self.write_settlement_results(
+                [
+                    SettlementResult(
+                        settlement,
+                        item.token_imbalances,  # type: ignore[arg-type]
+                        item.transaction_timestamp,  # type: ignore[arg-type]
+                        item.transaction_tokens,  # type: ignore[arg-type]
+                        item.prices,  # type: ignore[arg-type]
+                    )
+                ],
+                (
+                    None
+                    if item.checkpoint is None
+                    else self.checkpoint_block(item.checkpoint, processed=[settlement])
+                ),
+            )
+        except Exception as err:
+            logger.error(f"An Error occurred: {err}")
+            self.retries.failed(settlement, err)
+            if item.checkpoint is not None:
+                self.write_checkpoint(item.checkpoint)
+            return
+        self.record_outcome([settlement], [])
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Queue depth and throughput of all stages."""
+        return {name: stage.stats() for name, stage in self.stages.items()}
+
+    def process_pipeline(self, start_block: int) -> None:
+        """
+        Start all stages and run the discover stage in this thread. Settlements are passed on
+        in batches of the maximal RPC batch size.
+        """
+        for stage in self.stages.values():
+            stage.start()
+        batch_size = self.blockchain_data.batch.max_batch_size
+        previous_block = start_block
+        seq = 0
+        logger.info(
+            "%s pipeline started. Start block: %d", self.chain_name, start_block
+        )
+        while True:
+            try:
+                _, latest_block = self.head_tracker.next_range(previous_block)
+                settlements = (
+                    self.blockchain_data.fetch_tx_data(previous_block, latest_block)
+                    + self.retries.due()
+                )
+                items = [
+                    PipelineItem(seq + i, settlement)
+                    for i, settlement in enumerate(settlements)
+                ]
+                seq += len(items)
+                if items:
+                    items[-1].checkpoint = latest_block
+                elif self.next_seq == seq:
+                    # no settlements in the range and all earlier ones are persisted
+                    self.write_checkpoint(latest_block)
+                for start in range(0, len(items), batch_size):
+                    self.stages["fetch"].put(items[start : start + batch_size])
+                previous_block = latest_block + 1
+                logger.info("Pipeline: %s", self.stats())
+                logger.info("Database pool: %s", self.db.pool_stats())
+            except Exception as e:
+                logger.error(f"Error in discover stage: {e}")
+                time.sleep(CHAIN_SLEEP_TIME)
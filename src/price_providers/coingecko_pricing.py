@@ -6,7 +6,8 @@ from web3 import Web3
 
 from src.price_providers.pricing_model import AbstractPriceProvider
 from src.helpers.config import logger, get_web3_instance
-from src.helpers.helper_functions import get_finalized_block_number, extract_params
+from src.helpers.block_headers import BLOCK_HEADERS
+from src.helpers.helper_functions import extract_params
 from src.constants import (
     NATIVE_ETH_TOKEN_ADDRESS,
     WETH_TOKEN_ADDRESS,
@@ -116,9 +117,7 @@ class CoingeckoPriceProvider(AbstractPriceProvider):
         This function checks if the time elapsed between the latest block and block being processed
         is less than 2 days, which is coingecko's time frame for fetching 5-minutely data.
         """
-        newest_block_timestamp = self.web3.eth.get_block(
-            get_finalized_block_number(self.web3)
-        )["timestamp"]
+        newest_block_timestamp = BLOCK_HEADERS.get_finalized_timestamp(self.web3)
         return (newest_block_timestamp - block_start_timestamp) > COINGECKO_TIME_LIMIT
 
     def get_price(self, price_params: dict) -> float | None:
@@ -130,7 +129,7 @@ class CoingeckoPriceProvider(AbstractPriceProvider):
             logger.warning("Coingecko API key is not set.")
             return None
         token_address, block_number = extract_params(price_params, is_block=True)
-        block_start_timestamp = self.web3.eth.get_block(block_number)["timestamp"]
+        block_start_timestamp = BLOCK_HEADERS.get_timestamp(self.web3, block_number)
         if self.price_not_retrievable(block_start_timestamp):
             return None
 
@@ -4,6 +4,7 @@ from src.price_providers.pricing_model import AbstractPriceProvider
 from dune_client.types import QueryParameter
 from dune_client.client import DuneClient
 from dune_client.query import QueryBase
+from src.helpers.block_headers import BLOCK_HEADERS
 from src.helpers.config import get_web3_instance, get_logger
 from src.helpers.helper_functions import extract_params
 from src.constants import DUNE_PRICE_QUERY_ID, DUNE_QUERY_BUFFER_TIME
@@ -44,11 +45,7 @@ class DunePriceProvider(AbstractPriceProvider):
             if not self.dune:
                 return None
             token_address, block_number = extract_params(price_params, is_block=True)
-            start_timestamp = getattr(
-                self.web3.eth.get_block(block_number), "timestamp", None
-            )
-            if start_timestamp is None:
-                raise KeyError("Timestamp not found in block data.")
+            start_timestamp = BLOCK_HEADERS.get_timestamp(self.web3, block_number)
             end_timestamp = start_timestamp + DUNE_QUERY_BUFFER_TIME
             query = QueryBase(
                 name="ERC20 Prices",
@@ -4,6 +4,7 @@ from src.price_providers.pricing_model import AbstractPriceProvider
 from src.helpers.blockchain_data import BlockchainData
 from src.helpers.config import get_web3_instance, logger
 from src.helpers.helper_functions import extract_params
+from src.helpers.token_decimals_registry import TOKEN_DECIMALS
 
 
 class AuctionPriceProvider(AbstractPriceProvider):
@@ -40,10 +41,12 @@ class AuctionPriceProvider(AbstractPriceProvider):
                         f"Price for token {token_address} not found in auction data."
                     )
                     return None
+                decimals = TOKEN_DECIMALS.get(self.blockchain.web3, token_address)
+                if decimals is None:
+                    logger.warning(f"Decimals of token {token_address} not found.")
+                    return None
                 # calculation for converting auction price from endpoint to ETH equivalent per token unit
-                price_in_eth = (float(price) / 10**18) * (
-                    10 ** self.blockchain.get_token_decimals(token_address) / 10**18
-                )
+                price_in_eth = (float(price) / 10**18) * (10**decimals / 10**18)
                 return price_in_eth
 
             except requests.exceptions.HTTPError as err:
@@ -0,0 +1,56 @@
+"""
+Replay of settlements from the failed_transactions table.
+
+Settlements are processed again in batches. Successful ones are removed from the table, the
+attempt count and error of failed ones are updated.
+
+Usage:
+python -m src.replay_failed [--limit 1000] [--batch-size 100]
+"""
+
+import argparse
+import os
+
+from src.backfill import create_processor
+from src.helpers.config import logger
+
+
+def replay_failed(chain_name: str, limit: int | None, batch_size: int) -> None:
+    processor = create_processor(chain_name)
+    settlements = processor.db.get_failed_transactions(limit)
+    logger.info("Replaying %d failed transactions.", len(settlements))
+    replayed = 0
+    for start in range(0, len(settlements), batch_size):
+        batch = settlements[start : start + batch_size]
+        failures = processor.process_batch(batch)
+        for settlement, error in failures:
+            processor.db.write_failed_transaction(settlement, 1, str(error))
+        failed_hashes = {settlement.tx_hash for settlement, _ in failures}
+        succeeded = [
+            settlement.tx_hash
+            for settlement in batch
+            if settlement.tx_hash not in failed_hashes
+        ]
+        if succeeded:
+            processor.db.delete_failed_transactions(succeeded)
+        replayed += len(succeeded)
+    logger.info("Replayed %d of %d failed transactions.", replayed, len(settlements))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Replay settlements from the failed_transactions table."
+    )
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    chain_name = os.getenv("CHAIN_NAME")
+    if chain_name is None:
+        logger.error("CHAIN_NAME environment variable is not set.")
+        return
+    replay_failed(chain_name, args.limit, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
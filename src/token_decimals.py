@@ -6,20 +6,32 @@ from web3 import Web3
 
 from src.helpers.blockchain_data import BlockchainData
 from src.helpers.database import Database
+from src.helpers.token_decimals_registry import TOKEN_DECIMALS
 
 
 load_dotenv()
 
 
-def update_token_decimals(database: Database, blockchain: BlockchainData) -> None:
-    token_addresses = database.get_tokens_without_decimals()
-
-    token_decimals = [
-        (token_address, blockchain.get_token_decimals(token_address))
-        for token_address in token_addresses
-    ]
+def update_token_decimals(
+    database: Database,
+    blockchain: BlockchainData,
+    token_addresses: list[str] | None = None,
+) -> None:
+    """
+    Store decimals of tokens in the token_decimals table. The registry is preloaded from the
+    table on first use, so only new tokens are requested from the chain. Without
+    token_addresses, all tokens in transaction_tokens without decimals are updated.
+    """
+    if not TOKEN_DECIMALS.loaded:
+        TOKEN_DECIMALS.load(database.get_token_decimals())
+    if token_addresses is None:
+        token_addresses = database.get_tokens_without_decimals()
+    TOKEN_DECIMALS.resolve(blockchain.web3, token_addresses)
+
+    token_decimals = TOKEN_DECIMALS.get_unpersisted()
     if token_decimals:
         database.write_token_decimals(token_decimals)
+        TOKEN_DECIMALS.mark_persisted(token_decimals)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,33 @@
 import time
+from typing import Iterable, cast
 
 from hexbytes import HexBytes
 from web3 import Web3
 
 from src.fees.compute_fees import compute_all_fees_of_batch
-from src.helpers.blockchain_data import BlockchainData
-from src.helpers.config import CHAIN_SLEEP_TIME, logger
-from src.helpers.database import Database
-from src.helpers.helper_functions import read_sql_file, set_params
+from src.helpers.block_headers import BLOCK_HEADERS
+from src.helpers.blockchain_data import BlockchainData, SettlementRecord
+from src.helpers.config import (
+    CHAIN_SLEEP_TIME,
+    DB_WRITE_GROUP_SIZE,
+    HEAD_TRACKING_MAX_RANGE,
+    HEAD_TRACKING_MODE,
+    LAZY_TRACES,
+    NODE_WS_URL,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_ATTEMPTS,
+    RETRY_MAX_DELAY,
+    TRACE_MODE,
+    TRACE_VERIFICATION_RATE,
+    logger,
+)
+from src.helpers.database import Database, SettlementResult
+from src.helpers.head_tracker import HeadTracker
+from src.helpers.retry_scheduler import RetryScheduler
+from src.helpers.rpc_cache import get_rpc_cache
+from src.helpers.token_decimals_registry import TOKEN_DECIMALS
+from src.helpers.write_buffer import WriteBuffer
+from src.helpers.helper_functions import set_params
 from src.imbalances_script import RawTokenImbalances
 from src.price_providers.price_feed import PriceFeed
 from src.token_decimals import update_token_decimals
@@ -20,6 +40,9 @@ class TransactionProcessor:
 
     # pylint: disable=too-many-instance-attributes, too-many-arguments
 
+    # stage under which the last processed block is stored in the processing_checkpoint table
+    checkpoint_stage = "daemon"
+
     def __init__(
         self,
         blockchain_data: BlockchainData,
@@ -36,9 +59,32 @@ class TransactionProcessor:
         self.process_fees = process_fees
         self.process_prices = process_prices
 
-        self.imbalances = RawTokenImbalances(self.blockchain_data.web3, self.chain_name)
+        self.imbalances = RawTokenImbalances(
+            self.blockchain_data.web3,
+            self.chain_name,
+            TRACE_MODE,
+            LAZY_TRACES,
+            TRACE_VERIFICATION_RATE,
+            self.blockchain_data.fast_rpc,
+        )
+        self.head_tracker = HeadTracker(
+            self.blockchain_data.web3,
+            HEAD_TRACKING_MODE,
+            NODE_WS_URL,
+            HEAD_TRACKING_MAX_RANGE,
+        )
+        self.retries = RetryScheduler(
+            self.db, RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+        )
+        self.db_write_group_size = DB_WRITE_GROUP_SIZE
+        # write results with COPY, for large groups of settlements
+        self.bulk_writes = False
+        # write-behind buffer for results and checkpoints, see start_write_buffer()
+        self.write_buffer: WriteBuffer | None = None
         self.price_providers = PriceFeed(activate=process_prices)
-        self.log_message: list[str] = []
+        # decimals stored in the database are known before prices are resolved
+        if not TOKEN_DECIMALS.loaded:
+            TOKEN_DECIMALS.load(self.db.get_token_decimals())
 
     def get_start_block(self) -> int:
         """
@@ -48,8 +94,14 @@ class TransactionProcessor:
         TODO: Remove that rule before moving to production.
 
         If no entries are present, fallback to get_finalized_block_number().
+
+        If a processing checkpoint exists, the block after it is returned without any requests
+        to the node.
         """
         try:
+            checkpoint = self.db.get_checkpoint(self.checkpoint_stage)
+            if checkpoint is not None:
+                return checkpoint + 1
             # 1) get latest block on chain
             block_number_latest = self.blockchain_data.get_latest_block()
             # 2) get last transaction from DB
@@ -65,7 +117,8 @@ class TransactionProcessor:
                     #  TODO: Remove this rule before moving to production.
                     logger.warning(
                         "Only old transactions found in database, latest was on block"
-                        f"{block_number_db}. Using recent block instead."
+                        f"{block_number_db}. Using recent block instead, use src.backfill "
+                        "to process skipped blocks."
                     )
                     start_block = block_number_latest
                 else:
@@ -84,136 +137,361 @@ class TransactionProcessor:
     def process(self, start_block: int) -> None:
         """Main Daemon loop that finds imbalances for txs and prices."""
         previous_block = start_block
-        unprocessed_txs: list[tuple[str, int, int]] = []
         logger.info("%s daemon started. Start block: %d", self.chain_name, start_block)
 
         while True:
             try:
-                latest_block = self.blockchain_data.get_latest_block()
-                new_txs = self.blockchain_data.fetch_tx_data(
+                # waits for new finalized blocks if all blocks are processed
+                _, latest_block = self.head_tracker.next_range(previous_block)
+                settlements = self.blockchain_data.fetch_tx_data(
                     previous_block, latest_block
                 )
-                all_txs = new_txs + unprocessed_txs
-                unprocessed_txs.clear()
-
-                for tx_hash, auction_id, block_number in all_txs:
-                    try:
-                        self.process_single_transaction(
-                            tx_hash, auction_id, block_number
-                        )
-                    except Exception as e:
-                        unprocessed_txs.append((tx_hash, auction_id, block_number))
-                        logger.error(f"Error processing transaction {tx_hash}: {e}")
-
+                due = self.retries.due()
+                try:
+                    # the checkpoint is written together with the last results of the range
+                    failed = self.process_batch(
+                        settlements + due, checkpoint=latest_block
+                    )
+                except Exception as err:
+                    # the range is processed again, settlements due for retry are rescheduled
+                    self.retries.record(due, [(settlement, err) for settlement in due])
+                    raise
+                self.record_outcome(settlements + due, failed)
                 previous_block = latest_block + 1
-                time.sleep(CHAIN_SLEEP_TIME)
+                logger.info("RPC cache: %s", get_rpc_cache().stats())
+                logger.info("Block header cache: %s", BLOCK_HEADERS.headers.stats())
+                logger.info("Database pool: %s", self.db.pool_stats())
+                if self.write_buffer is not None:
+                    logger.info("Write buffer: %s", self.write_buffer.stats())
+                if self.imbalances.lazy_traces:
+                    logger.info("Lazy traces: %s", self.imbalances.trace_stats)
+                if self.retries:
+                    logger.info(
+                        "Settlements scheduled for retry: %d", len(self.retries)
+                    )
 
             except Exception as e:
                 logger.error(f"Error in processing loop: {e}")
                 time.sleep(CHAIN_SLEEP_TIME)
 
+    def start_write_buffer(self, max_rows: int, max_delay: float) -> None:
+        """
+        Buffer results and checkpoints, and write them once max_rows rows are buffered or
+        max_delay seconds passed. The checkpoint is written in the same transaction as the
+        results buffered before it.
+        """
+        self.write_buffer = WriteBuffer(
+            self.store_buffered_results,
+            self.store_checkpoint,
+            self.retry_settlement_results,
+            max_rows,
+            max_delay,
+        )
+        self.write_buffer.start()
+
+    def record_outcome(
+        self,
+        settlements: list[SettlementRecord],
+        failures: list[tuple[SettlementRecord, Exception]],
+    ) -> None:
+        """
+        Record the outcome of processing settlements for retries. With the write buffer,
+        settlements with buffered results are recorded once their results are written.
+        """
+        if self.write_buffer is None:
+            self.retries.record(settlements, failures)
+        else:
+            self.retries.record([settlement for settlement, _ in failures], failures)
+
+    def checkpoint_block(
+        self,
+        latest_block: int,
+        failed: Iterable[tuple[SettlementRecord, Exception]] = (),
+        processed: Iterable[SettlementRecord] = (),
+    ) -> int:
+        """
+        Block to store as last processed block for latest_block. Blocks of failed settlements
+        and of settlements which are scheduled for retry, except for the processed ones, are
+        processed again after a restart.
+        """
+        retry_block = self.retries.min_block(
+            exclude={settlement.tx_hash for settlement in processed}
+        )
+        blocks = [settlement.block_number for settlement, _ in failed]
+        if retry_block is not None:
+            blocks.append(retry_block)
+        return min([latest_block] + [block - 1 for block in blocks])
+
+    def write_checkpoint(
+        self,
+        latest_block: int,
+        failed: Iterable[tuple[SettlementRecord, Exception]] = (),
+        processed: Iterable[SettlementRecord] = (),
+    ) -> None:
+        """
+        Store latest_block as last processed block without results, after all buffered
+        results. See checkpoint_block() for failed and processed.
+        """
+        checkpoint = self.checkpoint_block(latest_block, failed, processed)
+        if self.write_buffer is not None:
+            self.write_buffer.set_checkpoint(checkpoint)
+        else:
+            self.db.write_checkpoint(self.checkpoint_stage, checkpoint)
+
+    def store_checkpoint(self, latest_block: int) -> None:
+        """Store a checkpoint from the write buffer, before settlements scheduled for retry."""
+        self.db.write_checkpoint(
+            self.checkpoint_stage, self.checkpoint_block(latest_block)
+        )
+
+    def process_batch(
+        self, settlements: list[SettlementRecord], checkpoint: int | None = None
+    ) -> list[tuple[SettlementRecord, Exception]]:
+        """
+        Process settlements one by one and return failed settlements with their errors.
+        Results of up to DB_WRITE_GROUP_SIZE settlements are written in one transaction.
+        If checkpoint is given, it is written in the transaction of the last results, or on
+        its own if that fails, before all failed settlements.
+        """
+        failed: list[tuple[SettlementRecord, Exception]] = []
+        results: list[SettlementResult] = []
+        # fetch chain data of all transactions in a few batch requests
+        self.prefetch_chain_data(settlements)
+
+        for i, settlement in enumerate(settlements):
+            try:
+                results.append(self.compute_settlement_result(settlement))
+            except Exception as e:
+                failed.append((settlement, e))
+                logger.error(f"Error processing transaction {settlement.tx_hash}: {e}")
+            last = i == len(settlements) - 1
+            if results and (len(results) >= self.db_write_group_size or last):
+                try:
+                    self.write_settlement_results(
+                        results,
+                        (
+                            self.checkpoint_block(checkpoint, failed, settlements)
+                            if last and checkpoint is not None
+                            else None
+                        ),
+                    )
+                    checkpoint = None if last else checkpoint
+                except Exception as e:
+                    failed += [(result.settlement, e) for result in results]
+                    logger.error(f"Error writing results of {len(results)} txs: {e}")
+                results = []
+        if checkpoint is not None:
+            self.write_checkpoint(checkpoint, failed, settlements)
+        return failed
+
+    def prefetch_chain_data(self, settlements: list[SettlementRecord]) -> None:
+        """
+        Fetch receipts, traces, blocks and transactions without auction id using batch
+        requests. Responses are stored in the shared RPC cache and block header cache and used
+        when processing single transactions.
+        """
+        self.blockchain_data.batch.get_transactions(
+            [
+                settlement.tx_hash
+                for settlement in settlements
+                if settlement.auction_id is None
+            ]
+        )
+        self.blockchain_data.get_settlement_receipts(
+            [
+                (settlement.tx_hash, settlement.block_number)
+                for settlement in settlements
+            ]
+        )
+        self.imbalances.prefetch(
+            [settlement.tx_hash for settlement in settlements],
+            [settlement.block_number for settlement in settlements],
+        )
+        blocks = self.blockchain_data.batch.get_blocks(
+            sorted({settlement.block_number for settlement in settlements})
+        )
+        BLOCK_HEADERS.store(self.blockchain_data.web3, blocks)
+
     def process_single_transaction(
         self, tx_hash: str, auction_id: int, block_number: int
     ) -> None:
-        """Function processes a single tx to find imbalances, fees, prices including writing to database."""
-        self.log_message = []
-        try:
-            # compute raw token imbalances
-            token_imbalances = self.process_token_imbalances(
-                tx_hash, auction_id, block_number
-            )
+        """
+        Function processes a single tx to find imbalances, fees, prices including writing to
+        database. Errors are raised to the caller, all writes can be repeated safely.
+        """
+        self.write_settlement_results(
+            [
+                self.compute_settlement_result(
+                    SettlementRecord(tx_hash, block_number, auction_id=auction_id)
+                )
+            ]
+        )
 
-            # get transaction timestamp
-            transaction_timestamp = self.blockchain_data.get_transaction_timestamp(
-                tx_hash
-            )
-            # store transaction timestamp
-            self.db.write_transaction_timestamp(transaction_timestamp)
-
-            # get transaction tokens
-            # transaction_tokens = self.blockchain_data.get_transaction_tokens(tx_hash)
-            # store transaction tokens
-            transaction_tokens = []
-            for token_address, imbalance in token_imbalances.items():
-                if imbalance != 0:
-                    transaction_tokens.append((tx_hash, token_address))
-            self.db.write_transaction_tokens(transaction_tokens)
-
-            # update token decimals
-            update_token_decimals(self.db, self.blockchain_data)
-
-            # get prices
-            prices_new = self.get_prices_for_tokens(
-                transaction_timestamp, transaction_tokens
+    def compute_settlement_result(
+        self, settlement: SettlementRecord
+    ) -> SettlementResult:
+        """Compute imbalances of a settlement and fetch its timestamp and prices."""
+        tx_hash = settlement.tx_hash
+        self.set_auction_id(settlement)
+        # compute raw token imbalances
+        token_imbalances = self.process_token_imbalances(
+            tx_hash,
+            cast(int, settlement.auction_id),
+            settlement.block_number,
+        )
+
+        # get transaction timestamp
+        transaction_timestamp = self.blockchain_data.get_transaction_timestamp(
+            tx_hash, settlement.block_number
+        )
+
+        # get transaction tokens
+        transaction_tokens = self.get_transaction_tokens(tx_hash, token_imbalances)
+
+        # get prices
+        prices_new = self.get_prices_for_tokens(
+            transaction_timestamp, transaction_tokens
+        )
+
+        # # Compute Fees
+        # if self.process_fees:
+        #     (
+        #         protocol_fees,
+        #         partner_fees,
+        #         network_fees,
+        #     ) = self.process_fees_for_transaction(tx_hash)
+
+        return SettlementResult(
+            settlement,
+            token_imbalances,
+            transaction_timestamp,
+            transaction_tokens,
+            prices_new,
+        )
+
+    def set_auction_id(self, settlement: SettlementRecord) -> None:
+        """
+        Decode the auction id of a settlement found via logs from its transaction, which is
+        cached by prefetch_chain_data().
+        """
+        if settlement.auction_id is None:
+            settlement.auction_id = self.blockchain_data.get_auction_id(
+                settlement.tx_hash
             )
-            # store prices
-            self.db.write_prices_new(prices_new)
-
-            # Compute Raw Token Imbalances
-            # if self.process_imbalances:
-            #     token_imbalances = self.process_token_imbalances(
-            #         tx_hash, auction_id, block_number
-            #     )
-
-            # # Compute Fees
-            # if self.process_fees:
-            #     (
-            #         protocol_fees,
-            #         partner_fees,
-            #         network_fees,
-            #     ) = self.process_fees_for_transaction(tx_hash)
-
-            # # Compute Prices
-            # if self.process_prices and self.process_imbalances:
-            #     prices = self.process_prices_for_tokens(
-            #         token_imbalances, block_number, tx_hash
-            #     )
-
-            # Write to database iff no errors in either computations
-            # if (
-            #     (not self.process_imbalances)
-            #     and (not self.process_fees)
-            #     and (not self.process_prices)
-            # ):
-            #     return
-
-            if self.process_imbalances and token_imbalances:
-                self.handle_imbalances(
-                    token_imbalances, tx_hash, auction_id, block_number
-                )
 
-            # if self.process_fees:
-            #     self.handle_fees(
-            #         protocol_fees,
-            #         partner_fees,
-            #         network_fees,
-            #         auction_id,
-            #         block_number,
-            #         tx_hash,
-            #     )
+    def get_transaction_tokens(
+        self, tx_hash: str, token_imbalances: dict[str, int]
+    ) -> list[tuple[str, str]]:
+        """Return (tx_hash, token_address) for all tokens with non-zero imbalance."""
+        return [
+            (tx_hash, token_address)
+            for token_address, imbalance in token_imbalances.items()
+            if imbalance != 0
+        ]
+
+    def write_settlement_results(
+        self, results: list[SettlementResult], checkpoint: int | None = None
+    ) -> None:
+        """
+        Write results of settlements, and the checkpoint if given, to the database in a single
+        transaction, or to the write buffer.
+        """
+        if self.write_buffer is not None:
+            self.write_buffer.add(results, checkpoint)
+        else:
+            self.store_settlement_results(results, checkpoint)
 
-            # if self.process_prices and prices:
-            #     self.handle_prices(prices, tx_hash, block_number)
+    def store_buffered_results(
+        self, results: list[SettlementResult], checkpoint: int | None
+    ) -> None:
+        """Write results from the write buffer and record their settlements as processed."""
+        settlements = [result.settlement for result in results]
+        if checkpoint is not None:
+            # settlements scheduled for retry until these results are written
+            checkpoint = self.checkpoint_block(checkpoint, processed=settlements)
+        self.store_settlement_results(results, checkpoint)
+        self.retries.record(settlements, [])
+
+    def retry_settlement_results(
+        self, results: list[SettlementResult], error: Exception
+    ) -> None:
+        """Schedule settlements for another attempt if writing their results failed."""
+        settlements = [result.settlement for result in results]
+        self.retries.record(
+            settlements, [(settlement, error) for settlement in settlements]
+        )
 
-            logger.info("\n".join(self.log_message))
+    def store_settlement_results(
+        self, results: list[SettlementResult], checkpoint: int | None = None
+    ) -> None:
+        """Write results of settlements and the checkpoint in a single transaction."""
+        stage_checkpoint = (
+            None if checkpoint is None else (self.checkpoint_stage, checkpoint)
+        )
+        if self.bulk_writes:
+            self.db.bulk_write_settlement_results(
+                results, self.process_imbalances, stage_checkpoint
+            )
+        else:
+            self.db.write_settlement_results(
+                results, self.process_imbalances, stage_checkpoint
+            )
+        # update token decimals
+        update_token_decimals(
+            self.db,
+            self.blockchain_data,
+            [
+                token_address
+                for result in results
+                for _, token_address in result.transaction_tokens
+            ],
+        )
 
-        except Exception as err:
-            logger.error(f"An Error occurred: {err}")
-            return
+        # if self.process_fees:
+        #     self.handle_fees(
+        #         protocol_fees,
+        #         partner_fees,
+        #         network_fees,
+        #         auction_id,
+        #         block_number,
+        #         tx_hash,
+        #     )
+
+        for result in results:
+            self.log_results(result)
+
+    def log_results(self, result: SettlementResult) -> None:
+        """Log non-zero imbalances of a settlement."""
+        imbalances = [
+            f"Token: {token_address}, Imbalance: {imbalance}"
+            for token_address, imbalance in result.token_imbalances.items()
+            if imbalance != 0
+        ]
+        if self.process_imbalances and imbalances:
+            logger.info(
+                "\n".join(
+                    [
+                        f"Token Imbalances on {self.chain_name} for tx "
+                        f"{result.settlement.tx_hash}:"
+                    ]
+                    + imbalances
+                )
+            )
 
     def process_token_imbalances(
         self, tx_hash: str, auction_id: int, block_number: int
     ) -> dict[str, int]:
-        """Process token imbalances for a given transaction and return imbalances."""
+        """
+        Process token imbalances for a given transaction and return imbalances.
+        Errors are raised if imbalances are processed on this chain, such that the transaction
+        is retried.
+        """
         try:
-            token_imbalances = self.imbalances.compute_imbalances(tx_hash)
-            if token_imbalances:
-                self.log_message.append(
-                    f"Token Imbalances on {self.chain_name} for tx {tx_hash}:"
-                )
-            return token_imbalances
+            return self.imbalances.compute_imbalances(tx_hash)
         except Exception as e:
             logger.error(f"Failed to compute imbalances for transaction {tx_hash}: {e}")
+            if self.process_imbalances:
+                raise
             return {}
 
     def process_fees_for_transaction(
@@ -244,6 +522,9 @@ class TransactionProcessor:
         tx_hash = transaction_timestamp[0]
         timestamp = transaction_timestamp[1]
         token_addresses = [token_address for _, token_address in transaction_tokens]
+        # decimals of all tokens are fetched in one call, instead of one per auction price
+        if self.process_prices:
+            TOKEN_DECIMALS.resolve(self.blockchain_data.web3, token_addresses)
         block_number = self.blockchain_data.web3.eth.get_transaction_receipt(
             HexBytes(tx_hash)
         )["blockNumber"]
@@ -267,51 +548,6 @@ class TransactionProcessor:
 
         return prices
 
-    def process_prices_for_tokens(
-        self,
-        token_imbalances: dict[str, int],
-        block_number: int,
-        tx_hash: str,
-    ) -> dict[str, tuple[float, str]]:
-        """Compute prices for tokens with non-null imbalances."""
-        prices = {}
-        try:
-            for token_address in token_imbalances.keys():
-                price_data = self.price_providers.get_price(
-                    set_params(token_address, block_number, tx_hash)
-                )
-                if price_data:
-                    price, source = price_data[0]
-                    prices[token_address] = (price, source)
-        except Exception as e:
-            logger.error(f"Failed to process prices for transaction {tx_hash}: {e}")
-
-        return prices
-
-    def handle_imbalances(
-        self,
-        token_imbalances: dict[str, int],
-        tx_hash: str,
-        auction_id: int,
-        block_number: int,
-    ) -> None:
-        """Function loops over non-null raw imbalances and writes them to the database."""
-        try:
-            for token_address, imbalance in token_imbalances.items():
-                if imbalance != 0:
-                    self.db.write_token_imbalances(
-                        tx_hash,
-                        auction_id,
-                        block_number,
-                        token_address,
-                        imbalance,
-                    )
-                    self.log_message.append(
-                        f"Token: {token_address}, Imbalance: {imbalance}"
-                    )
-        except Exception as err:
-            logger.error(f"Error: {err}")
-
     def handle_fees(
         self,
         protocol_fees: dict[str, tuple[str, int]],
@@ -370,19 +606,6 @@ class TransactionProcessor:
                 f"Failed to write fees to database for transaction {tx_hash}: {err}"
             )
 
-    def handle_prices(
-        self, prices: dict[str, tuple[float, str]], tx_hash: str, block_number: int
-    ) -> None:
-        """Function writes prices to table per token."""
-        try:
-            for token_address, (price, source) in prices.items():
-                self.db.write_prices(
-                    source, block_number, tx_hash, token_address, price
-                )
-                self.log_message.append(f"Token: {token_address}, Price: {price} ETH")
-        except Exception as err:
-            logger.error(f"Error: {err}")
-
 
 def calculate_slippage(
     token_imbalances: dict[str, int],
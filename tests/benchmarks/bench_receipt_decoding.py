@@ -0,0 +1,80 @@
+"""
+Microbenchmark of decoding receipts via web3's formatters and via the fast RPC client.
+Run with: python -m tests.benchmarks.bench_receipt_decoding
+No node is needed, responses are served by a fake provider.
+"""
+
+import json
+import timeit
+
+import orjson
+from web3 import Web3
+
+from src.helpers.fast_rpc import decode_receipt
+
+TX_HASH = "0x" + "01" * 32
+NUMBER_OF_LOGS = 200
+REPETITIONS = 200
+
+
+def make_raw_receipt() -> bytes:
+    """JSON response of a large settlement with NUMBER_OF_LOGS transfers."""
+    logs = [
+        {
+            "address": "0x" + f"{i:040x}",
+            "topics": [
+                "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef",
+                "0x" + "00" * 12 + "9008d19f58aabd9ed0d60971565aa8510560ab41",
+                "0x" + "00" * 12 + f"{i:040x}",
+            ],
+            "data": "0x" + f"{i:064x}",
+            "blockNumber": "0x10",
+            "blockHash": "0x" + "02" * 32,
+            "transactionHash": TX_HASH,
+            "transactionIndex": "0x1",
+            "logIndex": hex(i),
+            "removed": False,
+        }
+        for i in range(NUMBER_OF_LOGS)
+    ]
+    receipt = {
+        "transactionHash": TX_HASH,
+        "transactionIndex": "0x1",
+        "blockHash": "0x" + "02" * 32,
+        "blockNumber": "0x10",
+        "from": "0x" + "ab" * 20,
+        "to": "0x9008d19f58aabd9ed0d60971565aa8510560ab41",
+        "cumulativeGasUsed": "0x100000",
+        "gasUsed": "0x10000",
+        "effectiveGasPrice": "0x10",
+        "contractAddress": None,
+        "logs": logs,
+        "logsBloom": "0x" + "00" * 256,
+        "status": "0x1",
+        "type": "0x2",
+    }
+    return json.dumps({"jsonrpc": "2.0", "id": 0, "result": receipt}).encode()
+
+
+def main() -> None:
+    raw = make_raw_receipt()
+    web3 = Web3(Web3.HTTPProvider("http://localhost:8545"))
+    web3.provider.make_request = lambda method, params: json.loads(raw)  # type: ignore
+
+    timings = {
+        "web3": timeit.timeit(
+            lambda: web3.eth.get_transaction_receipt(TX_HASH), number=REPETITIONS
+        ),
+        "fast_rpc": timeit.timeit(
+            lambda: decode_receipt(orjson.loads(raw)["result"]), number=REPETITIONS
+        ),
+    }
+    for name, total in timings.items():
+        print(
+            f"{name}: {total / REPETITIONS * 1e6:.0f} us per receipt "
+            f"with {NUMBER_OF_LOGS} logs"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -44,3 +44,14 @@ def test_get_transaction_tokens():
         "0xEE2a03Aa6Dacf51C18679C516ad5283d8E7C2637",
         "0x72e4f9F808C49A2a61dE9C5896298920Dc4EEEa9",
     }
+
+
+def tests_get_tx_hashes_blocks_discovery_modes():
+    web3 = Web3(Web3.HTTPProvider(getenv("NODE_URL")))
+    start_block = 20892110
+    end_block = 20892130
+    res_logs = BlockchainData(web3, "logs").get_tx_hashes_blocks(start_block, end_block)
+    res_blocks = BlockchainData(web3, "blocks").get_tx_hashes_blocks(
+        start_block, end_block
+    )
+    assert res_logs == res_blocks
@@ -0,0 +1,94 @@
+import asyncio
+from unittest.mock import Mock
+
+from src.async_transaction_processor import AsyncTransactionProcessor
+from src.helpers.blockchain_data import SettlementRecord
+from src.helpers.database import SettlementResult
+
+
+def mock_db() -> Mock:
+    """Database mock without stored token decimals."""
+    db = Mock()
+    db.get_token_decimals.return_value = {}
+    return db
+
+
+def test_results_are_written_in_block_order():
+    blockchain_data = Mock()
+    processor = AsyncTransactionProcessor(
+        blockchain_data, mock_db(), "mainnet", True, False, False, Mock()
+    )
+    settlements = [
+        SettlementRecord("0x03", 12, 0, 3),
+        SettlementRecord("0x01", 10, 0, 1),
+        SettlementRecord("0x02", 11, 5, 2),
+    ]
+    written = []
+
+    async def compute_settlement(settlement):
+        # later settlements finish first
+        await asyncio.sleep(0.01 * (13 - settlement.block_number))
+        return SettlementResult(settlement, {}, (settlement.tx_hash, 0), [], [])
+
+    processor.compute_settlement = compute_settlement
+    processor.db_write_group_size = 2
+    processor.write_settlement_results = lambda results, checkpoint: written.append(
+        ([result.settlement.tx_hash for result in results], checkpoint)
+    )
+
+    asyncio.run(processor.process_settlements(settlements, checkpoint=20))
+
+    # results are written in groups, the checkpoint with the last group
+    assert written == [(["0x01", "0x02"], None), (["0x03"], 20)]
+
+
+def test_imbalance_errors_are_ignored_if_imbalances_are_not_processed():
+    error = ValueError("no trace")
+
+    async def node_request(method, *args):
+        raise error
+
+    for process_imbalances, expected in [(False, {}), (True, error)]:
+        processor = AsyncTransactionProcessor(
+            Mock(), mock_db(), "arbitrum_one", process_imbalances, False, False, Mock()
+        )
+        processor.node_request = node_request
+        try:
+            result = asyncio.run(processor.compute_token_imbalances("0x01"))
+        except ValueError as err:
+            result = err
+        assert result == expected
+
+
+def test_skipped_traces_are_verified(monkeypatch):
+    processor = AsyncTransactionProcessor(
+        Mock(), mock_db(), "mainnet", True, False, False, Mock()
+    )
+    processor.imbalances.lazy_traces = True
+    processor.imbalances.trace_verification_rate = 0.5
+    monkeypatch.setattr("src.async_transaction_processor.random.random", lambda: 0.2)
+    trace = {
+        "type": "call",
+        "action": {
+            "from": "0x9008d19f58aabd9ed0d60971565aa8510560ab41",
+            "to": "0x" + "ab" * 20,
+            "value": "0x10",
+            "callType": "call",
+        },
+        "traceAddress": [0],
+    }
+    requests = []
+
+    async def node_request(method, *args):
+        requests.append(args)
+        return {"value": 0} if len(args) == 1 else [trace]
+
+    processor.node_request = node_request
+    events: dict[str, list[dict]] = {"WithdrawalWETH": [], "DepositWETH": []}
+
+    flow = asyncio.run(processor.get_eth_flow("0x01", events))
+
+    assert flow.outflow == 16
+    assert len(requests) == 2
+    assert processor.imbalances.trace_stats["verified"] == 1
+    assert processor.imbalances.trace_stats["mismatches"] == 1
@@ -0,0 +1,28 @@
+from unittest.mock import Mock
+
+from src import backfill
+from src.backfill import process_shard, split_range
+
+
+def test_split_range():
+    assert split_range(10, 34, 10) == [(10, 19), (20, 29), (30, 34)]
+    assert split_range(10, 10, 10) == [(10, 10)]
+
+
+def test_shard_is_completed_only_without_failures(monkeypatch):
+    processor = Mock()
+    processor.blockchain_data.fetch_tx_data.return_value = ["settlement"]
+    monkeypatch.setattr(backfill, "HEAD_TRACKING_MAX_RANGE", 100)
+    monkeypatch.setattr(backfill, "_processor", processor)
+
+    processor.process_batch.return_value = []
+    assert process_shard((0, 249)) == ((0, 249), 0)
+    assert [
+        call.args for call in processor.blockchain_data.fetch_tx_data.call_args_list
+    ] == [(0, 99), (100, 199), (200, 249)]
+    processor.db.write_backfill_shard.assert_called_once_with(0, 249)
+
+    processor.db.write_backfill_shard.reset_mock()
+    processor.process_batch.return_value = ["settlement"]
+    assert process_shard((0, 99)) == ((0, 99), 1)
+    processor.db.write_backfill_shard.assert_not_called()
@@ -0,0 +1,35 @@
+from unittest.mock import Mock
+
+from src.helpers.block_headers import BlockHeaderCache
+
+
+def make_web3() -> Mock:
+    web3 = Mock()
+    web3.eth.block_number = 1067
+    web3.eth.get_block.side_effect = lambda block_number: {
+        "number": block_number,
+        "timestamp": 12 * block_number,
+    }
+    return web3
+
+
+def test_headers_fetched_once():
+    web3 = make_web3()
+    cache = BlockHeaderCache()
+
+    for _ in range(10):
+        assert cache.get_timestamp(web3, 900) == 10800
+        assert cache.get_finalized_timestamp(web3) == 12000
+
+    # block 900 and the finalized head at block 1000
+    assert web3.eth.get_block.call_count == 2
+
+
+def test_blocks_after_finalized_head_are_not_cached():
+    web3 = make_web3()
+    cache = BlockHeaderCache(head_ttl=0)
+
+    cache.get_timestamp(web3, 1010)
+    cache.get_timestamp(web3, 1010)
+
+    assert [call.args[0] for call in web3.eth.get_block.call_args_list].count(1010) == 2
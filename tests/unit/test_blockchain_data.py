@@ -0,0 +1,122 @@
+from unittest.mock import Mock
+
+import pytest
+from hexbytes import HexBytes
+from web3 import Web3
+
+from src.constants import INVALIDATED_ORDER_TOPIC, SETTLEMENT_TOPIC, TRADE_TOPIC
+from src.helpers.blockchain_data import (
+    BlockchainData,
+    SettlementRecord,
+    is_logs_range_error,
+)
+
+
+def make_log(tx_hash: str, block_number: int, log_index: int, topic: str) -> dict:
+    return {
+        "transactionHash": HexBytes(tx_hash),
+        "blockNumber": block_number,
+        "logIndex": log_index,
+        "topics": [HexBytes(topic)],
+    }
+
+
+def test_get_tx_hashes_blocks_from_logs_shrinks_range():
+    tx_hash_1 = "0x" + "01" * 32
+    tx_hash_2 = "0x" + "02" * 32
+    tx_hash_3 = "0x" + "03" * 32
+    logs = [
+        make_log(tx_hash_2, 120, 3, SETTLEMENT_TOPIC),
+        make_log(tx_hash_1, 100, 0, SETTLEMENT_TOPIC),
+        make_log(tx_hash_3, 150, 1, SETTLEMENT_TOPIC),
+        make_log(tx_hash_3, 150, 0, INVALIDATED_ORDER_TOPIC),
+    ]
+
+    def get_logs(filter_params):
+        if filter_params["toBlock"] - filter_params["fromBlock"] >= 50:
+            raise ValueError("query returned more than 10000 results")
+        return [
+            log
+            for log in logs
+            if filter_params["fromBlock"]
+            <= log["blockNumber"]
+            <= filter_params["toBlock"]
+        ]
+
+    web3 = Mock()
+    web3.eth.get_logs.side_effect = get_logs
+    blockchain = BlockchainData(web3, "logs")
+
+    res = blockchain.get_tx_hashes_blocks(100, 199)
+
+    assert res == [(tx_hash_1, 100), (tx_hash_2, 120)]
+
+
+def test_get_settlement_logs_raises_unrelated_errors():
+    web3 = Mock()
+    web3.eth.get_logs.side_effect = ValueError("connection refused")
+    blockchain = BlockchainData(web3, "logs")
+
+    with pytest.raises(ValueError):
+        blockchain.get_settlement_logs(100, 199)
+
+
+def test_fetch_tx_data_builds_settlement_records():
+    tx_hash = "0x" + "01" * 32
+    solver = "0x" + "ab" * 20
+    settlement_log = make_log(tx_hash, 100, 2, SETTLEMENT_TOPIC)
+    settlement_log["topics"].append(
+        HexBytes(bytes.fromhex(solver[2:]).rjust(32, b"\0"))
+    )
+    trade_log = make_log(tx_hash, 100, 1, TRADE_TOPIC)
+    for log in (settlement_log, trade_log):
+        log["transactionIndex"] = 7
+    web3 = Mock()
+    web3.eth.get_logs.return_value = [trade_log, settlement_log]
+    blockchain = BlockchainData(web3, "logs")
+    blockchain.batch = Mock()
+
+    res = blockchain.fetch_tx_data(100, 100)
+
+    # the auction id is decoded when the settlement is processed
+    assert res == [
+        SettlementRecord(tx_hash, 100, 7, None, Web3.to_checksum_address(solver))
+    ]
+    blockchain.batch.get_transactions.assert_not_called()
+
+
+def test_logs_range_errors_are_provider_specific():
+    assert is_logs_range_error(ValueError("query returned more than 10000 results"))
+    assert is_logs_range_error(
+        ValueError({"code": -32602, "message": "Log response size exceeded."})
+    )
+    assert not is_logs_range_error(ValueError("rate limit exceeded"))
+    assert not is_logs_range_error(ValueError("block number out of range"))
+
+
+def test_settlement_receipts_are_fetched_with_fast_rpc():
+    receipts_by_hash = {
+        "0x" + f"{i:02x}" * 32: {"transactionHash": bytes([i]) * 32}
+        for i in range(1, 4)
+    }
+    tx_hash_1, tx_hash_2, tx_hash_3 = receipts_by_hash
+    fast_rpc = Mock()
+    fast_rpc.get_block_receipts.return_value = [
+        [receipts_by_hash[tx_hash_1], receipts_by_hash[tx_hash_3]]
+    ]
+    fast_rpc.get_transaction_receipts.return_value = {
+        tx_hash_2: receipts_by_hash[tx_hash_2]
+    }
+    blockchain = BlockchainData(Mock(), "logs", fast_rpc)
+    blockchain.batch = Mock()
+
+    receipts = blockchain.get_settlement_receipts(
+        [(tx_hash_1, 10), (tx_hash_3, 10), (tx_hash_2, 11)]
+    )
+
+    assert receipts == receipts_by_hash
+    # receipts are only fetched with the fast RPC client, which caches them for prefetch()
+    fast_rpc.get_block_receipts.assert_called_once_with([10])
+    fast_rpc.get_transaction_receipts.assert_called_once_with([tx_hash_2])
+    blockchain.batch.execute.assert_not_called()
+    blockchain.batch.get_transaction_receipts.assert_not_called()
@@ -0,0 +1,85 @@
+from unittest.mock import Mock
+
+from hexbytes import HexBytes
+
+from src.constants import SETTLEMENT_CONTRACT_ADDRESS
+from src.helpers.eth_flows import EthFlowTracer, eth_flows_by_transaction
+
+OTHER_ADDRESS = "0x" + "ab" * 20
+
+
+def make_trace(
+    tx_hash: str, sender: str, recipient: str, value: int, trace_address: list
+) -> dict:
+    return {
+        "action": {"from": sender, "to": recipient, "value": value},
+        "transactionHash": HexBytes(tx_hash),
+        "traceAddress": trace_address,
+    }
+
+
+def test_eth_flows_by_transaction():
+    tx_hash_1 = "0x" + "01" * 32
+    tx_hash_2 = "0x" + "02" * 32
+    traces = [
+        make_trace(tx_hash_1, OTHER_ADDRESS, SETTLEMENT_CONTRACT_ADDRESS, 0, []),
+        make_trace(tx_hash_1, OTHER_ADDRESS, SETTLEMENT_CONTRACT_ADDRESS, 5, [0]),
+        make_trace(tx_hash_1, SETTLEMENT_CONTRACT_ADDRESS, OTHER_ADDRESS, 2, [1]),
+        make_trace(tx_hash_2, OTHER_ADDRESS, OTHER_ADDRESS, 7, []),
+        # block reward
+        {"action": {"author": OTHER_ADDRESS, "value": 1}, "type": "reward"},
+    ]
+
+    flows = eth_flows_by_transaction(traces)
+
+    assert flows.keys() == {tx_hash_1, tx_hash_2}
+    assert (flows[tx_hash_1].imbalance, flows[tx_hash_1].actions) == (3, 3)
+    assert (flows[tx_hash_2].imbalance, flows[tx_hash_2].actions) == (0, 0)
+
+
+def test_from_filter_counts_frames_once():
+    tx_hash = "0x" + "01" * 32
+    traces = [
+        make_trace(tx_hash, SETTLEMENT_CONTRACT_ADDRESS, OTHER_ADDRESS, 2, [0]),
+        make_trace(
+            tx_hash, SETTLEMENT_CONTRACT_ADDRESS, SETTLEMENT_CONTRACT_ADDRESS, 4, [1]
+        ),
+        make_trace(tx_hash, OTHER_ADDRESS, SETTLEMENT_CONTRACT_ADDRESS, 9, [2]),
+    ]
+
+    def trace_filter(params):
+        if "fromAddress" in params:
+            return [t for t in traces if t["action"]["from"] in params["fromAddress"]]
+        return [t for t in traces if t["action"]["to"] in params["toAddress"]]
+
+    web3 = Mock()
+    web3.tracing.trace_filter.side_effect = trace_filter
+
+    flows = EthFlowTracer(web3).from_filter(1, 10)
+
+    assert flows[tx_hash].inflow == 13
+    assert flows[tx_hash].outflow == 6
+    assert flows[tx_hash].actions == 3
+
+
+def test_from_filter_requests_all_pages():
+    traces = [
+        make_trace(
+            "0x" + f"{i:02x}" * 32, OTHER_ADDRESS, SETTLEMENT_CONTRACT_ADDRESS, 1, []
+        )
+        for i in range(5)
+    ]
+
+    def trace_filter(params):
+        if "fromAddress" in params:
+            return []
+        return traces[params["after"] : params["after"] + params["count"]]
+
+    web3 = Mock()
+    web3.tracing.trace_filter.side_effect = trace_filter
+
+    flows = EthFlowTracer(web3, page_size=2).from_filter(1, 10)
+
+    assert len(flows) == 5
+    # 1 page for fromAddress, 3 pages for toAddress
+    assert web3.tracing.trace_filter.call_count == 4
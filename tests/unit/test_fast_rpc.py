@@ -0,0 +1,82 @@
+from unittest.mock import Mock
+
+from src.helpers.fast_rpc import FastRPCClient, RPCError
+
+TX_HASH_1 = "0x" + "01" * 32
+TX_HASH_2 = "0x" + "02" * 32
+
+
+def make_receipt(tx_hash: str) -> dict:
+    return {
+        "transactionHash": tx_hash,
+        "blockNumber": "0x10",
+        "transactionIndex": "0x1",
+        "from": "0x" + "AB" * 20,
+        "to": None,
+        "status": "0x1",
+        "logs": [
+            {
+                "address": "0x" + "CD" * 20,
+                "topics": ["0x" + "ee" * 32],
+                "data": "0x0a",
+                "blockNumber": "0x10",
+                "transactionHash": tx_hash,
+                "transactionIndex": "0x1",
+                "logIndex": "0x3",
+            }
+        ],
+    }
+
+
+def test_batch_request_decodes_and_caches_receipts():
+    client = FastRPCClient("http://localhost:8545")
+    client._post = Mock(
+        return_value=[
+            {"jsonrpc": "2.0", "id": 1, "error": {"code": -32000, "message": "fail"}},
+            {"jsonrpc": "2.0", "id": 0, "result": make_receipt(TX_HASH_1)},
+        ]
+    )
+
+    receipts = client.get_transaction_receipts([TX_HASH_1, TX_HASH_2])
+
+    assert isinstance(receipts[TX_HASH_2], RPCError)
+    receipt = receipts[TX_HASH_1]
+    assert receipt["blockNumber"] == 16
+    assert receipt["from"] == "0x" + "ab" * 20
+    assert receipt["logs"][0]["topics"] == [bytes.fromhex("ee" * 32)]
+    assert receipt["logs"][0]["data"] == b"\n"
+    assert receipt["logs"][0]["logIndex"] == 3
+
+    # only the failed receipt is requested again
+    client._post.return_value = [
+        {"jsonrpc": "2.0", "id": 0, "result": make_receipt(TX_HASH_2)}
+    ]
+    receipts = client.get_transaction_receipts([TX_HASH_1, TX_HASH_2])
+    assert client._post.call_args.args[0][0]["params"] == [TX_HASH_2]
+    assert receipts[TX_HASH_2]["transactionHash"] == bytes.fromhex("02" * 32)
+
+
+def test_block_receipts_of_settlements_are_cached():
+    client = FastRPCClient("http://localhost:8545")
+    settlement_receipt = make_receipt(TX_HASH_1)
+    settlement_receipt["to"] = "0x9008D19f58AAbD9eD0D60971565AA8510560ab41"
+    client._post = Mock(
+        return_value=[
+            {
+                "jsonrpc": "2.0",
+                "id": 0,
+                "result": [settlement_receipt, make_receipt(TX_HASH_2)],
+            }
+        ]
+    )
+
+    [block_receipts] = client.get_block_receipts([16])
+
+    assert client._post.call_args.args[0][0]["params"] == ["0x10"]
+    assert len(block_receipts) == 2
+    # the settlement receipt is answered from the cache, the other one is requested
+    client._post.return_value = [
+        {"jsonrpc": "2.0", "id": 0, "result": make_receipt(TX_HASH_2)}
+    ]
+    client.get_transaction_receipts([TX_HASH_1, TX_HASH_2])
+    assert client._post.call_args.args[0][0]["params"] == [TX_HASH_2]
@@ -0,0 +1,81 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+
+from src.constants import FINALIZATION_DEPTH
+from src.helpers import head_tracker
+from src.helpers.head_tracker import HeadTracker
+
+
+def make_web3(heads):
+    """Mock web3 returning the given heads for "latest", with 5 second blocks."""
+    web3 = Mock()
+    heads = iter(heads)
+
+    def get_block(block):
+        if block == "latest":
+            number = next(heads)
+        else:
+            number = block
+        return {"number": number, "timestamp": 5 * number}
+
+    web3.eth.get_block.side_effect = get_block
+    return web3
+
+
+def test_ranges_are_handed_out_without_waiting_while_lagging(monkeypatch):
+    sleep = Mock()
+    monkeypatch.setattr(head_tracker.time, "sleep", sleep)
+    web3 = make_web3([1000 + FINALIZATION_DEPTH])
+    tracker = HeadTracker(web3, max_range=400)
+
+    assert tracker.next_range(1) == (1, 400)
+    assert tracker.next_range(401) == (401, 800)
+    assert tracker.next_range(801) == (801, 1000)
+    # the head is requested once for all ranges
+    assert web3.eth.get_block.call_count == 1
+    sleep.assert_not_called()
+
+
+def test_waits_for_next_block_when_caught_up(monkeypatch):
+    sleep = Mock()
+    monkeypatch.setattr(head_tracker.time, "sleep", sleep)
+    head = 1000 + FINALIZATION_DEPTH
+    monkeypatch.setattr(head_tracker.time, "time", lambda: 5 * head + 2)
+    # heads of the first poll, the block time estimate and the second poll
+    tracker = HeadTracker(make_web3([head, head, head + 1]))
+
+    assert tracker.next_range(1001) == (1001, 1001)
+    assert tracker.block_time == 5
+    # the block is due 3 seconds after the last poll
+    sleep.assert_called_once_with(3)
+
+
+def test_invalid_mode():
+    with pytest.raises(ValueError):
+        HeadTracker(Mock(), "sleep")
+    with pytest.raises(ValueError):
+        HeadTracker(Mock(), "subscribe")
+
+
+def test_subscription_is_renewed_with_backoff(monkeypatch):
+    monkeypatch.setattr(
+        head_tracker, "AsyncWeb3", Mock(side_effect=ConnectionError("refused"))
+    )
+    monkeypatch.setattr(head_tracker, "WebSocketProvider", Mock())
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 8:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(head_tracker.asyncio, "sleep", sleep)
+    tracker = HeadTracker(Mock(), "subscribe", "ws://localhost:8546")
+
+    with pytest.raises(KeyboardInterrupt):
+        asyncio.run(tracker.subscribe())
+
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+    assert head_tracker.AsyncWeb3.call_count == 8
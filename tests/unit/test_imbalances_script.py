@@ -0,0 +1,94 @@
+from unittest.mock import Mock
+
+from web3 import Web3
+
+from src.constants import SETTLEMENT_CONTRACT_ADDRESS, WETH_TOKEN_ADDRESS
+from src.helpers.eth_flows import EthFlow
+from src.imbalances_script import RawTokenImbalances
+
+TX_HASH = "0x" + "01" * 32
+
+
+def make_imbalances(trace_verification_rate: float) -> RawTokenImbalances:
+    web3 = Mock()
+    web3.keccak = Web3.keccak
+    web3.eth.get_transaction.return_value = {"value": 0}
+    web3.eth.get_transaction_receipt.return_value = {"logs": []}
+    imbalances = RawTokenImbalances(
+        web3,
+        "mainnet",
+        lazy_traces=True,
+        trace_verification_rate=trace_verification_rate,
+    )
+    imbalances.get_eth_flow = Mock(return_value=EthFlow(inflow=1, actions=1))
+    return imbalances
+
+
+def test_lazy_traces_skip_trace():
+    imbalances = make_imbalances(trace_verification_rate=0.0)
+
+    assert imbalances.compute_imbalances(TX_HASH) == {}
+    imbalances.get_eth_flow.assert_not_called()
+    assert imbalances.trace_stats == {"skipped": 1, "verified": 0, "mismatches": 0}
+
+
+def test_lazy_traces_verification_detects_mismatch():
+    imbalances = make_imbalances(trace_verification_rate=1.0)
+
+    imbalances.compute_imbalances(TX_HASH)
+
+    imbalances.get_eth_flow.assert_called_once_with(TX_HASH)
+    assert imbalances.trace_stats == {"skipped": 1, "verified": 1, "mismatches": 1}
+
+
+def test_extract_events_classifies_logs():
+    imbalances = make_imbalances(trace_verification_rate=0.0)
+    transfer = {"topics": [Web3.keccak(text="Transfer(address,address,uint256)")]}
+    erc20_transfer = {
+        "topics": [Web3.keccak(text="ERC20Transfer(address,address,uint256)")]
+    }
+    withdrawal = {"topics": [Web3.keccak(text="Withdrawal(address,uint256)")]}
+    unrelated = {"topics": [Web3.keccak(text="Approval(address,address,uint256)")]}
+    anonymous: dict = {"topics": []}
+
+    events = imbalances.extract_events(
+        {"logs": [transfer, unrelated, erc20_transfer, anonymous, withdrawal]}
+    )
+
+    assert events["Transfer"] == [transfer, erc20_transfer]
+    assert events["WithdrawalWETH"] == [withdrawal]
+    assert events["ERC20Transfer"] == events["DepositWETH"] == []
+
+
+def test_compute_imbalances_returns_checksummed_addresses():
+    imbalances = make_imbalances(trace_verification_rate=0.0)
+    token = "0x" + "ab" * 20
+    other = bytes.fromhex("cd" * 20).rjust(32, b"\0")
+    settlement = bytes.fromhex(SETTLEMENT_CONTRACT_ADDRESS[2:]).rjust(32, b"\0")
+    transfer_topic = Web3.keccak(text="Transfer(address,address,uint256)")
+    imbalances.web3.eth.get_transaction_receipt.return_value = {
+        "logs": [
+            {
+                "address": token,
+                "topics": [transfer_topic, other, settlement],
+                "data": (10).to_bytes(32, "big"),
+            },
+            {
+                "address": token,
+                "topics": [transfer_topic, settlement, other],
+                "data": (4).to_bytes(32, "big"),
+            },
+            {
+                "address": WETH_TOKEN_ADDRESS,
+                "topics": [Web3.keccak(text="Withdrawal(address,uint256)"), settlement],
+                "data": (3).to_bytes(32, "big"),
+            },
+        ]
+    }
+    imbalances.get_eth_flow.return_value = EthFlow(inflow=3, actions=1)
+
+    assert imbalances.compute_imbalances(TX_HASH) == {
+        Web3.to_checksum_address(token): 6,
+        WETH_TOKEN_ADDRESS: -3,
+        "0xEeeeeEeeeEeEeeEeEeEeeEEEeeeeEeeeeeeeEEeE": 3,
+    }
@@ -0,0 +1,59 @@
+import time
+from unittest.mock import Mock
+
+from src.helpers.blockchain_data import SettlementRecord
+from src.pipeline_processor import PipelineItem, PipelineProcessor
+
+
+def mock_db() -> Mock:
+    """Database mock without stored token decimals."""
+    db = Mock()
+    db.get_token_decimals.return_value = {}
+    return db
+
+
+def test_results_are_persisted_in_discovery_order():
+    db = mock_db()
+    processor = PipelineProcessor(
+        Mock(),
+        db,
+        "mainnet",
+        True,
+        False,
+        False,
+        stage_workers={"fetch": 1, "compute": 3, "price": 3},
+        stage_queue_sizes={"fetch": 1, "compute": 2, "price": 2, "persist": 2},
+    )
+    written = []
+
+    def compute(item):
+        if item.seq == 1:
+            raise ValueError("node error")
+        # later settlements finish first
+        time.sleep(0.01 * (3 - item.seq))
+        return [item]
+
+    processor.prefetch_chain_data = Mock()
+    processor.stages["compute"].handler = compute
+    processor.stages["price"].handler = lambda item: [item]
+    processor.write_settlement_results = lambda results, checkpoint: written.append(
+        (results[0].settlement.tx_hash, checkpoint)
+    )
+    for stage in processor.stages.values():
+        stage.start()
+
+    items = [
+        PipelineItem(i, SettlementRecord(f"0x0{i}", 10 + i, 0, i)) for i in range(3)
+    ]
+    items[-1].checkpoint = 15
+    processor.stages["fetch"].put(items)
+    for stage in processor.stages.values():
+        stage.queue.join()
+
+    # the checkpoint is written with the last results and stops before the failed settlement
+    assert written == [("0x00", None), ("0x02", 10)]
+    assert processor.retries.min_block() == 11
+    stats = processor.stats()
+    assert stats["compute"]["processed"] == 3
+    assert stats["compute"]["errors"] == 1
+    assert stats["persist"]["queue"] == 0
@@ -0,0 +1,58 @@
+from unittest.mock import Mock
+
+from src.helpers import retry_scheduler
+from src.helpers.blockchain_data import SettlementRecord
+from src.helpers.retry_scheduler import RetryScheduler
+
+
+def test_backoff_grows_exponentially_up_to_max_delay():
+    scheduler = RetryScheduler(Mock(), 10, 10, 100)
+    for attempts, delay in [(1, 10), (2, 20), (3, 40), (4, 80), (5, 100), (8, 100)]:
+        assert delay / 2 <= scheduler.delay(attempts) <= delay
+
+
+def test_settlements_are_retried_then_dead_lettered(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry_scheduler.time, "time", lambda: now[0])
+    db = Mock()
+    scheduler = RetryScheduler(db, 3, 10, 100)
+    failing = SettlementRecord("0x01", 15, 0, 1)
+    succeeding = SettlementRecord("0x02", 16, 0, 2)
+
+    scheduler.record([failing, succeeding], [(failing, ValueError("no trace"))])
+    assert len(scheduler) == 1
+    assert scheduler.min_block() == 15
+    # not due before the backoff delay
+    assert scheduler.due() == []
+    now[0] += 10
+    assert scheduler.due() == [failing]
+    assert scheduler.due() == []
+
+    scheduler.record([failing], [(failing, ValueError("no trace"))])
+    now[0] += 20
+    assert scheduler.due() == [failing]
+    db.write_failed_transaction.assert_not_called()
+
+    scheduler.record([failing], [(failing, ValueError("no trace"))])
+    db.write_failed_transaction.assert_called_once_with(failing, 3, "no trace")
+    assert len(scheduler) == 0
+    assert scheduler.min_block() is None
+
+
+def test_success_resets_attempts():
+    scheduler = RetryScheduler(Mock(), 3, 0, 0)
+    settlement = SettlementRecord("0x01", 15, 0, 1)
+    scheduler.record([settlement], [(settlement, ValueError())])
+    scheduler.record(scheduler.due(), [])
+    assert len(scheduler) == 0
+
+
+def test_min_block_includes_due_settlements():
+    scheduler = RetryScheduler(Mock(), 3, 0, 0)
+    settlement = SettlementRecord("0x01", 15, 0, 1)
+    scheduler.record([settlement], [(settlement, ValueError())])
+    # still being retried until its outcome is recorded
+    assert scheduler.due() == [settlement]
+    assert scheduler.min_block() == 15
+    scheduler.record([settlement], [])
+    assert scheduler.min_block() is None
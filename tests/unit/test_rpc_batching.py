@@ -0,0 +1,86 @@
+import sys
+import threading
+
+from web3 import Web3
+from web3.exceptions import Web3RPCError
+
+from src.helpers.http_provider import ThreadSafeHTTPProvider
+from src.helpers.rpc_batching import BatchRPCClient
+
+
+def test_batch_client_maps_errors_per_item():
+    web3 = Web3(Web3.HTTPProvider("http://localhost:8545"))
+    batch_sizes = []
+
+    def make_batch_request(requests):
+        batch_sizes.append(len(requests))
+        responses = []
+        for i, (_, params) in enumerate(requests):
+            if params[0] == "0x2":
+                responses.append(
+                    {"jsonrpc": "2.0", "id": i, "error": {"code": -1, "message": "x"}}
+                )
+            else:
+                responses.append(
+                    {
+                        "jsonrpc": "2.0",
+                        "id": i,
+                        "result": {"number": params[0], "timestamp": "0x10"},
+                    }
+                )
+        return responses
+
+    web3.provider.make_batch_request = make_batch_request
+    batch = BatchRPCClient(web3, max_batch_size=2)
+
+    blocks = batch.get_blocks([1, 2, 3])
+
+    assert batch_sizes == [2, 1]
+    assert blocks[1]["timestamp"] == 16
+    assert isinstance(blocks[2], Web3RPCError)
+    assert blocks[3]["timestamp"] == 16
+
+
+def test_batches_and_calls_of_concurrent_stages_do_not_mix():
+    web3 = Web3(ThreadSafeHTTPProvider("http://localhost:8545"))
+
+    def block(number: str) -> dict:
+        return {"number": number, "timestamp": number}
+
+    web3.provider.make_request = lambda method, params: {
+        "jsonrpc": "2.0",
+        "id": 0,
+        "result": block(params[0]),
+    }
+    web3.provider.make_batch_request = lambda requests: [
+        {"jsonrpc": "2.0", "id": i, "result": block(params[0])}
+        for i, (_, params) in enumerate(requests)
+    ]
+    batch = BatchRPCClient(web3, max_batch_size=10)
+    errors: list[str] = []
+
+    def fetch_stage() -> None:
+        for i in range(200):
+            numbers = list(range(10 * i, 10 * i + 10))
+            for number, result in batch.get_blocks(numbers).items():
+                if isinstance(result, Exception) or result["timestamp"] != number:
+                    errors.append(f"batch {number}: {result}")
+
+    def compute_stage() -> None:
+        for number in range(2000):
+            result = web3.eth.get_block(number)
+            # while another thread batches, a plain provider returns the request instead
+            if isinstance(result, tuple) or result["timestamp"] != number:
+                errors.append(f"call {number}: {result}")
+
+    stages = [threading.Thread(target=stage) for stage in [fetch_stage, compute_stage]]
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
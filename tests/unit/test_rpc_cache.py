@@ -0,0 +1,105 @@
+import asyncio
+
+from web3 import AsyncWeb3, Web3
+
+from src.helpers.rpc_batching import BatchRPCClient
+from src.constants import SETTLEMENT_CONTRACT_ADDRESS
+from src.helpers.rpc_cache import LRUCache, add_cache_middleware
+
+
+def make_web3(requests: list) -> Web3:
+    web3 = Web3(Web3.HTTPProvider("http://localhost:8545"))
+
+    def response(method, params, request_id=0):
+        requests.append((method, params))
+        return {
+            "jsonrpc": "2.0",
+            "id": request_id,
+            "result": {"number": "0x1", "timestamp": "0x10"},
+        }
+
+    web3.provider.make_request = response
+    web3.provider.make_batch_request = lambda batch: [
+        response(method, params, i) for i, (method, params) in enumerate(batch)
+    ]
+    return web3
+
+
+def test_cache_middleware_shares_responses():
+    requests: list = []
+    cache = LRUCache(max_size=2)
+    web3 = add_cache_middleware(make_web3(requests), cache)
+
+    BatchRPCClient(web3).get_blocks([1, 2])
+    assert web3.eth.get_block(1)["timestamp"] == 16
+    assert web3.eth.get_block(2)["timestamp"] == 16
+    assert len(requests) == 2
+    assert cache.stats() == {"hits": 2, "misses": 2, "entries": 2}
+
+    # block 3 evicts the least recently used block 1
+    web3.eth.get_block(3)
+    web3.eth.get_block(1)
+    assert len(requests) == 4
+
+
+def test_cache_middleware_ignores_block_tags():
+    requests: list = []
+    web3 = add_cache_middleware(make_web3(requests), LRUCache(max_size=10))
+
+    web3.eth.get_block("latest")
+    web3.eth.get_block("latest")
+
+    assert len(requests) == 2
+
+
+def test_block_receipts_fill_receipt_cache():
+    requests: list = []
+    cache = LRUCache(max_size=10)
+    web3 = add_cache_middleware(make_web3(requests), cache)
+    settlement_hash = "0x" + "11" * 32
+    other_hash = "0x" + "22" * 32
+    receipt = {
+        "transactionHash": settlement_hash,
+        "blockNumber": "0x1",
+        "to": SETTLEMENT_CONTRACT_ADDRESS.lower(),
+        "logs": [],
+    }
+
+    middleware = web3.middleware_onion.get("rpc_cache")(web3)
+    middleware.store(
+        "eth_getBlockReceipts",
+        ["0x1"],
+        {
+            "jsonrpc": "2.0",
+            "id": 0,
+            "result": [receipt, {**receipt, "transactionHash": other_hash, "to": None}],
+        },
+    )
+
+    assert cache.stats()["entries"] == 1
+    assert middleware.lookup("eth_getTransactionReceipt", [settlement_hash]) == {
+        "jsonrpc": "2.0",
+        "id": 0,
+        "result": receipt,
+    }
+    assert middleware.lookup("eth_getTransactionReceipt", [other_hash]) is None
+
+
+def test_cache_middleware_shares_responses_with_async_web3():
+    requests: list = []
+    cache = LRUCache(max_size=10)
+    BatchRPCClient(add_cache_middleware(make_web3(requests), cache)).get_blocks([1])
+    async_web3 = add_cache_middleware(
+        AsyncWeb3(AsyncWeb3.AsyncHTTPProvider("http://localhost:8545")), cache
+    )
+
+    async def make_request(method, params):
+        requests.append((method, params))
+        return {"jsonrpc": "2.0", "id": 0, "result": {"number": "0x2"}}
+
+    async_web3.provider.make_request = make_request
+
+    assert asyncio.run(async_web3.eth.get_block(1))["timestamp"] == 16
+    assert asyncio.run(async_web3.eth.get_block(2))["number"] == 2
+    assert [method for method, _ in requests] == ["eth_getBlockByNumber"] * 2
+    assert cache.stats()["hits"] == 1
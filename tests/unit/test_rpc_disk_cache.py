@@ -0,0 +1,95 @@
+from web3 import Web3
+
+from src.helpers import rpc_disk_cache
+from src.helpers.rpc_disk_cache import (
+    DiskCache,
+    add_disk_cache_middleware,
+    get_disk_cache,
+)
+
+
+def make_web3(requests: list, head: int, chain_id: int = 1) -> Web3:
+    web3 = Web3(Web3.HTTPProvider("http://localhost:8545"))
+
+    def make_request(method, params):
+        if method == "eth_chainId":
+            return {"jsonrpc": "2.0", "id": 0, "result": hex(chain_id)}
+        requests.append(method)
+        if method == "eth_blockNumber":
+            return {"jsonrpc": "2.0", "id": 0, "result": hex(head)}
+        return {
+            "jsonrpc": "2.0",
+            "id": 0,
+            "result": {"number": params[0], "timestamp": hex(chain_id)},
+        }
+
+    web3.provider.make_request = make_request
+    return web3
+
+
+def test_disk_cache_persists_finalized_blocks(tmp_path):
+    path = str(tmp_path / "rpc_cache.sqlite")
+    requests: list = []
+    web3 = add_disk_cache_middleware(make_web3(requests, head=1000), path)
+
+    web3.eth.get_block(100)
+    web3.eth.get_block(990)  # not finalized
+    assert requests == [
+        "eth_getBlockByNumber",
+        "eth_blockNumber",
+        "eth_getBlockByNumber",
+    ]
+
+    # a new instance with a new provider reads finalized data from disk
+    requests.clear()
+    web3 = add_disk_cache_middleware(make_web3(requests, head=1000), path)
+    assert web3.eth.get_block(100)["timestamp"] == 1
+    web3.eth.get_block(990)
+    assert requests == ["eth_getBlockByNumber"]
+
+
+def test_disk_cache_shared_by_chains(tmp_path):
+    path = str(tmp_path / "rpc_cache.sqlite")
+    mainnet_requests: list = []
+    mainnet = add_disk_cache_middleware(make_web3(mainnet_requests, 1000), path)
+    gnosis_requests: list = []
+    gnosis = add_disk_cache_middleware(make_web3(gnosis_requests, 200, 100), path)
+
+    assert mainnet.eth.get_block(100)["timestamp"] == 1
+    # not served from the mainnet response, and finalized according to the gnosis head
+    assert gnosis.eth.get_block(100)["timestamp"] == 100
+    gnosis.eth.get_block(500)  # not finalized on gnosis
+    assert gnosis_requests == [
+        "eth_getBlockByNumber",
+        "eth_blockNumber",
+        "eth_getBlockByNumber",
+    ]
+    gnosis_requests.clear()
+    assert gnosis.eth.get_block(100)["timestamp"] == 100
+    gnosis.eth.get_block(500)
+    assert gnosis_requests == ["eth_getBlockByNumber"]
+
+
+def test_disk_cache_size_limit(tmp_path):
+    cache = DiskCache(str(tmp_path / "rpc_cache.sqlite"), max_bytes=1000)
+    for i in range(100):
+        cache.put(bytes([i]), {"data": "0x" + f"{i:02x}" * 50})
+
+    assert cache.size <= 1000
+    assert cache.get(bytes([0])) is None
+    assert cache.get(bytes([99])) == {"data": "0x" + "63" * 50}
+
+
+def test_disk_cache_path_read_on_use(tmp_path, monkeypatch):
+    # set after the module is imported, like values loaded from .env
+    monkeypatch.setenv("RPC_DISK_CACHE_PATH", str(tmp_path / "rpc_cache.sqlite"))
+    web3 = add_disk_cache_middleware(make_web3([], head=1000))
+    assert "rpc_disk_cache" in web3.middleware_onion
+
+
+def test_disk_cache_opened_again_after_fork(tmp_path, monkeypatch):
+    path = str(tmp_path / "rpc_cache.sqlite")
+    cache = get_disk_cache(path)
+    assert get_disk_cache(path) is cache
+    monkeypatch.setattr(rpc_disk_cache.os, "getpid", lambda: -1)
+    assert get_disk_cache(path) is not cache
@@ -0,0 +1,73 @@
+from unittest.mock import Mock
+
+import pytest
+from requests.exceptions import ReadTimeout
+from web3.exceptions import ContractLogicError
+
+from src.helpers.token_decimals_registry import TokenDecimalsRegistry
+
+USDC = "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48"
+USDT = "0xdac17f958d2ee523a2206206994597c13d831ec7"
+WETH = "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"
+NO_DECIMALS = "0x0000000000000000000000000000000000000001"
+
+
+def make_web3(multicall_results=None, error=None) -> Mock:
+    web3 = Mock()
+    aggregate3 = web3.eth.contract.return_value.functions.aggregate3
+    aggregate3.return_value.call.return_value = multicall_results
+    aggregate3.return_value.call.side_effect = error
+    return web3
+
+
+def test_preloaded_decimals_need_no_calls():
+    web3 = make_web3()
+    registry = TokenDecimalsRegistry()
+    registry.load({USDC: 6})
+    assert registry.get(web3, "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48") == 6
+    web3.eth.contract.assert_not_called()
+    assert registry.get_unpersisted() == []
+
+
+def test_missing_decimals_are_fetched_in_one_multicall():
+    web3 = make_web3(
+        [
+            (False, b""),
+            (True, (18).to_bytes(32, "big")),
+            (True, (6).to_bytes(32, "big")),
+        ]
+    )
+    registry = TokenDecimalsRegistry()
+    registry.load({USDC: 6})
+
+    decimals = registry.resolve(web3, [USDC, WETH, NO_DECIMALS, USDT])
+
+    assert decimals == {USDC: 6, USDT: 6, WETH: 18}
+    calls = web3.eth.contract.return_value.functions.aggregate3.call_args.args[0]
+    assert [call[0].lower() for call in calls] == [NO_DECIMALS, WETH, USDT]
+    assert registry.get_unpersisted() == [(WETH, 18), (USDT, 6)]
+    registry.mark_persisted([(WETH, 18)])
+    assert registry.get_unpersisted() == [(USDT, 6)]
+    # tokens without decimals are not requested again
+    assert registry.get(web3, NO_DECIMALS) is None
+    assert web3.eth.contract.return_value.functions.aggregate3.call_count == 1
+
+
+def test_single_calls_if_multicall_fails():
+    web3 = make_web3(error=ContractLogicError("execution reverted"))
+    web3.eth.contract.return_value.functions.decimals.return_value.call.return_value = 8
+    registry = TokenDecimalsRegistry()
+    assert registry.resolve(web3, [USDC, WETH]) == {USDC: 8, WETH: 8}
+
+
+def test_transport_errors_do_not_mark_tokens_unresolvable():
+    web3 = make_web3(error=ReadTimeout("timeout"))
+    registry = TokenDecimalsRegistry()
+    with pytest.raises(ReadTimeout):
+        registry.resolve(web3, [USDC])
+    web3.eth.contract.return_value.functions.decimals.assert_not_called()
+
+    aggregate3 = web3.eth.contract.return_value.functions.aggregate3
+    aggregate3.return_value.call.side_effect = None
+    aggregate3.return_value.call.return_value = [(True, (6).to_bytes(32, "big"))]
+    assert registry.resolve(web3, [USDC]) == {USDC: 6}
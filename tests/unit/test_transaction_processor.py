@@ -0,0 +1,175 @@
+from unittest.mock import Mock
+
+import pytest
+
+from src.helpers.blockchain_data import SettlementRecord
+from src.helpers.database import SettlementResult
+from src.helpers.retry_scheduler import RetryScheduler
+from src.helpers.token_decimals_registry import TokenDecimalsRegistry
+from src.helpers.write_buffer import WriteBuffer
+from src.transaction_processor import TransactionProcessor
+
+
+def mock_db() -> Mock:
+    """Database mock without stored token decimals."""
+    db = Mock()
+    db.get_token_decimals.return_value = {}
+    return db
+
+
+def test_start_block_from_checkpoint():
+    blockchain_data = Mock()
+    db = mock_db()
+    db.get_checkpoint.return_value = 100
+    processor = TransactionProcessor(blockchain_data, db, "mainnet", True, False, False)
+
+    assert processor.get_start_block() == 101
+    db.get_checkpoint.assert_called_once_with("daemon")
+    # no requests to the node and no scan of transaction_timestamp
+    blockchain_data.get_latest_block.assert_not_called()
+    blockchain_data.web3.eth.get_transaction_receipt.assert_not_called()
+    db.get_latest_transaction.assert_not_called()
+
+
+def test_checkpoint_stops_before_settlements_scheduled_for_retry():
+    db = mock_db()
+    processor = TransactionProcessor(Mock(), db, "mainnet", True, False, False)
+    processor.retries = RetryScheduler(db, 3, 0, 0)
+    processor.head_tracker = Mock()
+    processor.head_tracker.next_range.side_effect = [(10, 20), (21, 30)]
+    settlement = SettlementRecord("0x01", 15, 0, 1)
+    processor.blockchain_data.fetch_tx_data.side_effect = [[settlement], []]
+    processor.prefetch_chain_data = Mock()
+    processor.compute_settlement_result = Mock(
+        side_effect=[
+            ValueError(),
+            SettlementResult(settlement, {}, (settlement.tx_hash, 0), [], []),
+        ]
+    )
+    # stop the daemon loop after the second iteration
+    db.write_settlement_results.side_effect = KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        processor.process(10)
+
+    # the checkpoint is written on its own after the failure, and with the results of the
+    # settlement when it is retried in the second iteration
+    db.write_checkpoint.assert_called_once_with("daemon", 14)
+    assert db.write_settlement_results.call_args.args[2] == ("daemon", 30)
+
+
+def test_due_settlements_are_rescheduled_if_processing_fails(monkeypatch):
+    db = mock_db()
+    processor = TransactionProcessor(Mock(), db, "mainnet", True, False, False)
+    processor.retries = RetryScheduler(db, 3, 0, 0)
+    settlement = SettlementRecord("0x01", 15, 0, 1)
+    processor.retries.failed(settlement, ValueError("missing trace"))
+    processor.head_tracker = Mock()
+    processor.head_tracker.next_range.return_value = (21, 30)
+    processor.blockchain_data.fetch_tx_data.return_value = []
+    processor.process_batch = Mock(side_effect=ValueError("node error"))
+    # stop the daemon loop after the failed iteration
+    monkeypatch.setattr(
+        "src.transaction_processor.time.sleep", Mock(side_effect=KeyboardInterrupt)
+    )
+
+    with pytest.raises(KeyboardInterrupt):
+        processor.process(21)
+
+    assert processor.process_batch.call_args.args[0] == [settlement]
+    # the failed attempt is counted and the settlement is due again
+    assert processor.retries.attempts == {"0x01": 2}
+    assert processor.retries.due() == [settlement]
+    assert processor.retries.min_block() == 15
+
+
+def test_results_are_written_in_groups():
+    processor = TransactionProcessor(Mock(), mock_db(), "mainnet", True, False, False)
+    processor.db_write_group_size = 2
+    processor.prefetch_chain_data = Mock()
+    settlements = [SettlementRecord(f"0x0{i}", 10 + i, 0, i) for i in range(4)]
+    error = ValueError("node error")
+
+    def compute_settlement_result(settlement):
+        if settlement.tx_hash == "0x01":
+            raise error
+        return SettlementResult(settlement, {}, (settlement.tx_hash, 0), [], [])
+
+    processor.compute_settlement_result = compute_settlement_result
+    written = []
+    processor.write_settlement_results = lambda results, checkpoint: written.append(
+        ([result.settlement.tx_hash for result in results], checkpoint)
+    )
+
+    assert processor.process_batch(settlements, checkpoint=20) == [
+        (settlements[1], error)
+    ]
+    # the checkpoint is written with the last group and stops before the failed settlement
+    assert written == [(["0x00", "0x02"], None), (["0x03"], 10)]
+
+
+def test_buffered_settlement_failing_to_write_is_dead_lettered():
+    db = mock_db()
+    db.write_settlement_results.side_effect = ValueError("value out of range")
+    processor = TransactionProcessor(Mock(), db, "mainnet", True, False, False)
+    processor.retries = RetryScheduler(db, 3, 0, 0)
+    processor.write_buffer = WriteBuffer(
+        processor.store_buffered_results,
+        processor.store_checkpoint,
+        processor.retry_settlement_results,
+        max_rows=100,
+        max_delay=60,
+    )
+    settlement = SettlementRecord("0x01", 15, 0, 1)
+    processor.compute_settlement_result = lambda settlement: SettlementResult(
+        settlement, {}, (settlement.tx_hash, 0), [], []
+    )
+    processor.prefetch_chain_data = Mock()
+
+    settlements = [settlement]
+    # the checkpoint is written after the failed flush and stops before the settlement,
+    # until it is moved to failed_transactions
+    for checkpoint in [14, 14, 20]:
+        processor.record_outcome(
+            settlements, processor.process_batch(settlements, checkpoint=20)
+        )
+        processor.write_buffer.flush()
+        assert db.write_checkpoint.call_args.args == ("daemon", checkpoint)
+        settlements = processor.retries.due()
+
+    db.write_failed_transaction.assert_called_once_with(
+        settlement, 3, "value out of range"
+    )
+    assert len(processor.retries) == 0
+
+
+def test_token_decimals_are_loaded_from_the_database(monkeypatch):
+    registry = TokenDecimalsRegistry()
+    monkeypatch.setattr("src.transaction_processor.TOKEN_DECIMALS", registry)
+    db = mock_db()
+    db.get_token_decimals.return_value = {
+        "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48": 6
+    }
+    TransactionProcessor(Mock(), db, "mainnet", True, False, True)
+
+    assert registry.loaded
+    assert registry.decimals == {"0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48": 6}
+
+
+def test_auction_id_is_decoded_when_processing(monkeypatch):
+    monkeypatch.setattr("src.transaction_processor.BLOCK_HEADERS", Mock())
+    processor = TransactionProcessor(Mock(), mock_db(), "mainnet", True, False, False)
+    processor.imbalances = Mock()
+    processor.blockchain_data.get_auction_id.return_value = 0xABC
+    settlements = [
+        SettlementRecord("0x01", 10, 0, None),
+        SettlementRecord("0x02", 10, 1, 5),
+    ]
+
+    processor.prefetch_chain_data(settlements)
+    processor.blockchain_data.batch.get_transactions.assert_called_once_with(["0x01"])
+    for settlement in settlements:
+        processor.set_auction_id(settlement)
+
+    assert [settlement.auction_id for settlement in settlements] == [0xABC, 5]
+    processor.blockchain_data.get_auction_id.assert_called_once_with("0x01")
@@ -0,0 +1,77 @@
+import time
+
+from src.helpers.blockchain_data import SettlementRecord
+from src.helpers.database import SettlementResult
+from src.helpers.write_buffer import WriteBuffer, result_rows
+
+
+def settlement_result(tx_hash: str) -> SettlementResult:
+    return SettlementResult(
+        SettlementRecord(tx_hash, 15, 0, 1),
+        {"0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48": 10},
+        (tx_hash, 1728044411),
+        [(tx_hash, "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48")],
+        [],
+    )
+
+
+def test_flush_when_full_with_checkpoint():
+    events = []
+    buffer = WriteBuffer(
+        lambda results, checkpoint: events.append(
+            ([r.settlement.tx_hash for r in results], checkpoint)
+        ),
+        lambda block: events.append(block),
+        lambda results, error: events.append(error),
+        max_rows=2 * result_rows(settlement_result("0x01")),
+        max_delay=60,
+    )
+    buffer.add([settlement_result("0x01")])
+    buffer.set_checkpoint(100)
+    assert events == []
+    buffer.add([settlement_result("0x02")])
+    # the checkpoint is written with the results
+    assert events == [(["0x01", "0x02"], 100)]
+    assert buffer.stats() == {"buffered_rows": 0, "flushes": 1, "rows_written": 6}
+
+
+def test_failed_write_is_passed_on_before_checkpoint():
+    events = []
+    error = ValueError("connection lost")
+
+    def write(results, checkpoint):
+        raise error
+
+    buffer = WriteBuffer(
+        write,
+        lambda block: events.append(block),
+        lambda results, err: events.append((len(results), err)),
+        max_rows=100,
+        max_delay=60,
+    )
+    buffer.add([settlement_result("0x01")])
+    buffer.set_checkpoint(100)
+    buffer.close()
+    assert events == [(1, error), 100]
+
+
+def test_flush_after_max_delay():
+    written = []
+    buffer = WriteBuffer(
+        lambda results, checkpoint: written.extend(results),
+        lambda block: None,
+        lambda results, error: None,
+        100,
+        0.05,
+    )
+    buffer.start()
+    buffer.add([settlement_result("0x01")])
+    for _ in range(100):
+        if written:
+            break
+        time.sleep(0.01)
+    assert len(written) == 1
+    buffer.close()
+    assert buffer.thread is not None
+    buffer.thread.join(1)
+    assert not buffer.thread.is_alive()